@@ -0,0 +1,192 @@
+"""端到端基准测试：从源目录写入文件到客户端目标目录出现相同内容的延迟和吞吐量
+
+服务端在子进程中监控源目录，客户端在本进程中运行（TCPClient + ApplyEngine + FileSync），
+每个文件的延迟为开始写入到目标文件大小与源文件一致、事件应用完成的时间。
+依次测量创建新文件和修改已有文件两个阶段。
+
+用法：
+    python benchmarks/bench_end_to_end.py --files 2000 --rate 500 --debounce 0 --json e2e.json
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from common import ServerProcess, environment_info, latency_summary, quiet, write_result  # noqa: E402
+from apply_engine import ApplyEngine  # noqa: E402
+from file_sync import FileSync  # noqa: E402
+from file_transfer import FileFetcher  # noqa: E402
+from tcp_client import TCPClient  # noqa: E402
+
+# 等待客户端连接服务端的最长时间（秒）
+CONNECT_TIMEOUT = 30
+
+
+class LatencyRecorder:
+    def __init__(self, file_sync):
+        """包装FileSync.handle_event，记录每个目标文件内容到位的时间"""
+        self.file_sync = file_sync
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # 目标路径 -> (期望大小, 写入时间)
+        self.expected = {}
+        self.latencies = []
+
+    def expect(self, target_path, size, write_time):
+        """登记一个刚写入的文件"""
+        with self.lock:
+            self.expected[target_path] = (size, write_time)
+
+    def handle_event(self, event):
+        result = self.file_sync.handle_event(event)
+        if event.file_path:
+            self._check(self.file_sync.get_target_path(event.file_path))
+        if event.new_file_path:
+            self._check(self.file_sync.get_target_path(event.new_file_path))
+        return result
+
+    def _check(self, target_path):
+        with self.lock:
+            item = self.expected.get(target_path)
+        if item is None:
+            return
+        try:
+            size = os.path.getsize(target_path)
+        except OSError:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            if size != item[0] or self.expected.get(target_path) is not item:
+                return
+            del self.expected[target_path]
+            self.latencies.append(now - item[1])
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """等待所有已登记的文件到位，返回未到位的文件数"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.expected:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return len(self.expected)
+
+    def take(self):
+        """取出并清空已记录的延迟"""
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            return latencies
+
+
+def write_phase(source, recorder, file_sync, names, rate, rng, append):
+    """按rate（文件/秒，0为不限速）写入文件，返回写入耗时"""
+    interval = 1.0 / rate if rate > 0 else 0
+    start = time.perf_counter()
+    for index, name in enumerate(names):
+        if interval:
+            delay = start + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        path = os.path.join(source, name)
+        data = rng.randbytes(rng.randint(1, 4096))
+        # 先登记再写入，避免事件在登记之前就已应用
+        size = (os.path.getsize(path) if append else 0) + len(data)
+        recorder.expect(file_sync.get_target_path(path), size, time.perf_counter())
+        with open(path, 'ab' if append else 'wb') as f:
+            f.write(data)
+    return time.perf_counter() - start
+
+
+def run_phase(phase, source, recorder, file_sync, names, args, rng):
+    """执行一个阶段并汇总延迟和吞吐量"""
+    write_seconds = write_phase(source, recorder, file_sync, names, args.rate, rng, phase == 'modify')
+    start = time.perf_counter()
+    missing = recorder.wait(args.timeout)
+    latencies = recorder.take()
+    total_seconds = write_seconds + time.perf_counter() - start
+    return {
+        'files': len(names),
+        'applied': len(latencies),
+        'missing': missing,
+        'write_seconds': round(write_seconds, 3),
+        'total_seconds': round(total_seconds, 3),
+        'files_per_second': round(len(latencies) / total_seconds, 1) if total_seconds > 0 else None,
+        'latency_ms': latency_summary(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=2000, help='每个阶段写入的文件数')
+    parser.add_argument('--dirs', type=int, default=20, help='文件分布的子目录数')
+    parser.add_argument('--rate', type=float, default=0, help='每秒写入的文件数，0为不限速')
+    parser.add_argument('--debounce', type=int, default=0, help='服务端DebounceDelay（毫秒）')
+    parser.add_argument('--batch-latency', type=int, default=50, help='服务端BatchLatency（毫秒）')
+    parser.add_argument('--transfer', choices=('tcp', 'shared'), default='tcp', help='客户端传输方式')
+    parser.add_argument('--workers', type=int, default=5, help='客户端应用线程数')
+    parser.add_argument('--fsync', default='batch', help='写入持久化方式：none、file 或 batch')
+    parser.add_argument('--timeout', type=float, default=120, help='每个阶段等待同步完成的最长秒数')
+    parser.add_argument('--seed', type=int, default=0, help='文件内容随机种子')
+    parser.add_argument('--json', help='将结果写入JSON文件')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='filesync_e2e_')
+    source = os.path.join(work_dir, 'source')
+    target = os.path.join(work_dir, 'target')
+    names = [os.path.join(f"dir{index % args.dirs:03d}", f"file{index:06d}.dat") for index in range(args.files)]
+    for directory in {os.path.dirname(name) for name in names}:
+        os.makedirs(os.path.join(source, directory))
+    os.makedirs(target)
+    rng = random.Random(args.seed)
+
+    result = {
+        'benchmark': 'end_to_end',
+        'environment': environment_info(),
+        'parameters': {'files': args.files, 'dirs': args.dirs, 'rate': args.rate, 'debounce_ms': args.debounce,
+                       'batch_latency_ms': args.batch_latency, 'transfer': args.transfer,
+                       'workers': args.workers, 'fsync': args.fsync, 'seed': args.seed},
+    }
+    server = ServerProcess(source, work_dir, DebounceDelay=args.debounce, BatchLatency=args.batch_latency)
+    tcp_client = apply_engine = None
+    try:
+        with quiet():
+            server.start()
+            fetcher = FileFetcher('127.0.0.1', server.port, source) if args.transfer == 'tcp' else None
+            file_sync = FileSync(source, target, args.workers, fetcher, fsync_mode=args.fsync)
+            recorder = LatencyRecorder(file_sync)
+            apply_engine = ApplyEngine(recorder.handle_event, args.workers, file_sync.writer.commit)
+            apply_engine.start()
+            tcp_client = TCPClient('127.0.0.1', server.port, apply_engine.submit)
+            tcp_client.connect()
+            deadline = time.monotonic() + CONNECT_TIMEOUT
+            while not tcp_client.is_connected and time.monotonic() < deadline:
+                time.sleep(0.05)
+            # 等待握手完成后再开始写入
+            time.sleep(0.5)
+
+            for phase in ('create', 'modify'):
+                result[phase] = run_phase(phase, source, recorder, file_sync, names, args, rng)
+            result['apply_engine'] = apply_engine.get_stats()
+    finally:
+        with quiet():
+            if tcp_client is not None:
+                tcp_client.disconnect()
+            if apply_engine is not None:
+                apply_engine.stop()
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    write_result(result, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""同步基准测试：对合成目录树测量FileSync.full_sync和compare_and_sync_diff的耗时
+
+每种目录树依次测量：空目标目录的全量同步、没有变化时的增量对比、修改部分文件后的增量同步。
+shared方式直接读取源目录，tcp方式通过子进程中的服务端数据通道获取（使用清单和Merkle树对比）。
+
+用法：
+    python benchmarks/bench_sync.py --preset quick --profiles tiny,huge --transfer shared,tcp --json sync.json
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from common import ServerProcess, environment_info, quiet, write_result  # noqa: E402
+from tree_gen import PRESETS, PROFILES, generate_tree, modify_files  # noqa: E402
+from file_sync import FileSync  # noqa: E402
+from file_transfer import FileFetcher  # noqa: E402
+from manifest import Manifest  # noqa: E402
+
+TRANSFERS = ('shared', 'tcp')
+# 等待服务端Merkle树建立完成的最长时间（秒）
+TREE_READY_TIMEOUT = 600
+
+
+def timed_sync(file_sync, operation):
+    """执行一次同步并返回耗时和同步统计"""
+    start = time.perf_counter()
+    with quiet():
+        success = operation()
+    seconds = time.perf_counter() - start
+    stats = file_sync.sync_stats
+    return {
+        'seconds': round(seconds, 3),
+        'success': bool(success),
+        'checked_files': stats['total_files'],
+        'synced_files': stats['synced_files'],
+        'failed_files': stats['failed_files'],
+        'files_per_second': round(stats['total_files'] / seconds, 1) if seconds > 0 else None,
+    }
+
+
+def wait_tree_ready(fetcher):
+    """等待服务端建立完Merkle树，否则增量对比会回退为扫描共享路径"""
+    deadline = time.monotonic() + TREE_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        with quiet():
+            listing = fetcher.list_tree('')
+        if listing is not None:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def bench_transfer(source, work_dir, transfer, tree_info, args):
+    """对一种传输方式测量全量同步、无变化对比和部分修改后的增量同步"""
+    target = tempfile.mkdtemp(prefix=f'target_{transfer}_', dir=work_dir)
+    server = None
+    fetcher = None
+    manifest = None
+    try:
+        if transfer == 'tcp':
+            server = ServerProcess(source, work_dir).start()
+            fetcher = FileFetcher('127.0.0.1', server.port, source)
+            manifest = Manifest(os.path.join(work_dir, f"{os.path.basename(target)}.manifest.db"))
+            wait_tree_ready(fetcher)
+
+        def new_file_sync():
+            return FileSync(source, target, args.workers, fetcher, manifest=manifest, fsync_mode=args.fsync)
+
+        file_sync = new_file_sync()
+        result = {'full_sync': timed_sync(file_sync, file_sync.full_sync)}
+        full = result['full_sync']
+        if full['seconds'] > 0:
+            full['mb_per_second'] = round(tree_info['bytes'] / 1024 / 1024 / full['seconds'], 1)
+        if manifest is not None:
+            manifest.flush()
+
+        file_sync = new_file_sync()
+        result['diff_unchanged'] = timed_sync(file_sync, file_sync.compare_and_sync_diff)
+
+        modified = modify_files(source, args.modify_fraction, args.seed)
+        if server is not None:
+            # 等待服务端收到文件事件并将目录标记为待重新扫描
+            time.sleep(args.settle)
+        file_sync = new_file_sync()
+        result['diff_modified'] = timed_sync(file_sync, file_sync.compare_and_sync_diff)
+        result['diff_modified']['modified_files'] = modified
+        return result
+    finally:
+        if manifest is not None:
+            manifest.close()
+        if server is not None:
+            server.stop()
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick', help='目录树规模')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='目录树类型，逗号分隔')
+    parser.add_argument('--transfer', default=','.join(TRANSFERS), help='传输方式，逗号分隔')
+    parser.add_argument('--workers', type=int, default=5, help='同步线程数')
+    parser.add_argument('--fsync', default='batch', help='写入持久化方式：none、file 或 batch')
+    parser.add_argument('--modify-fraction', type=float, default=0.01, help='增量测试中修改的文件比例')
+    parser.add_argument('--settle', type=float, default=2.0, help='tcp方式修改文件后等待服务端处理事件的秒数')
+    parser.add_argument('--seed', type=int, default=0, help='目录树随机种子')
+    parser.add_argument('--work-dir', help='工作目录（默认使用临时目录，结束后删除）')
+    parser.add_argument('--json', help='将结果写入JSON文件')
+    args = parser.parse_args()
+
+    profiles = [profile for profile in args.profiles.split(',') if profile]
+    transfers = [transfer for transfer in args.transfer.split(',') if transfer]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='filesync_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    result = {
+        'benchmark': 'sync',
+        'environment': environment_info(),
+        'parameters': {'preset': args.preset, 'workers': args.workers, 'fsync': args.fsync,
+                       'modify_fraction': args.modify_fraction, 'seed': args.seed,
+                       'tree': PRESETS[args.preset]},
+        'profiles': {},
+    }
+    try:
+        for profile in profiles:
+            source = os.path.join(work_dir, f'source_{profile}')
+            shutil.rmtree(source, ignore_errors=True)
+            os.makedirs(source)
+            print(f"Generating {profile} tree...", file=sys.stderr)
+            tree_info = generate_tree(source, profile, PRESETS[args.preset], args.seed)
+            profile_result = {'tree': tree_info}
+            for transfer in transfers:
+                print(f"Benchmarking {profile} / {transfer}...", file=sys.stderr)
+                profile_result[transfer] = bench_transfer(source, work_dir, transfer, tree_info, args)
+            result['profiles'][profile] = profile_result
+            shutil.rmtree(source, ignore_errors=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    write_result(result, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
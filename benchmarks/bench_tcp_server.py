@@ -0,0 +1,132 @@
+"""TCP服务器基准测试：保持大量订阅连接并测量广播扇出延迟
+
+用法：
+    python benchmarks/bench_tcp_server.py --clients 1000 --events 200
+    python benchmarks/bench_tcp_server.py --clients 1000 --events 200 --prefixes 100
+"""
+import argparse
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from common import environment_info, free_port, latency_summary, write_result  # noqa: E402
+from tcp_server import TCPServer  # noqa: E402
+
+
+def raise_fd_limit(wanted):
+    """尽量提高进程可打开的文件描述符数量"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def open_subscribers(port, count, prefixes=0):
+    """建立count个二进制协议订阅连接并等待握手完成，prefixes大于0时第i个连接只订阅目录dir_{i % prefixes}"""
+    sockets = []
+    for index in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(f"HELLO|2||||dir_{index % prefixes}\n".encode() if prefixes else b"HELLO|2\n")
+        sockets.append(sock)
+
+    for sock in sockets:
+        welcome = b''
+        while not welcome.endswith(b'\n'):
+            welcome += sock.recv(1)
+        sock.setblocking(False)
+    return sockets
+
+
+def measure_fanout(server, sockets, events, path, prefixes=0):
+    """逐个广播事件，记录从调用broadcast到所有订阅者收到完整帧的时间
+
+    prefixes大于0时事件轮流写入各订阅目录，只等待订阅了该目录的连接
+    """
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        selector.register(sock, selectors.EVENT_READ)
+
+    frame_size = None
+    latencies = []
+    for index in range(events):
+        if prefixes:
+            subscribers = sockets[index % prefixes::prefixes]
+            file_path = f"{path}/dir_{index % prefixes}/file_{index}.txt"
+        else:
+            subscribers = sockets
+            file_path = f"{path}/file_{index}.txt"
+        received = dict.fromkeys(subscribers, 0)
+        done = 0
+        start = time.perf_counter()
+        server.broadcast('MODIFY', file_path)
+
+        while done < len(subscribers):
+            for key, _ in selector.select(5):
+                data = key.fileobj.recv(65536)
+                if frame_size is None:
+                    frame_size = int.from_bytes(data[:4], 'big') + 4
+                received[key.fileobj] += len(data)
+                if received[key.fileobj] >= frame_size:
+                    done += 1
+        latencies.append(time.perf_counter() - start)
+
+    selector.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1000, help='订阅连接数')
+    parser.add_argument('--events', type=int, default=200, help='广播事件数')
+    parser.add_argument('--prefixes', type=int, default=0,
+                        help='订阅目录数，连接轮流订阅其中一个目录；0为所有连接接收全部事件')
+    parser.add_argument('--port', type=int, default=0, help='监听端口，0为自动选择空闲端口')
+    parser.add_argument('--json', help='将结果写入JSON文件')
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients * 2 + 100)
+    args.port = args.port or free_port()
+
+    server = TCPServer('127.0.0.1', args.port, root_dir='/bench/source')
+    if not server.start():
+        return 1
+
+    try:
+        connect_start = time.perf_counter()
+        sockets = open_subscribers(args.port, args.clients, args.prefixes)
+        connect_time = time.perf_counter() - connect_start
+
+        # 等待事件循环登记所有订阅者
+        while server.get_client_count() < args.clients:
+            time.sleep(0.01)
+
+        latencies = measure_fanout(server, sockets, args.events, '/bench/source', args.prefixes)
+        result = {
+            'benchmark': 'tcp_server_fanout',
+            'environment': environment_info(),
+            'clients_held': server.get_client_count(),
+            'server_threads': threading.active_count() - 1,
+            'connect_seconds': round(connect_time, 3),
+            'events': args.events,
+            'prefixes': args.prefixes,
+            'fanout_latency_ms': latency_summary(latencies),
+        }
+        for sock in sockets:
+            sock.close()
+    finally:
+        server.stop()
+
+    write_result(result, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""基准测试公用函数：运行环境信息、结果输出和服务端子进程"""
+import contextlib
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SERVER_DIR = os.path.join(REPO_ROOT, 'server')
+CLIENT_DIR = os.path.join(REPO_ROOT, 'client')
+# 等待服务端开始监听的最长时间（秒）
+SERVER_START_TIMEOUT = 30
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment_info():
+    """记录结果对应的代码版本和运行环境，便于在不同版本之间对比"""
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'describe': _git('describe', '--always', '--dirty'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_result(result, json_path=None):
+    """输出结果，json_path不为空时同时写入JSON文件"""
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+def percentile(values, fraction):
+    """计算百分位数"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_summary(latencies):
+    """延迟列表（秒）汇总为毫秒统计"""
+    if not latencies:
+        return None
+    return {
+        'p50': round(percentile(latencies, 0.5) * 1000, 3),
+        'p90': round(percentile(latencies, 0.9) * 1000, 3),
+        'p99': round(percentile(latencies, 0.99) * 1000, 3),
+        'max': round(max(latencies) * 1000, 3),
+        'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+    }
+
+
+def free_port():
+    """返回一个当前空闲的本地端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def quiet():
+    """屏蔽被测代码的逐文件输出，避免终端输出影响计时"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class ServerProcess:
+    def __init__(self, monitor_dir, work_dir, **settings):
+        """在子进程中运行服务端（与客户端模块同名，不能在同一进程中导入）
+
+        settings为server.ini中[Server]节的额外配置，如DebounceDelay=0
+        """
+        self.monitor_dir = os.path.abspath(monitor_dir)
+        self.work_dir = tempfile.mkdtemp(prefix='server_', dir=work_dir)
+        self.port = free_port()
+        self.settings = settings
+        self.process = None
+        self.log_file = None
+
+    def start(self):
+        """写入配置并启动服务端，等待开始监听"""
+        lines = ['[Server]', f'MonitorDir = {self.monitor_dir}', 'BindIP = 127.0.0.1', f'Port = {self.port}',
+                 'JournalDir =', 'HashCacheFile =']
+        lines += [f'{key} = {value}' for key, value in self.settings.items()]
+        with open(os.path.join(self.work_dir, 'server.ini'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        self.log_file = open(os.path.join(self.work_dir, 'server.log'), 'w', encoding='utf-8')
+        self.process = subprocess.Popen([sys.executable, '-u', os.path.join(SERVER_DIR, 'main.py')],
+                                        cwd=self.work_dir, stdout=self.log_file, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited, see {self.log_file.name}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Server did not start listening")
+
+    def stop(self):
+        """停止服务端（POSIX下发送SIGINT，与Ctrl+C相同的正常退出流程）"""
+        if self.process is not None and self.process.poll() is None:
+            if os.name == 'posix':
+                self.process.send_signal(signal.SIGINT)
+            else:
+                self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,71 @@
+"""对比两次基准测试结果（run_suite.py或单个基准测试输出的JSON），列出各数值指标的变化
+
+用法：
+    python benchmarks/compare.py results/base.json results/HEAD.json --threshold 5
+"""
+import argparse
+import json
+import sys
+
+# 不参与对比的字段：运行环境和测试参数
+SKIPPED_KEYS = ('environment', 'parameters')
+
+
+def flatten(data, prefix=''):
+    """将嵌套字典展开为{'a.b.c': 数值}，只保留数值"""
+    values = {}
+    for key, value in data.items():
+        if key in SKIPPED_KEYS:
+            continue
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def _format(value):
+    return '-' if value is None else f"{value:.6g}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base', help='基准结果')
+    parser.add_argument('current', help='当前结果')
+    parser.add_argument('--threshold', type=float, default=0, help='只显示变化超过该百分比的指标')
+    args = parser.parse_args()
+
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    for label, data in (('base', base), ('current', current)):
+        environment = data.get('environment') or {}
+        print(f"{label:8} {environment.get('describe')}  {environment.get('timestamp')}")
+    print()
+
+    base_values = flatten(base)
+    current_values = flatten(current)
+    width = max((len(name) for name in base_values.keys() | current_values.keys()), default=10)
+    print(f"{'metric':{width}}  {'base':>12}  {'current':>12}  {'change':>8}")
+    for name in sorted(base_values.keys() | current_values.keys()):
+        old = base_values.get(name)
+        new = current_values.get(name)
+        if old is None or new is None:
+            change = 'n/a'
+        elif old == 0:
+            if new == 0 and args.threshold > 0:
+                continue
+            change = '0.0%' if new == 0 else 'new'
+        else:
+            percent = (new - old) / abs(old) * 100
+            if abs(percent) < args.threshold:
+                continue
+            change = f"{percent:+.1f}%"
+        print(f"{name:{width}}  {_format(old):>12}  {_format(new):>12}  {change:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
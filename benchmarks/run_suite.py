@@ -0,0 +1,78 @@
+"""运行全部基准测试并将结果合并为一个JSON文件，用于在不同版本之间对比
+
+每个基准测试在独立的子进程中运行（服务端和客户端模块同名，不能在同一进程中导入）。
+
+用法：
+    python benchmarks/run_suite.py --preset quick --output results/HEAD.json
+    python benchmarks/compare.py results/base.json results/HEAD.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import environment_info, write_result
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def suite_commands(args):
+    """各基准测试的名称和命令行参数"""
+    return {
+        'sync': ['bench_sync.py', '--preset', args.preset, '--profiles', args.profiles],
+        'end_to_end': ['bench_end_to_end.py', '--files', str(args.e2e_files), '--rate', str(args.e2e_rate)],
+        'tcp_server': ['bench_tcp_server.py', '--clients', str(args.clients), '--events', '200'],
+    }
+
+
+def run_benchmark(name, command, work_dir):
+    """在子进程中运行一个基准测试并读取其JSON结果"""
+    json_path = os.path.join(work_dir, f'{name}.json')
+    print(f"Running {name}...", file=sys.stderr)
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, os.path.join(BENCH_DIR, command[0]), *command[1:],
+                                '--json', json_path], stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    if completed.returncode != 0 or not os.path.exists(json_path):
+        print(f"Benchmark {name} failed with exit code {completed.returncode}", file=sys.stderr)
+        return {'error': f'exit code {completed.returncode}'}
+    with open(json_path, encoding='utf-8') as f:
+        result = json.load(f)
+    # 环境信息在套件结果中只记录一次
+    result.pop('environment', None)
+    result['wall_seconds'] = round(seconds, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', default='quick', help='目录树规模：quick 或 full')
+    parser.add_argument('--profiles', default='tiny,huge,deep,unicode', help='同步测试的目录树类型')
+    parser.add_argument('--e2e-files', type=int, default=2000, help='端到端测试每个阶段的文件数')
+    parser.add_argument('--e2e-rate', type=float, default=500, help='端到端测试每秒写入的文件数')
+    parser.add_argument('--clients', type=int, default=1000, help='TCP服务器测试的订阅连接数')
+    parser.add_argument('--only', help='只运行指定的基准测试，逗号分隔')
+    parser.add_argument('--output', help='合并结果的JSON文件')
+    args = parser.parse_args()
+
+    commands = suite_commands(args)
+    names = args.only.split(',') if args.only else list(commands)
+    result = {'environment': environment_info(), 'preset': args.preset, 'benchmarks': {}}
+    with tempfile.TemporaryDirectory(prefix='filesync_suite_') as work_dir:
+        for name in names:
+            if name not in commands:
+                print(f"Unknown benchmark: {name}", file=sys.stderr)
+                continue
+            result['benchmarks'][name] = run_benchmark(name, commands[name], work_dir)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    write_result(result, args.output)
+    return 0 if all('error' not in item for item in result['benchmarks'].values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
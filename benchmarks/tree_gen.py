@@ -0,0 +1,157 @@
+"""生成基准测试用的合成目录树，相同参数和种子总是生成相同的内容
+
+用法：
+    python benchmarks/tree_gen.py /tmp/bench_tree --profile tiny --preset quick
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# 各规模的生成参数：quick用于日常对比，full对应百万级小文件和GB级大文件
+PRESETS = {
+    'quick': {
+        'tiny_files': 10000,
+        'tiny_max_size': 512,
+        'huge_files': 2,
+        'huge_size': 64 * 1024 * 1024,
+        'deep_depth': 32,
+        'deep_files_per_level': 4,
+        'unicode_files': 1000,
+    },
+    'full': {
+        'tiny_files': 1000000,
+        'tiny_max_size': 512,
+        'huge_files': 4,
+        'huge_size': 1024 * 1024 * 1024,
+        'deep_depth': 128,
+        'deep_files_per_level': 8,
+        'unicode_files': 20000,
+    },
+}
+PROFILES = ('tiny', 'huge', 'deep', 'unicode')
+# 小文件每个目录的文件数
+FILES_PER_DIR = 1000
+# 大文件按块写入，块内容由种子决定
+HUGE_BLOCK_SIZE = 4 * 1024 * 1024
+# 文件名使用的各种文字：中日韩、重音、西里尔、阿拉伯（从右到左）、组合字符和表情符号
+UNICODE_WORDS = ('文件', '同步', 'データ', '파일', 'café', 'naïve', 'Ångström', 'файл', 'ملف', 'ε̃',
+                 'é', '😀', '🚀', 'z̷a̷l̷g̷o', 'ß', 'İ', 'ﬁ', 'Ω')
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _generate_tiny(root, params, rng):
+    count = total = 0
+    for index in range(params['tiny_files']):
+        directory = os.path.join(root, 'tiny', f"d{index // FILES_PER_DIR:05d}")
+        if index % FILES_PER_DIR == 0:
+            os.makedirs(directory, exist_ok=True)
+        data = rng.randbytes(rng.randint(0, params['tiny_max_size']))
+        _write(os.path.join(directory, f"f{index:07d}.txt"), data)
+        count += 1
+        total += len(data)
+    return count, total
+
+
+def _generate_huge(root, params, rng):
+    directory = os.path.join(root, 'huge')
+    os.makedirs(directory, exist_ok=True)
+    block = rng.randbytes(HUGE_BLOCK_SIZE)
+    total = 0
+    for index in range(params['huge_files']):
+        with open(os.path.join(directory, f"huge_{index}.bin"), 'wb') as f:
+            remaining = params['huge_size']
+            block_index = 0
+            while remaining > 0:
+                # 每块开头写入文件和块序号，块之间内容不同
+                data = f"{index}:{block_index}:".encode('ascii') + block
+                data = data[:min(remaining, HUGE_BLOCK_SIZE)]
+                f.write(data)
+                remaining -= len(data)
+                block_index += 1
+        total += params['huge_size']
+    return params['huge_files'], total
+
+
+def _generate_deep(root, params, rng):
+    directory = os.path.join(root, 'deep')
+    count = total = 0
+    for level in range(params['deep_depth']):
+        directory = os.path.join(directory, f"level{level:03d}")
+        os.makedirs(directory, exist_ok=True)
+        for index in range(params['deep_files_per_level']):
+            data = rng.randbytes(rng.randint(0, 4096))
+            _write(os.path.join(directory, f"file{index}.dat"), data)
+            count += 1
+            total += len(data)
+    return count, total
+
+
+def _generate_unicode(root, params, rng):
+    count = total = 0
+    for index in range(params['unicode_files']):
+        directory = os.path.join(root, 'unicode', rng.choice(UNICODE_WORDS))
+        os.makedirs(directory, exist_ok=True)
+        name = f"{rng.choice(UNICODE_WORDS)} {rng.choice(UNICODE_WORDS)}_{index}.txt"
+        data = f"{name}\n".encode('utf-8') * rng.randint(1, 64)
+        _write(os.path.join(directory, name), data)
+        count += 1
+        total += len(data)
+    return count, total
+
+
+GENERATORS = {
+    'tiny': _generate_tiny,
+    'huge': _generate_huge,
+    'deep': _generate_deep,
+    'unicode': _generate_unicode,
+}
+
+
+def generate_tree(root, profile, params, seed=0):
+    """在root下生成一种目录树，返回{'files': 文件数, 'bytes': 总字节数, 'seconds': 生成耗时}"""
+    rng = random.Random(f"{profile}:{seed}")
+    start = time.perf_counter()
+    count, total = GENERATORS[profile](root, params, rng)
+    return {'files': count, 'bytes': total, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+def modify_files(root, fraction, seed=0):
+    """按种子选取约fraction比例的文件追加内容并推后修改时间，返回修改的文件数"""
+    rng = random.Random(f"modify:{seed}")
+    modified = 0
+    for directory, _dirnames, filenames in sorted(os.walk(root)):
+        for name in sorted(filenames):
+            if rng.random() >= fraction:
+                continue
+            path = os.path.join(directory, name)
+            with open(path, 'ab') as f:
+                f.write(b'modified\n')
+            file_stat = os.stat(path)
+            os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 2 * 10 ** 9))
+            modified += 1
+    return modified
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='输出目录')
+    parser.add_argument('--profile', choices=PROFILES + ('all',), default='all', help='目录树类型')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick', help='规模')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    args = parser.parse_args()
+
+    profiles = PROFILES if args.profile == 'all' else (args.profile,)
+    result = {profile: generate_tree(args.root, profile, PRESETS[args.preset], args.seed) for profile in profiles}
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
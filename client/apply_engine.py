@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+# 涉及整个子树的事件：目录被删除或重命名时，子树内的所有事件都必须与其保持顺序
+SUBTREE_EVENT_TYPES = ('DELETE', 'RENAME')
+
+APPLY_LAG = REGISTRY.histogram('filesync_client_apply_lag_seconds',
+                               'Time from receiving an event to the change being on disk')
+EVENTS_APPLIED = REGISTRY.counter('filesync_client_events_applied_total', 'Events applied', ('result',))
+APPLY_QUEUE = REGISTRY.gauge('filesync_client_apply_queue_depth', 'Events waiting to be applied')
+APPLY_IN_PROGRESS = REGISTRY.gauge('filesync_client_apply_in_progress', 'Events being applied')
+
+
+class ApplyTask:
+    def __init__(self, event, paths, subtree):
+        """一个待应用的事件及其依赖关系"""
+        self.event = event
+        self.paths = paths
+        self.subtree = subtree
+        # 尚未完成的前序事件数量，为0时可以执行
+        self.waiting = 0
+        # 等待本事件完成的后续事件
+        self.dependents = []
+        self.received_time = time.monotonic()
+
+
+class ApplyEngine:
+    def __init__(self, apply_callback, max_workers=5, idle_callback=None):
+        """实时事件应用引擎：事件交给线程池并行应用，同一路径上的事件保持到达顺序
+
+        DELETE/RENAME按子树排序：必须等待其路径及子路径上更早的事件完成，
+        之后到达的、位于其子树内的事件也必须等它完成；互不相关的文件并行同步，
+        接收线程只负责登记事件，不会被大文件传输阻塞。
+        idle_callback在所有已登记的事件应用完成时调用（如提交一批写入）
+        """
+        self.apply_callback = apply_callback
+        self.idle_callback = idle_callback
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.running = False
+        # 路径 -> 该路径上最后一个未完成的事件
+        self.last_task = {}
+        # 路径 -> 该路径上最后一个未完成的子树事件
+        self.last_subtree_task = {}
+        # 路径 -> 路径下（不含自身）未完成的事件数量
+        self.descendant_count = {}
+        self.unfinished = set()
+        self.running_count = 0
+
+        # 统计信息：应用延迟为从收到事件到应用完成的时间
+        self.applied_count = 0
+        self.failed_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        APPLY_QUEUE.set_function(lambda: len(self.unfinished) - self.running_count)
+        APPLY_IN_PROGRESS.set_function(lambda: self.running_count)
+
+    def start(self):
+        """启动工作线程池"""
+        if self.running:
+            return
+        self.running = True
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def stop(self):
+        """停止引擎，等待正在应用的事件完成，尚未开始的事件被丢弃"""
+        if not self.running:
+            return
+        with self.lock:
+            self.running = False
+            skipped = len(self.unfinished) - self.running_count
+        self.executor.shutdown(wait=True)
+        if skipped:
+            print(f"Apply engine stopped, {skipped} queued events not applied")
+
+    def _ancestors(self, path):
+        """路径的所有上级目录"""
+        parent = os.path.dirname(path)
+        while parent and parent != path:
+            yield parent
+            path, parent = parent, os.path.dirname(parent)
+
+    def submit(self, event):
+        """登记一个事件，没有需要等待的前序事件时立即执行"""
+        paths = [os.path.normpath(event.file_path)] if event.file_path else []
+        if event.new_file_path:
+            paths.append(os.path.normpath(event.new_file_path))
+        task = ApplyTask(event, paths, event.event_type in SUBTREE_EVENT_TYPES)
+
+        with self.lock:
+            if not self.running:
+                return False
+
+            depends_on = set()
+            for path in paths:
+                previous = self.last_task.get(path)
+                if previous is not None:
+                    depends_on.add(previous)
+                # 上级目录正在被删除或重命名
+                for ancestor in self._ancestors(path):
+                    previous = self.last_subtree_task.get(ancestor)
+                    if previous is not None:
+                        depends_on.add(previous)
+                # 子树事件还需等待子路径上的所有事件
+                if task.subtree and self.descendant_count.get(path):
+                    prefix = path.rstrip(os.sep) + os.sep
+                    for other in self.unfinished:
+                        if any(p.startswith(prefix) for p in other.paths):
+                            depends_on.add(other)
+
+            task.waiting = len(depends_on)
+            for previous in depends_on:
+                previous.dependents.append(task)
+
+            for path in paths:
+                self.last_task[path] = task
+                if task.subtree:
+                    self.last_subtree_task[path] = task
+                for ancestor in self._ancestors(path):
+                    self.descendant_count[ancestor] = self.descendant_count.get(ancestor, 0) + 1
+            self.unfinished.add(task)
+
+            if task.waiting == 0:
+                self._run_locked(task)
+        return True
+
+    def _run_locked(self, task):
+        """将可以执行的事件交给线程池（调用方持有锁）"""
+        self.running_count += 1
+        self.executor.submit(self._apply, task)
+
+    def _apply(self, task):
+        """工作线程：应用事件并释放等待它的后续事件"""
+        try:
+            success = self.apply_callback(task.event) is not False
+        except Exception as e:
+            print(f"Error applying {task.event.event_type} {task.event.file_path}: {e}")
+            success = False
+        lag = time.monotonic() - task.received_time
+        APPLY_LAG.observe(lag)
+        EVENTS_APPLIED.inc(result='applied' if success else 'failed')
+
+        with self.lock:
+            self.running_count -= 1
+            if success:
+                self.applied_count += 1
+            else:
+                self.failed_count += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+
+            self.unfinished.discard(task)
+            for path in task.paths:
+                if self.last_task.get(path) is task:
+                    del self.last_task[path]
+                if self.last_subtree_task.get(path) is task:
+                    del self.last_subtree_task[path]
+                for ancestor in self._ancestors(path):
+                    count = self.descendant_count[ancestor] - 1
+                    if count:
+                        self.descendant_count[ancestor] = count
+                    else:
+                        del self.descendant_count[ancestor]
+
+            if not self.running:
+                return
+            for dependent in task.dependents:
+                dependent.waiting -= 1
+                if dependent.waiting == 0:
+                    self._run_locked(dependent)
+            idle = not self.unfinished
+
+        if idle and self.idle_callback:
+            try:
+                self.idle_callback()
+            except Exception as e:
+                print(f"Error in apply engine idle callback: {e}")
+
+    def get_stats(self, reset_lag=False):
+        """返回队列深度和应用延迟统计，reset_lag为True时重置延迟统计区间"""
+        with self.lock:
+            now = time.monotonic()
+            completed = self.applied_count + self.failed_count
+            stats = {
+                'queue_depth': len(self.unfinished) - self.running_count,
+                'in_progress': self.running_count,
+                'applied': self.applied_count,
+                'failed': self.failed_count,
+                'oldest_pending_seconds': max((now - task.received_time for task in self.unfinished),
+                                              default=0.0),
+                'lag_mean_seconds': self.lag_total / completed if completed else 0.0,
+                'lag_max_seconds': self.lag_max,
+            }
+            if reset_lag:
+                self.lag_total = 0.0
+                self.lag_max = 0.0
+                self.applied_count = 0
+                self.failed_count = 0
+            return stats
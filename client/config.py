@@ -30,6 +30,23 @@ class Config:
             self.server_root = config.get('Client', 'ServerRoot', fallback='D:/source')
             self.sync_mode = config.get('Client', 'SyncMode', fallback='incremental')
             self.max_workers = config.getint('Client', 'MaxWorkers', fallback=5)
+            self.transfer_mode = config.get('Client', 'TransferMode', fallback='tcp')
+            self.delta_min_size = config.getint('Client', 'DeltaMinSize', fallback=1048576)
+            self.manifest_file = config.get('Client', 'ManifestFile', fallback='manifest.db')
+            self.parallel_copy_threshold = config.getint('Client', 'ParallelCopyThreshold', fallback=268435456)
+            self.checksum = config.getboolean('Client', 'Checksum', fallback=False)
+            self.hash_cache_file = config.get('Client', 'HashCacheFile', fallback='hashcache.db')
+            self.dedup_min_size = config.getint('Client', 'DedupMinSize', fallback=1048576)
+            self.dedup_link = config.get('Client', 'DedupLink', fallback='reflink')
+            self.compression = config.get('Client', 'Compression', fallback='zstd,lz4,zlib')
+            self.fsync_mode = config.get('Client', 'FsyncMode', fallback='batch')
+            self.exclude = config.get('Client', 'Exclude', fallback='.*, *.tmp')
+            self.exclude_file = config.get('Client', 'ExcludeFile', fallback='')
+            self.subscribe = config.get('Client', 'Subscribe', fallback='')
+            self.metrics_bind = config.get('Client', 'MetricsBind', fallback='127.0.0.1')
+            self.metrics_port = config.getint('Client', 'MetricsPort', fallback=0)
+            self.metrics_file = config.get('Client', 'MetricsFile', fallback='')
+            self.metrics_interval = config.getint('Client', 'MetricsInterval', fallback=60)
         except Exception as e:
             print(f"Error loading config: {e}")
             self.set_default_config()
@@ -42,6 +59,23 @@ class Config:
         self.server_root = 'D:/source'
         self.sync_mode = 'incremental'  # 同步模式：incremental（增量）或 full（全量）
         self.max_workers = 5  # 并发工作线程数
+        self.transfer_mode = 'tcp'  # 文件传输方式：tcp（通过数据通道）或 shared（直接读取共享路径）
+        self.delta_min_size = 1048576  # 修改事件使用差异传输的最小文件大小（字节），0表示禁用
+        self.manifest_file = 'manifest.db'  # 已应用文件的清单数据库，留空表示不使用清单
+        self.parallel_copy_threshold = 268435456  # 从共享路径分块并行复制的最小文件大小（字节），0表示禁用
+        self.checksum = False  # 校验模式：增量同步时比较文件内容哈希
+        self.hash_cache_file = 'hashcache.db'  # 校验模式的哈希缓存数据库，留空表示只缓存在内存中
+        self.dedup_min_size = 1048576  # 按内容哈希在本地去重的最小文件大小（字节），0表示禁用
+        self.dedup_link = 'reflink'  # 去重方式：reflink（reflink或复制）或 hardlink（硬链接）
+        self.compression = 'zstd,lz4,zlib'  # 支持的压缩算法（按优先顺序），留空表示不压缩
+        self.fsync_mode = 'batch'  # 写入持久化方式：none、file（每个文件fsync）或 batch（每批统一提交）
+        self.exclude = '.*, *.tmp'  # gitignore格式的排除规则，逗号分隔，!开头表示重新包含
+        self.exclude_file = ''  # 每行一条排除规则的文件，留空表示不使用
+        self.subscribe = ''  # 只同步服务端目录下的这些路径前缀或glob模式，逗号分隔，留空表示全部
+        self.metrics_bind = '127.0.0.1'  # 指标HTTP端点监听的地址
+        self.metrics_port = 0  # 指标HTTP端点的端口，0表示不启用
+        self.metrics_file = ''  # 定期写入指标的JSON文件，留空表示不写入
+        self.metrics_interval = 60  # 写入JSON文件的间隔（秒）
         
         # 保存默认配置到文件
         config = configparser.ConfigParser()
@@ -51,7 +85,24 @@ class Config:
             'TargetDir': self.target_dir,
             'ServerRoot': self.server_root,
             'SyncMode': self.sync_mode,
-            'MaxWorkers': str(self.max_workers)
+            'MaxWorkers': str(self.max_workers),
+            'TransferMode': self.transfer_mode,
+            'DeltaMinSize': str(self.delta_min_size),
+            'ManifestFile': self.manifest_file,
+            'ParallelCopyThreshold': str(self.parallel_copy_threshold),
+            'Checksum': str(self.checksum).lower(),
+            'HashCacheFile': self.hash_cache_file,
+            'DedupMinSize': str(self.dedup_min_size),
+            'DedupLink': self.dedup_link,
+            'Compression': self.compression,
+            'FsyncMode': self.fsync_mode,
+            'Exclude': self.exclude,
+            'ExcludeFile': self.exclude_file,
+            'Subscribe': self.subscribe,
+            'MetricsBind': self.metrics_bind,
+            'MetricsPort': str(self.metrics_port),
+            'MetricsFile': self.metrics_file,
+            'MetricsInterval': str(self.metrics_interval)
         }
         
         with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -0,0 +1,88 @@
+import hashlib
+import math
+import struct
+import zlib
+
+# 每个块签名：4字节弱校验（Adler-32）+ 16字节强校验（BLAKE2b）
+SIGNATURE_FORMAT = '>I16s'
+SIGNATURE_SIZE = struct.calcsize(SIGNATURE_FORMAT)
+
+# 差异指令：C=复制客户端已有的块，L=字面数据，E=结束
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+OP_END = b'E'
+
+# 块大小范围
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+
+def strong_hash(data):
+    """计算块的强校验值"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def choose_block_size(file_size):
+    """根据文件大小选择块大小：约为文件大小的平方根，取2的幂"""
+    if file_size <= 0:
+        return MIN_BLOCK_SIZE
+    block_size = 1 << math.ceil(math.log2(math.sqrt(file_size)))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def compute_signatures(file_path, block_size):
+    """计算文件中每个完整块的签名，返回(块数, 签名数据)
+
+    末尾不足一块的数据不生成签名，由服务端作为字面数据发送
+    """
+    signatures = bytearray()
+    count = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+            signatures += struct.pack(SIGNATURE_FORMAT, zlib.adler32(block), strong_hash(block))
+            count += 1
+    return count, bytes(signatures)
+
+
+class DeltaPatcher:
+    def __init__(self, target_file, block_size):
+        """将差异指令原地应用到目标文件
+
+        服务端只会生成源块偏移不小于写入位置的复制指令，
+        因此按顺序原地写入不会覆盖之后仍需读取的块；
+        源块偏移与写入位置相同时数据已在原处，无需任何I/O
+        """
+        self.target_file = target_file
+        self.block_size = block_size
+        self.position = 0
+        self.copied_blocks = 0
+        self.reused_blocks = 0
+        self.literal_bytes = 0
+
+    def copy_block(self, index):
+        """复制目标文件中已有的块到当前位置"""
+        offset = index * self.block_size
+        if offset != self.position:
+            self.target_file.seek(offset)
+            block = self.target_file.read(self.block_size)
+            self.target_file.seek(self.position)
+            self.target_file.write(block)
+            self.copied_blocks += 1
+        else:
+            self.reused_blocks += 1
+        self.position += self.block_size
+
+    def write_literal(self, data):
+        """在当前位置写入字面数据"""
+        self.target_file.seek(self.position)
+        self.target_file.write(data)
+        self.position += len(data)
+        self.literal_bytes += len(data)
+
+    def finish(self):
+        """截断多余的旧数据，返回新文件大小"""
+        self.target_file.truncate(self.position)
+        return self.position
@@ -0,0 +1,176 @@
+import errno
+import os
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows下没有fcntl，不支持reflink
+    fcntl = None
+
+# ioctl(dst, FICLONE, src)：在btrfs、XFS等文件系统上共享数据块，不复制数据
+FICLONE = 0x40049409
+# 内核复制每次调用处理的字节数，同时决定进度回调的频率
+KERNEL_COPY_CHUNK = 8 * 1024 * 1024
+# 回退到普通读写时按文件大小选择缓冲区
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+# 分块并行复制时每个块的大小，以及块内每次pread/pwrite的字节数
+RANGE_SIZE = 32 * 1024 * 1024
+RANGE_BUFFER_SIZE = 4 * 1024 * 1024
+# 文件系统或内核不支持某种复制方式时的错误码，遇到后从当前位置换用下一种方式
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+IS_LINUX = sys.platform.startswith('linux')
+# Windows下没有os.pread/os.pwrite，不支持分块并行复制
+PARALLEL_COPY_SUPPORTED = hasattr(os, 'pread') and hasattr(os, 'pwrite')
+
+
+def _reflink(src_fd, dst_fd):
+    """尝试以reflink方式克隆整个文件，不支持时返回False"""
+    if fcntl is None or not IS_LINUX:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _kernel_copy(copy_chunk, offset, size, report):
+    """循环调用内核复制函数，返回(已复制到的位置, 是否完成)
+
+    遇到不支持的错误码或提前返回0时（源文件被截断，或某些虚拟文件系统不支持）返回当前位置，
+    由调用方换用其他方式继续
+    """
+    while offset < size:
+        try:
+            copied = copy_chunk(offset, min(KERNEL_COPY_CHUNK, size - offset))
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return offset, False
+            raise
+        if copied == 0:
+            return offset, False
+        offset += copied
+        report(offset)
+    return offset, True
+
+
+def copy_file_data(src_file, dst_file, progress_callback=None):
+    """将已打开的源文件内容复制到新建的目标文件，返回使用的复制方式
+
+    Linux下依次尝试reflink、copy_file_range和sendfile，由内核直接在文件之间复制数据；
+    都不可用时（如Windows）回退为按文件大小选择缓冲区的普通读写。
+    progress_callback(已复制字节数)在每个复制块完成后调用
+    """
+    src_fd = src_file.fileno()
+    dst_fd = dst_file.fileno()
+    size = os.fstat(src_fd).st_size
+    report = progress_callback or (lambda copied: None)
+
+    if size > 0 and _reflink(src_fd, dst_fd):
+        report(size)
+        return 'reflink'
+
+    offset = 0
+    if IS_LINUX and hasattr(os, 'copy_file_range'):
+        offset, finished = _kernel_copy(
+            lambda position, count: os.copy_file_range(src_fd, dst_fd, count, position, position),
+            offset, size, report)
+        if finished:
+            return 'copy_file_range'
+
+    if IS_LINUX and hasattr(os, 'sendfile'):
+        # sendfile写入目标文件的当前位置
+        dst_file.seek(offset)
+        offset, finished = _kernel_copy(
+            lambda position, count: os.sendfile(dst_fd, src_fd, position, count),
+            offset, size, report)
+        if finished:
+            return 'sendfile'
+
+    src_file.seek(offset)
+    dst_file.seek(offset)
+    buffer = bytearray(min(MAX_BUFFER_SIZE, max(MIN_BUFFER_SIZE, size // 16)))
+    view = memoryview(buffer)
+    while True:
+        count = src_file.readinto(buffer)
+        if not count:
+            break
+        dst_file.write(view[:count])
+        offset += count
+        report(offset)
+    return 'buffered'
+
+
+def _preallocate(fd, size):
+    """为目标文件预先分配空间，文件系统不支持时只设置文件大小"""
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+    os.ftruncate(fd, size)
+
+
+def _copy_range(src_fd, dst_fd, start, end, report):
+    """用pread/pwrite复制[start, end)字节，不依赖也不改变文件的当前位置，可在多个线程中同时执行"""
+    offset = start
+    while offset < end:
+        data = os.pread(src_fd, min(RANGE_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            raise OSError(errno.EIO, "Source file truncated during copy")
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(dst_fd, view, offset)
+            offset += written
+            view = view[written:]
+        report(len(data))
+
+
+def copy_file_parallel(src_path, dst_path, executor, progress_callback=None, range_size=RANGE_SIZE):
+    """将大文件按range_size拆分为多个块，在executor中并行复制到预先分配好空间的dst_path
+
+    任一块失败时抛出异常，dst_path内容不完整，由调用方删除（dst_path应为临时文件）
+    """
+    lock = threading.Lock()
+    copied = [0]
+
+    def report(count):
+        with lock:
+            copied[0] += count
+            total = copied[0]
+        if progress_callback:
+            progress_callback(total)
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _preallocate(dst_fd, size)
+            futures = [executor.submit(_copy_range, src_fd, dst_fd, start, min(start + range_size, size), report)
+                       for start in range(0, size, range_size)]
+            error = None
+            for future in futures:
+                if error is not None:
+                    future.cancel()
+                    continue
+                try:
+                    future.result()
+                except OSError as e:
+                    error = e
+            # 等待已开始的块结束后再关闭文件
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            if error is not None:
+                raise error
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
@@ -2,16 +2,69 @@ import os
 import shutil
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import queue
 
+from fast_copy import PARALLEL_COPY_SUPPORTED, copy_file_data, copy_file_parallel
+from file_transfer import BYTES_COPIED
+from metrics import REGISTRY
+from protocol import FLAG_DIR, decode_text_event
+from staged_write import StagedWriter
+from tree_walker import walk_files
+
+# 每个同步线程最多同时提交的任务数：扫描与复制同时进行，未完成的任务数量有上限
+SUBMIT_WINDOW_PER_WORKER = 4
+
+FILES_SYNCED = REGISTRY.counter('filesync_client_files_synced_total', 'Files synced by full/incremental sync',
+                                ('result',))
+SYNC_DURATION = REGISTRY.histogram('filesync_client_sync_duration_seconds', 'Duration of full/incremental sync passes',
+                                   (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200), ('mode',))
+SYNC_FILES_CHECKED = REGISTRY.gauge('filesync_client_sync_files_checked', 'Files checked by the last sync pass',
+                                    ('mode',))
+SYNC_FILES_PER_SECOND = REGISTRY.gauge('filesync_client_sync_files_per_second',
+                                       'Files synced per second in the last sync pass', ('mode',))
+
 class FileSync:
-    def __init__(self, server_root, target_dir, max_workers=5):
-        """初始化文件同步器"""
+    def __init__(self, server_root, target_dir, max_workers=5, fetcher=None, delta_min_size=0,
+                 manifest=None, parallel_copy_threshold=0, hash_cache=None, dedup_min_size=0,
+                 dedup_link='reflink', fsync_mode='batch', path_filter=None):
+        """初始化文件同步器
+        
+        fetcher为FileFetcher实例时通过TCP数据通道获取文件内容，
+        失败或未提供时回退为直接读取共享路径server_root；
+        delta_min_size大于0时，修改事件中不小于该大小的已有文件使用差异传输；
+        manifest为Manifest实例时记录已应用的文件，增量同步只与清单对比；
+        parallel_copy_threshold大于0时，从共享路径复制不小于该大小的文件时分块并行复制；
+        hash_cache为HashCache实例时启用校验模式，大小相同的文件还需比较内容哈希；
+        dedup_min_size大于0且使用清单时，不小于该大小的文件先按内容哈希在清单中查找，
+        目标目录中已有相同内容时在本地复制（dedup_link为hardlink时使用硬链接），不再传输；
+        文件内容先写入临时文件再替换目标文件，fsync_mode为持久化方式（见staged_write.StagedWriter）；
+        path_filter为PathFilter实例时，被排除的文件和目录不扫描、不同步，也不从目标目录中删除
+        """
         self.server_root = server_root
         self.target_dir = target_dir
         self.max_workers = max_workers
+        self.fetcher = fetcher
+        self.delta_min_size = delta_min_size
+        self.manifest = manifest
+        self.parallel_copy_threshold = parallel_copy_threshold if PARALLEL_COPY_SUPPORTED else 0
+        self.hash_cache = hash_cache
+        self.dedup_min_size = dedup_min_size if manifest is not None else 0
+        self.dedup_link = dedup_link
+        self.writer = StagedWriter(fsync_mode)
+        self.path_filter = path_filter or None
+        self.stats_lock = threading.Lock()
+        # 大文件分块复制使用的线程池，首次需要时创建
+        self.range_executor = None
+        self.range_executor_lock = threading.Lock()
+        if manifest is not None:
+            manifest.bind(os.path.normpath(server_root), os.path.normpath(target_dir))
+        
+        # 后台重新同步状态：运行中收到的新请求合并为一次后续同步
+        self.resync_lock = threading.Lock()
+        self.resync_running = False
+        self.resync_requested = False
         
         # 同步统计信息
         self.sync_stats = {
@@ -19,6 +72,8 @@ class FileSync:
             'synced_files': 0,
             'failed_files': 0,
             'skipped_files': 0,
+            'deduplicated_files': 0,
+            'deduplicated_bytes': 0,
             'start_time': None,
             'end_time': None
         }
@@ -26,17 +81,9 @@ class FileSync:
         # 确保目标目录存在
         os.makedirs(self.target_dir, exist_ok=True)
     
-    def _get_all_files(self, directory):
-        """高效获取目录下的所有文件列表"""
-        file_list = []
-        try:
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    file_list.append(file_path)
-        except Exception as e:
-            print(f"Error scanning directory {directory}: {e}")
-        return file_list
+    def _iter_files(self, directory):
+        """多线程扫描目录，逐个返回(文件路径, stat结果)，不在内存中保存完整的文件列表"""
+        return walk_files(directory, self.max_workers, self.path_filter)
     
     def _sync_file_worker(self, file_path, operation="create"):
         """单个文件同步的工作函数"""
@@ -53,12 +100,51 @@ class FileSync:
         except Exception as e:
             return (file_path, False, str(e))
     
-    def _update_progress(self, current, total, operation="Syncing"):
-        """更新进度显示"""
-        if total > 0:
+    def _update_progress(self, current, total, operation="Syncing", scanning=False):
+        """更新进度显示，扫描尚未结束时总数还在增长，不显示百分比"""
+        if scanning:
+            print(f"\r{operation}: {current}/{total} (scanning...)", end="", flush=True)
+        elif total > 0:
             percentage = (current / total) * 100
             print(f"\r{operation}: {current}/{total} ({percentage:.1f}%)", end="", flush=True)
     
+    def _sync_files(self, file_paths, operation, label):
+        """用线程池同步文件，file_paths可以是生成器
+        
+        同时提交的任务不超过SUBMIT_WINDOW_PER_WORKER * max_workers个，窗口已满时等待任务完成
+        后再从生成器取下一个文件，因此扫描和复制同时进行且内存占用不随文件数量增长
+        """
+        window = max(1, self.max_workers * SUBMIT_WINDOW_PER_WORKER)
+        submitted = 0
+        completed = 0
+        
+        def collect(done, scanning):
+            nonlocal completed
+            for future in done:
+                file_path, success, error = future.result()
+                completed += 1
+                FILES_SYNCED.inc(result='synced' if success else 'failed')
+                if success:
+                    self.sync_stats['synced_files'] += 1
+                else:
+                    self.sync_stats['failed_files'] += 1
+                    print(f"\nFailed to sync {file_path}: {error}")
+                self._update_progress(completed, submitted, label, scanning)
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set()
+            for file_path in file_paths:
+                if len(pending) >= window:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done, True)
+                pending.add(executor.submit(self._sync_file_worker, file_path, operation))
+                submitted += 1
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done, False)
+        self.writer.commit()
+        return submitted
+    
     def full_sync(self):
         """执行全量同步：将服务端监控目录的所有文件同步到客户端目标目录"""
         print(f"Starting full sync from {self.server_root} to {self.target_dir}")
@@ -69,45 +155,26 @@ class FileSync:
             'synced_files': 0,
             'failed_files': 0,
             'skipped_files': 0,
+            'deduplicated_files': 0,
+            'deduplicated_bytes': 0,
             'start_time': time.time(),
             'end_time': None
         }
         
         try:
-            # 获取所有文件列表
-            print("Scanning files...")
-            all_files = self._get_all_files(self.server_root)
-            self.sync_stats['total_files'] = len(all_files)
+            # 边扫描边同步
+            print("Scanning and syncing files...")
             
-            if not all_files:
-                print("No files found to sync")
-                return True
+            def scanned_files():
+                for file_path, _file_stat in self._iter_files(self.server_root):
+                    self.sync_stats['total_files'] += 1
+                    yield file_path
             
-            print(f"Found {len(all_files)} files to sync")
-            print("Starting concurrent sync...")
+            self._sync_files(scanned_files(), "create", "Full sync")
             
-            # 使用线程池进行并发同步
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                # 提交所有同步任务
-                future_to_file = {
-                    executor.submit(self._sync_file_worker, file_path, "create"): file_path 
-                    for file_path in all_files
-                }
-                
-                # 处理完成的任务
-                completed = 0
-                for future in as_completed(future_to_file):
-                    file_path, success, error = future.result()
-                    completed += 1
-                    
-                    if success:
-                        self.sync_stats['synced_files'] += 1
-                    else:
-                        self.sync_stats['failed_files'] += 1
-                        print(f"\nFailed to sync {file_path}: {error}")
-                    
-                    # 更新进度
-                    self._update_progress(completed, len(all_files), "Full sync")
+            if not self.sync_stats['total_files']:
+                print("No files found to sync")
+                return True
             
             # 完成进度显示
             print()
@@ -118,21 +185,28 @@ class FileSync:
             print(f"Full sync completed in {duration:.2f} seconds")
             print(f"Results: {self.sync_stats['synced_files']} synced, "
                   f"{self.sync_stats['failed_files']} failed")
+            self._print_dedup_summary()
             
             return self.sync_stats['failed_files'] == 0
         except Exception as e:
             print(f"\nFailed to perform full sync: {e}")
             return False
+        finally:
+            self._record_sync_metrics('full')
     
-    def _need_sync(self, server_path, target_path):
-        """检查文件是否需要同步"""
+    def _need_sync(self, server_path, target_path, server_stat=None):
+        """检查文件是否需要同步，server_stat为扫描时已获取的服务端文件状态"""
         try:
             # 如果目标文件不存在，需要同步
             if not os.path.exists(target_path):
                 return True
             
             # 比较文件的修改时间和大小
-            server_stat = os.stat(server_path)
+            if server_stat is None:
+                server_stat = os.stat(server_path)
+            if self.hash_cache is not None:
+                return not self._content_matches(server_path, target_path,
+                                                 server_stat.st_size, server_stat.st_mtime_ns)
             target_stat = os.stat(target_path)
             
             # 如果修改时间或大小不同，需要同步
@@ -145,6 +219,199 @@ class FileSync:
             print(f"Error checking sync need for {server_path}: {e}")
             return True
     
+    def _diff_against_manifest(self):
+        """按目录对比服务端目录与清单，返回需要同步的服务端文件路径列表
+
+        只对服务端文件执行一次stat；清单中没有记录的文件按原方式与目标文件比较，
+        已一致的文件直接补录到清单。清单中存在而服务端已删除的文件在这里同步删除
+        """
+        files_to_sync = []
+        deleted = []
+        visited = set()
+        # 无法读取或被排除的目录，不对其中的文件做删除判断
+        skipped = []
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            visited.add(relative_dir)
+            source_dir = os.path.join(self.server_root, relative_dir) if relative_dir else self.server_root
+            try:
+                with os.scandir(source_dir) as it:
+                    entries = list(it)
+            except OSError as e:
+                # 无法读取的目录不做删除判断
+                print(f"Error scanning directory {source_dir}: {e}")
+                skipped.append(relative_dir)
+                continue
+            
+            known = self.manifest.list_dir(relative_dir)
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                try:
+                    if entry.is_dir():
+                        if entry.is_symlink():
+                            continue
+                        if self._is_excluded(relative_path, True):
+                            visited.add(relative_path)
+                            skipped.append(relative_path)
+                        else:
+                            stack.append(relative_path)
+                        continue
+                    if self._is_excluded(relative_path):
+                        known.pop(entry.name, None)
+                        continue
+                    stat = entry.stat()
+                except OSError as e:
+                    print(f"Error checking sync need for {entry.path}: {e}")
+                    known.pop(entry.name, None)
+                    files_to_sync.append(entry.path)
+                    continue
+                
+                self.sync_stats['total_files'] += 1
+                record = known.pop(entry.name, None)
+                if record == (stat.st_size, stat.st_mtime_ns) and (
+                        self.hash_cache is None or
+                        self._content_matches(entry.path, self.get_target_path(entry.path),
+                                              stat.st_size, stat.st_mtime_ns)):
+                    self.sync_stats['skipped_files'] += 1
+                elif record is None and not self._need_sync(entry.path, self.get_target_path(entry.path)):
+                    # 首次使用清单时目标文件已是最新，补录记录
+                    self._record_applied(self.get_target_path(entry.path))
+                    self.sync_stats['skipped_files'] += 1
+                else:
+                    files_to_sync.append(entry.path)
+            deleted.extend(f"{relative_dir}/{name}" if relative_dir else name for name in known)
+        
+        # 清单中有记录但服务端已不存在的目录
+        for parent in self.manifest.list_parents():
+            if parent in visited or any(parent.startswith(d + '/') or not d for d in skipped):
+                continue
+            deleted.extend(f"{parent}/{name}" if parent else name for name in self.manifest.list_dir(parent))
+        
+        print(f"Found {self.sync_stats['total_files']} files, {len(deleted)} deleted since last run")
+        self._delete_missing(deleted, visited)
+        return files_to_sync
+    
+    def _delete_missing(self, deleted, existing_dirs):
+        """删除服务端已不存在的文件（相对路径），existing_dirs之外的上级目录清空后一并删除"""
+        for relative_path in deleted:
+            self.sync_delete(os.path.join(self.server_root, relative_path))
+            parent = os.path.dirname(relative_path)
+            while parent and parent not in existing_dirs:
+                try:
+                    os.rmdir(os.path.join(self.target_dir, parent))
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+    
+    def _server_hash(self, server_path, size, mtime_ns):
+        """服务端文件的内容哈希：优先由服务端计算，文件已不是给定的大小和修改时间时返回None"""
+        if self._use_tcp_transfer():
+            result = self.fetcher.fetch_hash(server_path)
+            if result is not None:
+                return result[2] if result[:2] == (size, mtime_ns) else None
+        try:
+            server_stat = os.stat(server_path)
+        except OSError:
+            return None
+        if (server_stat.st_size, server_stat.st_mtime_ns) != (size, mtime_ns):
+            return None
+        return self.hash_cache.get_hash(server_path, server_stat)
+    
+    def _content_matches(self, server_path, target_path, size, mtime_ns):
+        """校验模式：目标文件与服务端文件大小相同且内容哈希一致
+        
+        只有修改时间不同（文件系统时间精度不同或复制时间戳失败）时修正目标文件的修改时间，不重新复制
+        """
+        try:
+            target_stat = os.stat(target_path)
+        except OSError:
+            return False
+        if target_stat.st_size != size:
+            return False
+        
+        target_hash = self.hash_cache.get_hash(target_path, target_stat)
+        if target_hash is None or target_hash != self._server_hash(server_path, size, mtime_ns):
+            return False
+        
+        if target_stat.st_mtime_ns != mtime_ns:
+            try:
+                os.utime(target_path, ns=(mtime_ns, mtime_ns))
+                self.hash_cache.put(os.stat(target_path), target_hash)
+                self._record_applied(target_path)
+            except OSError as e:
+                print(f"Failed to update modification time of {target_path}: {e}")
+        return True
+    
+    def _target_matches(self, target_path, size, mtime_ns):
+        """目标文件的大小和修改时间是否与给定值一致"""
+        try:
+            stat = os.stat(target_path)
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+    
+    def _diff_against_server_tree(self):
+        """通过TREE请求与服务端Merkle树对比，只进入摘要不同的目录
+
+        返回需要同步的服务端文件路径列表，服务端不支持时返回None。
+        请求次数与发生变化的目录数量成正比，不扫描服务端共享路径和目标目录
+        """
+        local_digests, local_children = self.manifest.directory_digests()
+        listing = self.fetcher.list_tree('')
+        if listing is None:
+            return None
+        if listing[0] == local_digests.get(''):
+            print("Directory digests match server, nothing changed")
+            return []
+        
+        files_to_sync = []
+        deleted = []
+        checked_dirs = set()
+        pending = [('', listing)]
+        while pending:
+            relative_dir, (_digest, files, subdirs) = pending.pop()
+            checked_dirs.add(relative_dir)
+            
+            known = self.manifest.list_dir(relative_dir)
+            for name, size, mtime_ns in files:
+                relative_path = f"{relative_dir}/{name}" if relative_dir else name
+                if self._is_excluded(relative_path):
+                    known.pop(name, None)
+                    continue
+                server_path = os.path.join(self.server_root, relative_path)
+                self.sync_stats['total_files'] += 1
+                record = known.pop(name, None)
+                if record == (size, mtime_ns):
+                    self.sync_stats['skipped_files'] += 1
+                elif record is None and self._target_matches(self.get_target_path(server_path), size, mtime_ns):
+                    # 首次使用清单时目标文件已是最新，补录记录
+                    self._record_applied(self.get_target_path(server_path))
+                    self.sync_stats['skipped_files'] += 1
+                else:
+                    files_to_sync.append(server_path)
+            deleted.extend(f"{relative_dir}/{name}" if relative_dir else name for name in known)
+            
+            remote_subdirs = set()
+            for name, subdir_digest in subdirs:
+                remote_subdirs.add(name)
+                relative_subdir = f"{relative_dir}/{name}" if relative_dir else name
+                if local_digests.get(relative_subdir) == subdir_digest or self._is_excluded(relative_subdir, True):
+                    continue
+                subdir_listing = self.fetcher.list_tree(relative_subdir)
+                if subdir_listing is None:
+                    return None
+                pending.append((relative_subdir, subdir_listing))
+            
+            # 服务端已不存在的子目录
+            for name in local_children.get(relative_dir, set()) - remote_subdirs:
+                deleted.extend(self.manifest.list_subtree(f"{relative_dir}/{name}" if relative_dir else name))
+        
+        print(f"Compared {len(checked_dirs)} changed directories with server, "
+              f"{len(deleted)} files deleted since last sync")
+        self._delete_missing(deleted, checked_dirs)
+        return files_to_sync
+    
     def compare_and_sync_diff(self):
         """执行差异对比和增量同步：只同步服务端和客户端有差异的文件"""
         print(f"Starting incremental sync (diff compare) from {self.server_root} to {self.target_dir}")
@@ -155,61 +422,55 @@ class FileSync:
             'synced_files': 0,
             'failed_files': 0,
             'skipped_files': 0,
+            'deduplicated_files': 0,
+            'deduplicated_bytes': 0,
             'start_time': time.time(),
             'end_time': None
         }
         
         try:
-            # 获取所有文件列表
-            print("Scanning files for differences...")
-            all_files = self._get_all_files(self.server_root)
-            self.sync_stats['total_files'] = len(all_files)
-            
-            if not all_files:
-                print("No files found to sync")
-                return True
-            
-            print(f"Found {len(all_files)} files to check")
-            
-            # 筛选需要同步的文件
-            files_to_sync = []
-            for file_path in all_files:
-                target_path = self.get_target_path(file_path)
-                if self._need_sync(file_path, target_path):
-                    files_to_sync.append(file_path)
-                else:
-                    self.sync_stats['skipped_files'] += 1
-            
-            print(f"{len(files_to_sync)} files need synchronization")
-            
-            if not files_to_sync:
-                print("All files are up to date")
-                return True
+            files_to_sync = None
+            # 校验模式需要检查每个文件的内容，不跳过摘要一致的子树
+            if self.manifest is not None and self._use_tcp_transfer() and self.hash_cache is None:
+                # 与服务端Merkle树对比，只检查发生变化的目录
+                print("Comparing directory digests with server...")
+                files_to_sync = self._diff_against_server_tree()
+                if files_to_sync is None:
+                    self.sync_stats['total_files'] = self.sync_stats['skipped_files'] = 0
             
-            print("Starting incremental sync...")
+            if files_to_sync is None and self.manifest is not None:
+                # 与清单对比，不扫描目标目录
+                print("Scanning files for differences (using manifest)...")
+                files_to_sync = self._diff_against_manifest()
+                if not self.sync_stats['total_files']:
+                    print("No files found to sync")
+                    return True
             
-            # 使用线程池进行并发同步
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                # 提交所有同步任务
-                future_to_file = {
-                    executor.submit(self._sync_file_worker, file_path, "modify"): file_path 
-                    for file_path in files_to_sync
-                }
+            if files_to_sync is not None:
+                print(f"{len(files_to_sync)} files need synchronization")
+                if not files_to_sync:
+                    print("All files are up to date")
+                    return True
+                print("Starting incremental sync...")
+                self._sync_files(files_to_sync, "modify", "Incremental sync")
+            else:
+                # 没有清单时边扫描边对比，需要同步的文件立即提交
+                print("Scanning files for differences...")
+                
+                def changed_files():
+                    for file_path, server_stat in self._iter_files(self.server_root):
+                        self.sync_stats['total_files'] += 1
+                        if self._need_sync(file_path, self.get_target_path(file_path), server_stat):
+                            yield file_path
+                        else:
+                            self.sync_stats['skipped_files'] += 1
                 
-                # 处理完成的任务
-                completed = 0
-                for future in as_completed(future_to_file):
-                    file_path, success, error = future.result()
-                    completed += 1
-                    
-                    if success:
-                        self.sync_stats['synced_files'] += 1
+                if not self._sync_files(changed_files(), "modify", "Incremental sync"):
+                    if not self.sync_stats['total_files']:
+                        print("No files found to sync")
                     else:
-                        self.sync_stats['failed_files'] += 1
-                        print(f"\nFailed to sync {file_path}: {error}")
-                    
-                    # 更新进度
-                    self._update_progress(completed, len(files_to_sync), "Incremental sync")
+                        print("All files are up to date")
+                    return True
             
             # 完成进度显示
             print()
@@ -221,11 +482,21 @@ class FileSync:
             print(f"Results: {self.sync_stats['synced_files']} synced, "
                   f"{self.sync_stats['failed_files']} failed, "
                   f"{self.sync_stats['skipped_files']} skipped")
+            self._print_dedup_summary()
             
             return self.sync_stats['failed_files'] == 0
         except Exception as e:
             print(f"\nFailed to perform incremental sync: {e}")
             return False
+        finally:
+            self._record_sync_metrics('incremental')
+    
+    def _record_sync_metrics(self, mode):
+        """记录本次同步的耗时、检查的文件数和同步速度"""
+        duration = time.time() - self.sync_stats['start_time']
+        SYNC_DURATION.observe(duration, mode=mode)
+        SYNC_FILES_CHECKED.set(self.sync_stats['total_files'], mode=mode)
+        SYNC_FILES_PER_SECOND.set(self.sync_stats['synced_files'] / duration if duration > 0 else 0, mode=mode)
     
     def get_target_path(self, server_path):
         """根据服务端路径计算客户端目标路径，处理特殊字符"""
@@ -256,6 +527,10 @@ class FileSync:
             # 如果计算失败，使用基本方法
             return os.path.join(self.target_dir, os.path.basename(server_path))
     
+    def _is_excluded(self, relative_path, is_dir=False):
+        """相对路径（/分隔）是否被排除规则排除，扫描时上级目录已经检查过"""
+        return self.path_filter is not None and self.path_filter.match(relative_path, is_dir)
+    
     def _should_skip_file(self, file_path):
         """检查是否需要跳过此文件（权限问题等）"""
         try:
@@ -283,8 +558,8 @@ class FileSync:
             # 如果检查过程中出现任何异常，跳过此文件
             return True
 
-    def _copy_file_with_progress(self, src, dst, buffer_size=8192):
-        """带进度显示的文件复制，避免大文件内存问题"""
+    def _copy_file_with_progress(self, src, dst):
+        """带进度显示的文件复制，Linux下由内核直接复制数据（reflink/copy_file_range/sendfile）"""
         try:
             # 检查源文件是否存在
             if not os.path.exists(src):
@@ -306,37 +581,45 @@ class FileSync:
                 return False
             
             file_size = os.path.getsize(src)
-            copied = 0
+            file_name = os.path.basename(src)
+            last_percentage = [-1]
             
-            # 尝试以不同方式打开文件，处理权限问题
+            def show_progress(copied):
+                # 大于1MB的文件显示进度，百分比变化时才刷新
+                if file_size <= 1024 * 1024:
+                    return
+                percentage = int(copied * 100 / file_size) if file_size else 100
+                if percentage != last_percentage[0]:
+                    last_percentage[0] = percentage
+                    print(f"\rCopying {file_name}: {copied/1024/1024:.1f}MB/{file_size/1024/1024:.1f}MB ({percentage}%)",
+                          end="", flush=True)
+            
+            # 写入临时文件，复制完成并恢复时间戳后再替换目标文件，处理权限问题
+            temp_path = self.writer.stage(dst)
             try:
-                with open(src, 'rb') as src_file:
-                    with open(dst, 'wb') as dst_file:
-                        while True:
-                            buffer = src_file.read(buffer_size)
-                            if not buffer:
-                                break
-                            dst_file.write(buffer)
-                            copied += len(buffer)
-                            
-                            # 显示大文件复制进度
-                            if file_size > 1024 * 1024:  # 大于1MB的文件显示进度
-                                percentage = (copied / file_size) * 100
-                                print(f"\rCopying {os.path.basename(src)}: {copied/1024/1024:.1f}MB/{file_size/1024/1024:.1f}MB ({percentage:.1f}%)", 
-                                      end="", flush=True)
+                if self.parallel_copy_threshold and file_size >= self.parallel_copy_threshold:
+                    # 大文件拆分为多个块并行复制，充分利用高延迟共享路径和条带化存储的带宽
+                    copy_file_parallel(src, temp_path, self._get_range_executor(), show_progress)
+                else:
+                    with open(src, 'rb') as src_file:
+                        with open(temp_path, 'wb') as dst_file:
+                            copy_file_data(src_file, dst_file, show_progress)
+                
+                try:
+                    shutil.copystat(src, temp_path)
+                except Exception:
+                    # 时间戳复制失败不影响主要功能
+                    pass
+                self.writer.publish(temp_path, dst)
+                BYTES_COPIED.inc(file_size, method='shared')
             except PermissionError as pe:
                 print(f"\nPermission denied when copying {src}: {pe}")
                 return False
             except OSError as oe:
                 print(f"\nOS error when copying {src}: {oe}")
                 return False
-            
-            # 复制完成后恢复文件时间戳
-            try:
-                shutil.copystat(src, dst)
-            except Exception:
-                # 时间戳复制失败不影响主要功能
-                pass
+            finally:
+                self.writer.discard(temp_path)
             
             if file_size > 1024 * 1024:
                 print()  # 换行
@@ -346,28 +629,169 @@ class FileSync:
             print(f"\nError copying file {src}: {e}")
             return False
     
+    def _get_range_executor(self):
+        """返回分块复制线程池：与同步线程池分开，避免等待块完成的同步线程占满线程池"""
+        with self.range_executor_lock:
+            if self.range_executor is None:
+                self.range_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.range_executor
+    
+    def _relative_target_path(self, target_path):
+        """目标路径相对于目标目录的路径（使用/分隔），用作清单的键"""
+        return os.path.relpath(target_path, self.target_dir).replace(os.sep, '/')
+    
+    def _record_applied(self, target_path, file_hash=None):
+        """将已应用的文件状态写入清单，file_hash为已知的内容哈希"""
+        if self.manifest is None:
+            return
+        try:
+            stat = os.stat(target_path)
+            self.manifest.update(self._relative_target_path(target_path), stat.st_size, stat.st_mtime_ns,
+                                 stat.st_ino, file_hash)
+        except OSError as e:
+            print(f"Failed to update manifest for {target_path}: {e}")
+    
+    def _use_tcp_transfer(self):
+        """是否通过TCP数据通道获取文件内容"""
+        return self.fetcher is not None and self.fetcher.available
+    
+    def _transfer_file(self, server_path, target_path, content=None):
+        """获取文件内容：优先使用TCP数据通道，失败时回退到共享路径复制
+        
+        content为字典时填入服务端告知的内容哈希(hash)，从本地去重时还填入来源文件(source)
+        """
+        if content is None:
+            content = {}
+        if self._use_tcp_transfer():
+            file_name = os.path.basename(server_path)
+            
+            def show_progress(copied):
+                # 大于1MB的文件显示进度
+                if copied > 1024 * 1024:
+                    print(f"\rFetching {file_name}: {copied/1024/1024:.1f}MB", end="", flush=True)
+            
+            # 获取到临时文件，完整接收后再替换目标文件
+            temp_path = self.writer.stage(target_path)
+            dedup_callback = None
+            if self.dedup_min_size > 0:
+                def dedup_callback(size, mtime_ns, file_hash):
+                    content['hash'] = file_hash
+                    content['source'] = self._place_from_store(target_path, temp_path, size, mtime_ns, file_hash)
+                    return content['source'] is not None
+            
+            try:
+                if self.fetcher.fetch(server_path, temp_path, show_progress, self.dedup_min_size, dedup_callback):
+                    self.writer.publish(temp_path, target_path)
+                    return True
+            finally:
+                self.writer.discard(temp_path)
+            content.clear()
+        
+        return self._copy_file_with_progress(server_path, target_path)
+    
+    def _place_from_store(self, target_path, temp_path, size, mtime_ns, file_hash):
+        """在清单中查找内容哈希相同的已同步文件，复制到目标文件的临时文件，返回来源文件路径，没有可用文件时返回None"""
+        relative_target = self._relative_target_path(target_path)
+        for relative_path, record_size, record_mtime_ns in self.manifest.find_by_hash(file_hash):
+            if relative_path == relative_target or record_size != size:
+                continue
+            source_path = os.path.join(self.target_dir, *relative_path.split('/'))
+            # 来源文件在本地被修改过时内容已不可信
+            if not self._target_matches(source_path, record_size, record_mtime_ns):
+                continue
+            try:
+                self._link_or_copy(source_path, temp_path, mtime_ns)
+            except OSError as e:
+                print(f"Failed to deduplicate {target_path} from {source_path}: {e}")
+                continue
+            with self.stats_lock:
+                self.sync_stats['deduplicated_files'] += 1
+                self.sync_stats['deduplicated_bytes'] += size
+            BYTES_COPIED.inc(size, method='dedup')
+            return source_path
+        return None
+    
+    def _link_or_copy(self, source_path, temp_path, mtime_ns):
+        """在本地用已有文件生成临时文件，不修改来源文件
+        
+        hardlink模式下修改时间相同时使用硬链接，否则复制（支持时为reflink）并设置修改时间
+        """
+        # 上一个来源文件失败时可能留下了不完整的内容
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        if self.dedup_link == 'hardlink' and os.stat(source_path).st_mtime_ns == mtime_ns:
+            os.link(source_path, temp_path)
+        else:
+            with open(source_path, 'rb') as src_file:
+                with open(temp_path, 'wb') as dst_file:
+                    copy_file_data(src_file, dst_file)
+            os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+    
+    def _break_hardlink(self, target_path):
+        """目标文件与其他文件共享inode（去重产生的硬链接）时，复制为独立的文件后替换，避免原地打补丁时同时修改其他文件
+
+        整个文件替换的写入总是生成新的inode，不需要处理；复制失败时返回False
+        """
+        try:
+            if os.stat(target_path).st_nlink <= 1:
+                return True
+        except OSError:
+            return True
+        temp_path = self.writer.stage(target_path)
+        try:
+            with open(target_path, 'rb') as src_file:
+                with open(temp_path, 'wb') as dst_file:
+                    copy_file_data(src_file, dst_file)
+            shutil.copystat(target_path, temp_path)
+            self.writer.publish(temp_path, target_path)
+            return True
+        except OSError as e:
+            print(f"Failed to break hard link of {target_path}: {e}")
+            return False
+        finally:
+            self.writer.discard(temp_path)
+    
+    def _transfer_delta(self, server_path, target_path, content=None):
+        """对已存在的大文件尝试差异传输，不满足条件或失败时完整获取"""
+        try:
+            use_delta = (self.delta_min_size > 0 and self._use_tcp_transfer()
+                         and os.path.getsize(target_path) >= self.delta_min_size)
+        except OSError:
+            use_delta = False
+        
+        if use_delta and self._break_hardlink(target_path) and self.fetcher.fetch_delta(server_path, target_path):
+            # 差异传输原地打补丁，修改时间在完成后才更新，中断时下次对比会重新同步
+            self.writer.record(target_path)
+            return True
+        
+        return self._transfer_file(server_path, target_path, content)
+    
     def sync_create(self, server_path):
         """同步文件创建事件"""
         target_path = self.get_target_path(server_path)
         
         try:
-            # 检查是否需要跳过此文件
-            if self._should_skip_file(server_path):
-                print(f"Skipped file (permission/access issue): {server_path}")
-                return True  # 返回True表示已处理，但实际跳过
+            # 共享路径模式下检查源文件是否可访问
+            if not self._use_tcp_transfer():
+                # 检查是否需要跳过此文件
+                if self._should_skip_file(server_path):
+                    print(f"Skipped file (permission/access issue): {server_path}")
+                    return True  # 返回True表示已处理，但实际跳过
+                
+                # 检查源文件是否存在
+                if not os.path.exists(server_path):
+                    print(f"Source file not found: {server_path}")
+                    return False
             
             # 确保目标目录存在
             target_dir = os.path.dirname(target_path)
             os.makedirs(target_dir, exist_ok=True)
             
-            # 检查源文件是否存在
-            if not os.path.exists(server_path):
-                print(f"Source file not found: {server_path}")
-                return False
-            
-            # 使用优化的文件复制方法
-            if self._copy_file_with_progress(server_path, target_path):
-                print(f"Created: {target_path}")
+            # 获取文件内容
+            content = {}
+            if self._transfer_file(server_path, target_path, content):
+                self._record_applied(target_path, content.get('hash'))
+                self._print_applied("Created", target_path, content)
                 return True
             else:
                 return False
@@ -380,23 +804,27 @@ class FileSync:
         target_path = self.get_target_path(server_path)
         
         try:
-            # 检查是否需要跳过此文件
-            if self._should_skip_file(server_path):
-                print(f"Skipped file (permission/access issue): {server_path}")
-                return True  # 返回True表示已处理，但实际跳过
-            
-            # 检查源文件是否存在
-            if not os.path.exists(server_path):
-                print(f"Source file not found: {server_path}")
-                return False
+            # 共享路径模式下检查源文件是否可访问
+            if not self._use_tcp_transfer():
+                # 检查是否需要跳过此文件
+                if self._should_skip_file(server_path):
+                    print(f"Skipped file (permission/access issue): {server_path}")
+                    return True  # 返回True表示已处理，但实际跳过
+                
+                # 检查源文件是否存在
+                if not os.path.exists(server_path):
+                    print(f"Source file not found: {server_path}")
+                    return False
             
             # 确保目标目录存在
             target_dir = os.path.dirname(target_path)
             os.makedirs(target_dir, exist_ok=True)
             
-            # 使用优化的文件复制方法
-            if self._copy_file_with_progress(server_path, target_path):
-                print(f"Modified: {target_path}")
+            # 获取文件内容，已有的大文件只传输变化部分
+            content = {}
+            if self._transfer_delta(server_path, target_path, content):
+                self._record_applied(target_path, content.get('hash'))
+                self._print_applied("Modified", target_path, content)
                 return True
             else:
                 return False
@@ -404,11 +832,27 @@ class FileSync:
             print(f"Failed to modify {target_path}: {e}")
             return False
     
+    def _print_applied(self, action, target_path, content):
+        """显示已应用的文件，注明从本地去重的来源"""
+        if content.get('source'):
+            print(f"{action}: {target_path} (deduplicated from {content['source']})")
+        else:
+            print(f"{action}: {target_path}")
+    
+    def _print_dedup_summary(self):
+        """显示本次同步去重节省的传输量"""
+        if self.sync_stats['deduplicated_files']:
+            print(f"Deduplicated: {self.sync_stats['deduplicated_files']} files, "
+                  f"{self.sync_stats['deduplicated_bytes']/1024/1024:.1f}MB not transferred")
+    
     def sync_delete(self, server_path):
-        """同步文件删除事件"""
+        """同步文件删除事件，路径为目录时删除整个目录"""
         target_path = self.get_target_path(server_path)
         
         try:
+            if self.manifest is not None:
+                self.manifest.remove(self._relative_target_path(target_path))
+            
             # 检查目标文件是否存在
             if not os.path.exists(target_path):
                 return True  # 文件已不存在，无需处理
@@ -420,20 +864,26 @@ class FileSync:
             elif os.path.isdir(target_path):
                 shutil.rmtree(target_path)
                 print(f"Deleted directory: {target_path}")
+            self.writer.record(target_path, is_file=False)
             
             return True
         except Exception as e:
             print(f"Failed to delete {target_path}: {e}")
             return False
     
-    def sync_rename(self, old_server_path, new_server_path):
-        """同步文件重命名事件"""
+    def sync_rename(self, old_server_path, new_server_path, is_dir=False):
+        """同步文件重命名事件，is_dir为True时重命名整个目录（文本协议没有目录标志，按本地路径判断）"""
         old_target_path = self.get_target_path(old_server_path)
         new_target_path = self.get_target_path(new_server_path)
+        is_dir = is_dir or os.path.isdir(old_target_path)
         
         try:
             # 检查目标文件是否存在
             if not os.path.exists(old_target_path):
+                if is_dir:
+                    # 本地没有原目录，通过差异对比同步新目录
+                    self.request_resync()
+                    return True
                 # 如果旧文件不存在，可能是重命名前的文件创建事件还未同步，
                 # 直接创建新文件
                 return self.sync_create(new_server_path)
@@ -444,7 +894,12 @@ class FileSync:
             
             # 重命名文件
             os.rename(old_target_path, new_target_path)
-            print(f"Renamed: {old_target_path} -> {new_target_path}")
+            self.writer.record(old_target_path, is_file=False)
+            self.writer.record(new_target_path, is_file=False)
+            if self.manifest is not None:
+                self.manifest.rename(self._relative_target_path(old_target_path),
+                                     self._relative_target_path(new_target_path))
+            print(f"Renamed{' directory' if is_dir else ''}: {old_target_path} -> {new_target_path}")
             return True
         except Exception as e:
             print(f"Failed to rename {old_target_path} to {new_target_path}: {e}")
@@ -452,59 +907,99 @@ class FileSync:
             # 重命名失败，尝试删除旧文件并创建新文件
             try:
                 self.sync_delete(old_server_path)
+                if is_dir:
+                    self.request_resync()
+                    return True
                 return self.sync_create(new_server_path)
             except Exception as fallback_e:
                 print(f"Fallback failed: {fallback_e}")
                 return False
     
-    def _decode_file_path(self, encoded_path):
-        """解码文件路径，处理特殊字符"""
-        try:
-            # 如果路径包含URL编码的字符，进行解码
-            import urllib.parse
-            decoded_path = urllib.parse.unquote(encoded_path)
-            
-            # 确保路径使用正确的路径分隔符
-            if os.sep == '\\':  # Windows系统
-                decoded_path = decoded_path.replace('/', '\\')
-            else:  # Unix系统
-                decoded_path = decoded_path.replace('\\', '/')
-            
-            return decoded_path
-        except Exception as e:
-            print(f"Error decoding path {encoded_path}: {e}")
-            return encoded_path
+    def request_resync(self):
+        """请求在后台执行一次差异对比同步（服务端丢弃了发给本客户端的事件或断线重连后）"""
+        with self.resync_lock:
+            if self.resync_running:
+                self.resync_requested = True
+                return
+            self.resync_running = True
+        
+        resync_thread = threading.Thread(target=self._resync_loop)
+        resync_thread.daemon = True
+        resync_thread.start()
     
-    def _encode_file_path(self, file_path):
-        """编码文件路径，处理特殊字符"""
-        try:
-            # 对路径进行URL编码，处理特殊字符
-            import urllib.parse
-            encoded_path = urllib.parse.quote(file_path, safe='')
-            return encoded_path
-        except Exception as e:
-            print(f"Error encoding path {file_path}: {e}")
-            return file_path
+    def _resync_loop(self):
+        """执行重新同步，期间再次收到请求时重复执行"""
+        while True:
+            print("\nResyncing with server, comparing directories...")
+            self.compare_and_sync_diff()
+            # 被丢弃的事件中可能有删除和重命名，清理服务端已不存在的文件（使用清单时对比过程中已处理）
+            if self.manifest is None:
+                self._remove_extra_files()
+            with self.resync_lock:
+                if not self.resync_requested:
+                    self.resync_running = False
+                    return
+                self.resync_requested = False
+    
+    def _remove_extra_files(self):
+        """删除目标目录中服务端已不存在的文件"""
+        removed = 0
+        for target_path, _target_stat in self._iter_files(self.target_dir):
+            relative_path = os.path.relpath(target_path, self.target_dir)
+            if os.path.exists(os.path.join(self.server_root, relative_path)) or self.writer.is_staging(target_path):
+                continue
+            try:
+                os.remove(target_path)
+                removed += 1
+            except Exception as e:
+                print(f"Failed to delete {target_path}: {e}")
+        if removed:
+            print(f"Removed {removed} files no longer present on server")
+    
+    def _normalize_path(self, file_path):
+        """确保路径使用本机的路径分隔符"""
+        if os.sep == '\\':  # Windows系统
+            return file_path.replace('/', '\\')
+        return file_path.replace('\\', '/')
     
     def handle_message(self, message):
-        """处理来自服务端的消息"""
+        """处理来自服务端的文本协议消息"""
+        event = decode_text_event(message)
+        if event is None:
+            print(f"Invalid message format: {message}")
+            return False
+        return self.handle_event(event)
+    
+    def handle_event(self, event):
+        """处理来自服务端的文件事件（protocol.Event）"""
+        if event.event_type == 'RESYNC':
+            self.request_resync()
+            return True
+        
         try:
-            # 解析消息格式：事件类型|文件路径|可选旧文件路径
-            parts = message.split('|')
-            if len(parts) < 2:
-                print(f"Invalid message format: {message}")
-                return False
+            event_type = event.event_type
+            file_path = self._normalize_path(event.file_path)
+            new_file_path = self._normalize_path(event.new_file_path) if event.new_file_path else None
+            is_dir = bool(event.flags & FLAG_DIR)
             
-            event_type = parts[0]
-            encoded_file_path = parts[1]
-            encoded_old_file_path = parts[2] if len(parts) > 2 else None
-            
-            # 解码文件路径
-            file_path = self._decode_file_path(encoded_file_path)
-            old_file_path = self._decode_file_path(encoded_old_file_path) if encoded_old_file_path else None
+            # 客户端的排除规则：被排除的路径不同步
+            if self.path_filter is not None:
+                excluded = self.path_filter.is_ignored(file_path, is_dir)
+                if event_type == 'RENAME' and new_file_path:
+                    new_excluded = self.path_filter.is_ignored(new_file_path, is_dir)
+                    if excluded and not new_excluded:
+                        # 从被排除的路径移入，本地没有原文件
+                        if is_dir:
+                            self.request_resync()
+                            return True
+                        return self.sync_create(new_file_path)
+                    if new_excluded and not excluded:
+                        return self.sync_delete(file_path)
+                if excluded:
+                    return True
             
-            # 对于CREATE和MODIFY事件，验证源文件是否存在
-            if event_type in ['CREATE', 'MODIFY']:
+            # 共享路径模式下，对于CREATE和MODIFY事件，验证源文件是否存在
+            if event_type in ['CREATE', 'MODIFY'] and not self._use_tcp_transfer():
                 if not os.path.exists(file_path):
                     print(f"Source file not found: {file_path}")
                     return False
@@ -517,14 +1012,14 @@ class FileSync:
             elif event_type == 'DELETE':
                 return self.sync_delete(file_path)
             elif event_type == 'RENAME':
-                if old_file_path:
-                    return self.sync_rename(file_path, old_file_path)  # 修复参数顺序：file_path是旧路径，old_file_path是新路径
+                if new_file_path:
+                    return self.sync_rename(file_path, new_file_path, is_dir)
                 else:
-                    print(f"RENAME event missing old file path: {message}")
+                    print(f"RENAME event missing new file path: {file_path}")
                     return False
             else:
                 print(f"Unknown event type: {event_type}")
                 return False
         except Exception as e:
-            print(f"Failed to handle message '{message}': {e}")
+            print(f"Failed to handle event {event}: {e}")
             return False
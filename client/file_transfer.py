@@ -0,0 +1,362 @@
+import os
+import socket
+import struct
+import threading
+import urllib.parse
+
+from compression import CHUNK_COMPRESSED, CHUNK_END, CHUNK_HEADER, CHUNK_RAW, CODEC_IDS, decompress
+from delta import OP_COPY, OP_END, OP_LITERAL, DeltaPatcher, choose_block_size, compute_signatures
+from metrics import REGISTRY
+
+# 接收缓冲区大小
+RECV_BUFFER_SIZE = 256 * 1024
+
+BYTES_COPIED = REGISTRY.counter('filesync_client_bytes_copied_total', 'File bytes written to the target directory',
+                                ('method',))
+
+
+class DataConnection:
+    def __init__(self, server_ip, server_port, timeout):
+        """到服务端的一条数据通道连接"""
+        self.sock = socket.create_connection((server_ip, server_port), timeout=timeout)
+        # 请求与响应头都是小数据包，关闭Nagle算法避免与延迟确认叠加产生等待
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        # 本连接协商的压缩算法，None表示不压缩
+        self.codec = None
+
+    def readline(self):
+        """读取一行响应（不含换行符）"""
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 1]
+                return line.decode('utf-8')
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            self.buffer += data
+
+    def read_exact(self, size):
+        """读取指定长度的数据"""
+        while len(self.buffer) < size:
+            data = self.sock.recv(max(65536, size - len(self.buffer)))
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def copy_to(self, dst_file, size, progress_callback=None):
+        """将接下来的size字节写入文件，优先消耗已缓冲的数据"""
+        remaining = size
+        if self.buffer:
+            head = self.buffer[:remaining]
+            dst_file.write(head)
+            remaining -= len(head)
+            del self.buffer[:len(head)]
+            if progress_callback:
+                progress_callback(size - remaining)
+
+        chunk = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(chunk)
+        while remaining > 0:
+            received = self.sock.recv_into(view, min(remaining, RECV_BUFFER_SIZE))
+            if not received:
+                raise ConnectionError("Connection closed during transfer")
+            dst_file.write(view[:received])
+            remaining -= received
+            if progress_callback:
+                progress_callback(size - remaining)
+
+    def copy_compressed_to(self, dst_file, size, codec, progress_callback=None):
+        """读取压缩数据块流并将解压后的size字节写入文件"""
+        codec_id = CODEC_IDS[codec]
+        written = 0
+        while True:
+            kind, length = CHUNK_HEADER.unpack(self.read_exact(CHUNK_HEADER.size))
+            if kind == CHUNK_END:
+                break
+            if kind == CHUNK_COMPRESSED:
+                # 解压后的数据不能超过文件剩余的大小
+                data = decompress(codec_id, self.read_exact(length), max(0, size - written))
+                dst_file.write(data)
+                written += len(data)
+                if progress_callback:
+                    progress_callback(written)
+            elif kind == CHUNK_RAW:
+                base = written
+                self.copy_to(dst_file, length,
+                             (lambda copied: progress_callback(base + copied)) if progress_callback else None)
+                written += length
+            else:
+                raise ValueError(f"Invalid compressed chunk type: {kind!r}")
+        if written != size:
+            raise ValueError(f"Compressed data size mismatch: {written} != {size}")
+
+    def sendall(self, data):
+        """发送请求"""
+        self.sock.sendall(data)
+
+    def close(self):
+        """关闭连接"""
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class FileFetcher:
+    def __init__(self, server_ip, server_port, server_root, timeout=30, codecs=None):
+        """初始化文件获取器：通过TCP数据通道从服务端拉取文件内容
+
+        codecs为本端支持的压缩算法列表，每个数据连接建立时与服务端协商
+        """
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.server_root = server_root
+        self.timeout = timeout
+        self.codecs = codecs or []
+        # 服务端是否支持数据通道，旧版本服务端不支持时自动回退到共享路径
+        self.available = True
+        self.has_succeeded = False
+        # 每个工作线程使用独立的数据连接
+        self._local = threading.local()
+
+    def get_relative_path(self, server_path):
+        """计算相对于服务端根目录的路径，统一使用'/'分隔"""
+        normalized_server_path = os.path.normpath(server_path)
+        normalized_server_root = os.path.normpath(self.server_root)
+        if normalized_server_path.startswith(normalized_server_root):
+            relative_path = normalized_server_path[len(normalized_server_root):]
+        else:
+            relative_path = os.path.basename(normalized_server_path)
+        return relative_path.replace('\\', '/').lstrip('/')
+
+    def _get_connection(self):
+        """获取当前线程的数据连接，不存在时新建"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = DataConnection(self.server_ip, self.server_port, self.timeout)
+            self._local.connection = connection
+            if self.codecs:
+                self._negotiate_compression(connection)
+        return connection
+
+    def _negotiate_compression(self, connection):
+        """协商数据连接的压缩算法，旧版本服务端返回错误时不压缩"""
+        connection.sendall(f"COMPRESS|{','.join(self.codecs)}\n".encode('utf-8'))
+        parts = connection.readline().split('|')
+        if parts[0] == 'COMPRESS' and len(parts) >= 2 and parts[1] in self.codecs:
+            connection.codec = parts[1]
+
+    def _drop_connection(self):
+        """关闭并丢弃当前线程的数据连接"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def request(self, line):
+        """发送一条请求并返回(连接, 响应首行)"""
+        connection = self._get_connection()
+        connection.sendall(f"{line}\n".encode('utf-8'))
+        return connection, connection.readline()
+
+    def _mark_unavailable(self, reason):
+        """标记服务端不支持数据通道"""
+        if self.available:
+            print(f"\nTCP transfer unavailable ({reason}), falling back to shared path")
+        self.available = False
+
+    def fetch(self, server_path, dst_path, progress_callback=None, dedup_min_size=0, dedup_callback=None):
+        """从服务端获取文件内容写入dst_path，成功后同步修改时间
+
+        dedup_callback不为空时请求服务端先发送不小于dedup_min_size的文件的内容哈希，
+        dedup_callback(大小, 修改时间, 哈希)返回True表示已从本地获得相同内容，此时不再传输
+        """
+        if not self.available:
+            return False
+
+        relative_path = self.get_relative_path(server_path)
+        encoded_path = urllib.parse.quote(relative_path, safe='')
+
+        try:
+            if dedup_callback is not None:
+                connection, header = self.request(f"FETCH|{encoded_path}|{dedup_min_size}")
+            else:
+                connection, header = self.request(f"FETCH|{encoded_path}")
+            parts = header.split('|')
+
+            if parts[0] == 'HASH' and len(parts) >= 4 and dedup_callback is not None:
+                if dedup_callback(int(parts[1]), int(parts[2]), parts[3]):
+                    connection.sendall(b"SKIP\n")
+                    self.has_succeeded = True
+                    return True
+                connection.sendall(b"SEND\n")
+                header = connection.readline()
+                parts = header.split('|')
+
+            if parts[0] == 'ERROR':
+                reason = urllib.parse.unquote(parts[1]) if len(parts) > 1 else 'unknown error'
+                print(f"Server failed to send {relative_path}: {reason}")
+                return False
+
+            compressed = parts[0] == 'CDATA' and len(parts) >= 4 and parts[3] == connection.codec
+            if parts[0] != 'DATA' and not compressed or len(parts) < 3:
+                # 旧版本服务端会把数据连接当作普通订阅连接
+                self._drop_connection()
+                self._mark_unavailable(f"unexpected response: {header[:40]}")
+                return False
+
+            file_size = int(parts[1])
+            mtime_ns = int(parts[2])
+
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            with open(dst_path, 'wb') as dst_file:
+                if compressed:
+                    connection.copy_compressed_to(dst_file, file_size, connection.codec, progress_callback)
+                else:
+                    connection.copy_to(dst_file, file_size, progress_callback)
+            BYTES_COPIED.inc(file_size, method='compressed' if compressed else 'tcp')
+
+            # 保持与服务端一致的修改时间，供增量对比使用
+            try:
+                os.utime(dst_path, ns=(mtime_ns, mtime_ns))
+            except OSError:
+                pass
+
+            self.has_succeeded = True
+            return True
+        except socket.timeout:
+            self._drop_connection()
+            if not self.has_succeeded:
+                self._mark_unavailable("no response from server")
+            else:
+                print(f"Timeout while fetching {relative_path}")
+            return False
+        except (OSError, ValueError) as e:
+            self._drop_connection()
+            print(f"Error fetching {relative_path}: {e}")
+            return False
+
+    def list_tree(self, relative_dir):
+        """获取服务端Merkle树中一个目录的摘要和内容
+
+        返回(摘要, [(文件名, 大小, 修改时间), ...], [(子目录名, 摘要), ...])，
+        目录不存在时摘要为None；服务端不支持或出错时返回None
+        """
+        if not self.available:
+            return None
+
+        try:
+            connection, header = self.request(f"TREE|{urllib.parse.quote(relative_dir, safe='')}")
+            parts = header.split('|')
+            if parts[0] == 'ERROR':
+                reason = urllib.parse.unquote(parts[1]) if len(parts) > 1 else 'unknown error'
+                print(f"Server failed to list {relative_dir or '/'}: {reason}")
+                return None
+            if parts[0] != 'TREE' or len(parts) < 4:
+                self._drop_connection()
+                print(f"Unexpected tree response for {relative_dir or '/'}: {header[:40]}")
+                return None
+
+            digest = bytes.fromhex(parts[1]) if parts[1] != '-' else None
+            files = []
+            for _ in range(int(parts[2])):
+                _, size, mtime_ns, name = connection.readline().split('|', 3)
+                files.append((urllib.parse.unquote(name), int(size), int(mtime_ns)))
+            subdirs = []
+            for _ in range(int(parts[3])):
+                _, subdir_digest, name = connection.readline().split('|', 2)
+                subdirs.append((urllib.parse.unquote(name), bytes.fromhex(subdir_digest)))
+            return digest, files, subdirs
+        except (OSError, ValueError) as e:
+            self._drop_connection()
+            print(f"Error listing {relative_dir or '/'}: {e}")
+            return None
+
+    def fetch_hash(self, server_path):
+        """获取服务端文件的内容哈希，返回(大小, 修改时间, 哈希)，服务端不支持或出错时返回None"""
+        if not self.available:
+            return None
+
+        relative_path = self.get_relative_path(server_path)
+        try:
+            _connection, header = self.request(f"HASH|{urllib.parse.quote(relative_path, safe='')}")
+            parts = header.split('|')
+            if parts[0] == 'ERROR':
+                reason = urllib.parse.unquote(parts[1]) if len(parts) > 1 else 'unknown error'
+                print(f"Server failed to hash {relative_path}: {reason}")
+                return None
+            if parts[0] != 'HASH' or len(parts) < 4:
+                self._drop_connection()
+                print(f"Unexpected hash response for {relative_path}: {header[:40]}")
+                return None
+            return int(parts[1]), int(parts[2]), parts[3]
+        except (OSError, ValueError) as e:
+            self._drop_connection()
+            print(f"Error hashing {relative_path}: {e}")
+            return None
+
+    def fetch_delta(self, server_path, dst_path):
+        """差异传输：发送本地文件的块签名，只接收变化的块和字面数据并原地打补丁"""
+        if not self.available:
+            return False
+
+        relative_path = self.get_relative_path(server_path)
+        encoded_path = urllib.parse.quote(relative_path, safe='')
+
+        try:
+            block_size = choose_block_size(os.path.getsize(dst_path))
+            count, signatures = compute_signatures(dst_path, block_size)
+
+            connection = self._get_connection()
+            connection.sendall(f"DELTA|{encoded_path}|{block_size}|{count}\n".encode('utf-8') + signatures)
+            header = connection.readline()
+            parts = header.split('|')
+
+            if parts[0] == 'ERROR':
+                reason = urllib.parse.unquote(parts[1]) if len(parts) > 1 else 'unknown error'
+                print(f"Server failed to send delta for {relative_path}: {reason}")
+                return False
+
+            if parts[0] != 'DELTA' or len(parts) < 3:
+                self._drop_connection()
+                print(f"Unexpected delta response for {relative_path}: {header[:40]}")
+                return False
+
+            mtime_ns = int(parts[2])
+
+            with open(dst_path, 'r+b') as dst_file:
+                patcher = DeltaPatcher(dst_file, block_size)
+                while True:
+                    op = connection.read_exact(1)
+                    if op == OP_COPY:
+                        index, = struct.unpack('>Q', connection.read_exact(8))
+                        patcher.copy_block(index)
+                    elif op == OP_LITERAL:
+                        length, = struct.unpack('>I', connection.read_exact(4))
+                        patcher.write_literal(connection.read_exact(length))
+                    elif op == OP_END:
+                        break
+                    else:
+                        raise ValueError(f"Invalid delta instruction: {op!r}")
+                patcher.finish()
+            BYTES_COPIED.inc(patcher.literal_bytes, method='delta')
+
+            try:
+                os.utime(dst_path, ns=(mtime_ns, mtime_ns))
+            except OSError:
+                pass
+
+            print(f"Delta applied to {relative_path}: {patcher.reused_blocks} blocks unchanged, "
+                  f"{patcher.copied_blocks} moved, {patcher.literal_bytes} literal bytes")
+            return True
+        except (OSError, ValueError, struct.error) as e:
+            # 打补丁中途失败时目标文件内容不完整，由调用方重新完整获取
+            self._drop_connection()
+            print(f"Error applying delta for {relative_path}: {e}")
+            return False
@@ -2,6 +2,17 @@ import time
 from config import Config
 from tcp_client import TCPClient
 from file_sync import FileSync
+from file_transfer import FileFetcher
+from apply_engine import ApplyEngine
+from hash_cache import HashCache
+from compression import parse_codec_list
+from manifest import Manifest
+from metrics import MetricsExporter
+from path_filter import load_filter
+from subscriptions import SubscriptionFilter, parse_subscriptions
+
+# 实时事件应用状态的报告间隔（秒）
+STATUS_INTERVAL = 10
 
 class FileSyncClient:
     def __init__(self):
@@ -9,23 +20,88 @@ class FileSyncClient:
         # 加载配置
         self.config = Config()
         
+        # 本机可用且配置允许的压缩算法，与服务端协商后使用
+        self.codecs = parse_codec_list(self.config.compression)
+        
+        # 初始化文件获取器（TCP数据通道），shared模式下直接读取共享路径
+        self.file_fetcher = None
+        if self.config.transfer_mode == 'tcp':
+            self.file_fetcher = FileFetcher(
+                self.config.server_ip, 
+                self.config.server_port, 
+                self.config.server_root,
+                codecs=self.codecs
+            )
+        
+        # 初始化清单：记录已应用的文件，增量同步时不再扫描目标目录
+        self.manifest = None
+        if self.config.manifest_file:
+            self.manifest = Manifest(self.config.manifest_file)
+        
+        # 校验模式：按内容哈希判断文件是否一致，哈希按文件状态缓存
+        self.hash_cache = None
+        if self.config.checksum:
+            self.hash_cache = HashCache(self.config.hash_cache_file)
+        
+        # 排除规则；订阅了部分路径时只扫描、同步订阅的路径，服务端也只发送这些路径的事件
+        path_filter = load_filter(self.config.exclude, self.config.exclude_file, self.config.server_root)
+        subscriptions = parse_subscriptions(self.config.subscribe.split(','))
+        if subscriptions:
+            path_filter = SubscriptionFilter(path_filter, subscriptions)
+        self.subscriptions = [subscription.pattern for subscription in subscriptions]
+
         # 初始化文件同步器
         self.file_sync = FileSync(
             self.config.server_root, 
             self.config.target_dir,
-            self.config.max_workers
+            self.config.max_workers,
+            self.file_fetcher,
+            self.config.delta_min_size,
+            self.manifest,
+            self.config.parallel_copy_threshold,
+            self.hash_cache,
+            self.config.dedup_min_size,
+            self.config.dedup_link,
+            self.config.fsync_mode,
+            path_filter
+        )
+        
+        # 初始化实时事件应用引擎：事件在线程池中并行应用，同一路径保持顺序
+        self.apply_engine = ApplyEngine(self.file_sync.handle_event, self.config.max_workers,
+                                        self.file_sync.writer.commit_soon)
+        
+        # 指标输出：本地HTTP端点和定期写入的JSON文件
+        self.metrics_exporter = MetricsExporter(
+            bind_ip=self.config.metrics_bind,
+            port=self.config.metrics_port,
+            json_file=self.config.metrics_file,
+            interval=self.config.metrics_interval
         )
         
         # 初始化TCP客户端
         self.tcp_client = TCPClient(
             self.config.server_ip, 
             self.config.server_port, 
-            self.handle_message
+            self.handle_event,
+            self.file_sync.request_resync,
+            self.codecs,
+            self.subscriptions
         )
     
-    def handle_message(self, message):
-        """处理来自服务端的消息"""
-        self.file_sync.handle_message(message)
+    def handle_event(self, event):
+        """处理来自服务端的文件事件：交给应用引擎，接收线程不等待同步完成"""
+        self.apply_engine.submit(event)
+    
+    def report_status(self):
+        """有事件积压或应用过事件时输出队列深度和应用延迟"""
+        stats = self.apply_engine.get_stats(reset_lag=True)
+        completed = stats['applied'] + stats['failed']
+        if not completed and not stats['queue_depth'] and not stats['in_progress']:
+            return
+        print(f"Apply queue: {stats['queue_depth']} queued, {stats['in_progress']} in progress, "
+              f"{completed} applied ({stats['failed']} failed), "
+              f"lag avg {stats['lag_mean_seconds'] * 1000:.0f}ms / max {stats['lag_max_seconds'] * 1000:.0f}ms, "
+              f"oldest pending {stats['oldest_pending_seconds']:.1f}s")
     
     def start(self):
         """启动客户端"""
@@ -38,6 +114,17 @@ class FileSyncClient:
         print(f"  Target Directory: {self.config.target_dir}")
         print(f"  Server Root Directory: {self.config.server_root}")
         print(f"  Sync Mode: {self.config.sync_mode}")
+        print(f"  Transfer Mode: {self.config.transfer_mode}")
+        print(f"  Manifest: {self.config.manifest_file or 'disabled'}")
+        print(f"  Checksum: {'enabled' if self.config.checksum else 'disabled'}")
+        print(f"  Compression: {','.join(self.codecs) or 'disabled'}")
+        print(f"  Fsync Mode: {self.file_sync.writer.fsync_mode}")
+        print(f"  Exclude: {self.config.exclude or 'none'}{f' + {self.config.exclude_file}' if self.config.exclude_file else ''}")
+        print(f"  Subscribe: {', '.join(self.subscriptions) or 'all'}")
+        print(f"  Metrics: port {self.config.metrics_port or 'disabled'}, file {self.config.metrics_file or 'disabled'}")
+        
+        # 初始同步期间也可以查看进度指标
+        self.metrics_exporter.start()
         
         # 确保目标目录存在
         import os
@@ -52,8 +139,13 @@ class FileSyncClient:
         else:  # incremental mode
             print("\nPerforming incremental sync (diff compare)...")
             self.file_sync.compare_and_sync_diff()
+        if self.manifest is not None:
+            self.manifest.flush()
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
         
         # 连接到服务端
+        self.apply_engine.start()
         if self.tcp_client.connect():
             print("\nClient started successfully!")
             print("Press Ctrl+C to stop...")
@@ -69,6 +161,15 @@ class FileSyncClient:
         # 断开与服务端的连接
         self.tcp_client.disconnect()
         
+        # 等待正在应用的事件完成，提交尚未提交的写入
+        self.apply_engine.stop()
+        self.file_sync.writer.commit()
+        if self.manifest is not None:
+            self.manifest.close()
+        if self.hash_cache is not None:
+            self.hash_cache.close()
+        self.metrics_exporter.stop()
+        
         print("Client stopped")
 
 def main():
@@ -77,9 +178,15 @@ def main():
     
     try:
         if client.start():
-            # 等待用户输入
+            # 等待用户输入，定期报告事件应用状态
+            elapsed = 0
             while True:
                 time.sleep(1)
+                elapsed += 1
+                if elapsed % STATUS_INTERVAL == 0:
+                    client.report_status()
+                    if client.manifest is not None:
+                        client.manifest.flush()
     except KeyboardInterrupt:
         pass
     finally:
@@ -0,0 +1,276 @@
+import hashlib
+import sqlite3
+import struct
+import threading
+import time
+
+# 累计多少次写入或多少秒后提交一次事务
+COMMIT_BATCH = 1000
+COMMIT_INTERVAL = 2.0
+
+# 目录摘要的计算方法与服务端Merkle树相同：文件条目为大小和修改时间(纳秒)
+FILE_ENTRY = struct.Struct('>QQ')
+DIGEST_SIZE = 16
+
+
+def split_relative_path(relative_path):
+    """将相对路径（使用/分隔）拆分为(上级目录, 文件名)，根目录下的文件上级目录为空字符串"""
+    parent, _, name = relative_path.rpartition('/')
+    return parent, name
+
+
+def files_digest(entries):
+    """目录中直接包含的文件的摘要，entries为[(名称, 大小, 修改时间), ...]，没有文件时返回None"""
+    if not entries:
+        return None
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for name, size, mtime_ns in sorted(entries, key=lambda entry: entry[0].encode('utf-8', 'surrogateescape')):
+        digest.update(b'F' + name.encode('utf-8', 'surrogateescape') + b'\0')
+        digest.update(FILE_ENTRY.pack(size, mtime_ns))
+    return digest.digest()
+
+
+def directory_digest(file_part, subdirs):
+    """目录摘要：由文件摘要和各子目录的(名称, 摘要)组成，整个子树没有文件时返回None"""
+    subdirs = [(name, digest) for name, digest in subdirs if digest is not None]
+    if file_part is None and not subdirs:
+        return None
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    digest.update(file_part or b'\0' * DIGEST_SIZE)
+    for name, subdir_digest in sorted(subdirs, key=lambda item: item[0].encode('utf-8', 'surrogateescape')):
+        digest.update(b'D' + name.encode('utf-8', 'surrogateescape') + b'\0' + subdir_digest)
+    return digest.digest()
+
+
+class Manifest:
+    def __init__(self, db_path):
+        """客户端清单：记录客户端最后一次成功应用的每个文件的状态
+
+        以相对路径为键保存大小、修改时间（纳秒）、inode和可选的内容哈希，
+        启动时只需与服务端目录对比，无需重新扫描目标目录。
+        写入按批提交，异常退出最多丢失最后一批记录，缺失的记录在下次启动时按原方式检查
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, parent TEXT NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, inode INTEGER, hash TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_parent ON files (parent)")
+        # 按内容哈希查找已有文件，用于去重
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+        # 目录摘要缓存：首次查询时计算，之后只重算记录发生变化的目录
+        self.digests = None
+        self.children = None
+        self.file_parts = None
+        self.dirty_dirs = set()
+
+    def bind(self, server_root, target_dir):
+        """绑定同步目录，目录与上次不同时清空清单"""
+        with self.lock:
+            rows = dict(self.connection.execute("SELECT key, value FROM meta"))
+            if rows.get('server_root') == server_root and rows.get('target_dir') == target_dir:
+                return
+            if rows:
+                print(f"Sync directories changed, clearing manifest {self.db_path}")
+            self.connection.execute("DELETE FROM files")
+            self.digests = None
+            self.connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                        [('server_root', server_root), ('target_dir', target_dir)])
+            self.connection.commit()
+
+    def _written_locked(self, count=1):
+        """记录写入次数，达到批量或时间间隔时提交（调用方持有锁）"""
+        self.pending_writes += count
+        if self.pending_writes >= COMMIT_BATCH or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self._commit_locked()
+
+    def _mark_dirty_locked(self, relative_path, subtree=False):
+        """记录发生变化后标记需要重算摘要的目录（调用方持有锁）"""
+        if self.digests is None:
+            return
+        self.dirty_dirs.add(split_relative_path(relative_path)[0])
+        if subtree and relative_path in self.digests:
+            # 路径是已知的目录：沿子目录表丢弃其下所有缓存的摘要；
+            # 其下仍待重算的目录重算时已没有记录，会从摘要中移除
+            if relative_path:
+                parent, name = split_relative_path(relative_path)
+                self.children.get(parent, set()).discard(name)
+            stack = [relative_path]
+            while stack:
+                relative_dir = stack.pop()
+                self.digests.pop(relative_dir, None)
+                self.file_parts.pop(relative_dir, None)
+                stack.extend(f"{relative_dir}/{name}" if relative_dir else name
+                             for name in self.children.pop(relative_dir, ()))
+
+    def _commit_locked(self):
+        self.connection.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def get(self, relative_path):
+        """返回(size, mtime_ns, inode, hash)，不存在时返回None"""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT size, mtime_ns, inode, hash FROM files WHERE path = ?", (relative_path,)).fetchone()
+
+    def list_dir(self, parent):
+        """返回目录下直接包含的文件：文件名 -> (size, mtime_ns)"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE parent = ?", (parent,)).fetchall()
+        return {split_relative_path(path)[1]: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def find_by_hash(self, file_hash):
+        """返回记录了该内容哈希的文件：[(相对路径, size, mtime_ns), ...]"""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE hash = ?", (file_hash,)).fetchall()
+    
+    def list_parents(self):
+        """返回清单中所有包含文件的目录"""
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT DISTINCT parent FROM files")]
+
+    def update(self, relative_path, size, mtime_ns, inode=None, file_hash=None):
+        """记录一个已应用的文件"""
+        parent, _ = split_relative_path(relative_path)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (path, parent, size, mtime_ns, inode, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (relative_path, parent, size, mtime_ns, inode, file_hash))
+            self._mark_dirty_locked(relative_path)
+            self._written_locked()
+
+    def remove(self, relative_path):
+        """删除文件或整个目录下的记录"""
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (relative_path,))
+            self.connection.execute("DELETE FROM files WHERE path >= ? AND path < ?",
+                                    (relative_path + '/', relative_path + '0'))
+            self._mark_dirty_locked(relative_path, subtree=True)
+            self._written_locked()
+
+    def rename(self, old_path, new_path):
+        """将文件或整个目录下的记录移动到新路径"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns, inode, hash FROM files "
+                "WHERE path = ? OR (path >= ? AND path < ?)",
+                (old_path, old_path + '/', old_path + '0')).fetchall()
+            self.connection.execute("DELETE FROM files WHERE path = ? OR path >= ? AND path < ?",
+                                    (new_path, new_path + '/', new_path + '0'))
+            self.connection.execute("DELETE FROM files WHERE path = ? OR path >= ? AND path < ?",
+                                    (old_path, old_path + '/', old_path + '0'))
+            moved = []
+            for path, size, mtime_ns, inode, file_hash in rows:
+                path = new_path + path[len(old_path):]
+                moved.append((path, split_relative_path(path)[0], size, mtime_ns, inode, file_hash))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, parent, size, mtime_ns, inode, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)", moved)
+            self._mark_dirty_locked(old_path, subtree=True)
+            self._mark_dirty_locked(new_path, subtree=True)
+            for path, parent, _size, _mtime_ns, _inode, _hash in moved:
+                self._mark_dirty_locked(path)
+            self._written_locked(len(moved) or 1)
+
+    def list_subtree(self, relative_dir):
+        """返回目录下（含所有子目录）记录的文件相对路径"""
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT path FROM files WHERE path >= ? AND path < ?", (relative_dir + '/', relative_dir + '0'))]
+
+    def directory_digests(self):
+        """返回所有包含文件的目录的摘要及子目录：({目录: 摘要}, {目录: 子目录名称集合})
+
+        首次调用时遍历整个清单计算，之后只重算有记录变化的目录及其上级目录
+        """
+        with self.lock:
+            if self.digests is None:
+                self._compute_all_digests_locked()
+            elif self.dirty_dirs:
+                self._recompute_dirty_locked()
+            # 返回副本，调用方使用期间其他线程可能继续更新清单
+            return dict(self.digests), {name: set(subdirs) for name, subdirs in self.children.items()}
+
+    def _link_parents_locked(self, relative_dir, pending):
+        """将目录及其所有上级目录登记到子目录表中，并加入待重算集合"""
+        while relative_dir not in pending:
+            pending.add(relative_dir)
+            if not relative_dir:
+                return
+            parent, name = split_relative_path(relative_dir)
+            self.children.setdefault(parent, set()).add(name)
+            relative_dir = parent
+
+    def _combine_locked(self, pending):
+        """从最深的目录开始重算摘要，子树中没有文件的目录从上级目录中移除"""
+        for relative_dir in sorted(pending, key=lambda path: path.count('/') + bool(path), reverse=True):
+            subdirs = self.children.get(relative_dir, set())
+            digest = directory_digest(self.file_parts.get(relative_dir), [
+                (name, self.digests.get(f"{relative_dir}/{name}" if relative_dir else name)) for name in subdirs])
+            if digest is None:
+                self.digests.pop(relative_dir, None)
+                self.children.pop(relative_dir, None)
+                self.file_parts.pop(relative_dir, None)
+                if relative_dir:
+                    parent, name = split_relative_path(relative_dir)
+                    self.children.get(parent, set()).discard(name)
+            else:
+                self.digests[relative_dir] = digest
+
+    def _compute_all_digests_locked(self):
+        """遍历整个清单计算目录摘要"""
+        self.digests = {}
+        self.children = {}
+        self.file_parts = file_parts = {}
+        self.dirty_dirs.clear()
+        pending = set()
+        current_parent = None
+        entries = []
+        rows = self.connection.execute("SELECT parent, path, size, mtime_ns FROM files ORDER BY parent, path")
+        for parent, path, size, mtime_ns in rows:
+            if parent != current_parent:
+                if current_parent is not None:
+                    file_parts[current_parent] = files_digest(entries)
+                    self._link_parents_locked(current_parent, pending)
+                current_parent = parent
+                entries = []
+            entries.append((split_relative_path(path)[1], size, mtime_ns))
+        if current_parent is not None:
+            file_parts[current_parent] = files_digest(entries)
+            self._link_parents_locked(current_parent, pending)
+        self._combine_locked(pending)
+
+    def _recompute_dirty_locked(self):
+        """只重算记录发生变化的目录及其上级目录"""
+        pending = set()
+        for relative_dir in self.dirty_dirs:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE parent = ?", (relative_dir,)).fetchall()
+            self.file_parts[relative_dir] = files_digest(
+                [(split_relative_path(path)[1], size, mtime_ns) for path, size, mtime_ns in rows])
+            self._link_parents_locked(relative_dir, pending)
+        self.dirty_dirs.clear()
+        self._combine_locked(pending)
+
+    def flush(self):
+        """提交尚未提交的记录"""
+        with self.lock:
+            if self.pending_writes:
+                self._commit_locked()
+
+    def close(self):
+        """提交并关闭数据库"""
+        with self.lock:
+            self._commit_locked()
+            self.connection.close()
@@ -0,0 +1,141 @@
+import struct
+import urllib.parse
+from collections import namedtuple
+
+from compression import decompress
+
+# 协议版本：1为换行分隔的文本协议，2为长度前缀的二进制帧协议
+TEXT_PROTOCOL_VERSION = 1
+BINARY_PROTOCOL_VERSION = 2
+
+# 帧头：长度(不含自身) 版本 类型 标志 序号 路径长度 新路径长度
+FRAME_HEADER = struct.Struct('>IBBHQII')
+
+# 帧类型与事件类型的对应关系
+EVENT_TYPES = {
+    1: 'CREATE',
+    2: 'MODIFY',
+    3: 'DELETE',
+    4: 'RENAME',
+}
+# 批量帧：负载为连续的多个事件帧
+BATCH_FRAME_TYPE = 5
+# 重新同步帧：服务端丢弃了发给本客户端的事件，需要重新对比目录
+RESYNC_FRAME_TYPE = 6
+# 压缩帧：标志位为压缩算法编号，负载为压缩后的事件帧序列
+COMPRESSED_FRAME_TYPE = 7
+# 序号水位帧：只订阅部分路径的客户端在该序号之前没有未收到的相关事件，用于推进续传位置
+WATERMARK_FRAME_TYPE = 8
+
+# 事件帧标志位：路径是目录，DELETE/RENAME作用于整个子树
+FLAG_DIR = 0x1
+
+# 单个帧的最大长度，防止异常数据导致无限扩容
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# 文件事件：事件类型、路径、新路径（仅RENAME）、标志、序号
+Event = namedtuple('Event', ['event_type', 'file_path', 'new_file_path', 'flags', 'sequence'])
+
+
+def encode_subscriptions(patterns):
+    """编码握手行中的订阅列表：逗号分隔、URL编码的路径前缀或glob模式"""
+    return ','.join(urllib.parse.quote(pattern, safe='') for pattern in patterns)
+
+
+def decode_text_event(line):
+    """解析文本协议消息：事件类型|文件路径|可选新路径，格式错误时返回None"""
+    parts = line.split('|')
+    if len(parts) < 2:
+        return None
+    file_path = urllib.parse.unquote(parts[1])
+    new_file_path = urllib.parse.unquote(parts[2]) if len(parts) > 2 and parts[2] else None
+    return Event(parts[0], file_path, new_file_path, 0, 0)
+
+
+class FrameDecoder:
+    def __init__(self, buffer_size=256 * 1024):
+        """二进制帧增量解析器：数据直接接收到可复用的缓冲区中，按帧边界解析"""
+        self.buffer = bytearray(buffer_size)
+        self.start = 0  # 未解析数据的起点
+        self.end = 0    # 已接收数据的终点
+
+    def _reserve(self, size):
+        """保证缓冲区末尾至少有size字节空闲空间"""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start > 0:
+            # 将未解析的数据移到缓冲区开头
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buffer) - self.end < size:
+            self.buffer.extend(bytes(size - (len(self.buffer) - self.end)))
+
+    def recv_into(self, sock):
+        """从套接字接收数据到缓冲区空闲处，返回接收的字节数（0表示连接关闭）"""
+        self._reserve(4096)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """追加已读取的数据（如握手行之后的剩余字节）"""
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def _decode_frames(self, view, start, end, events):
+        """解析[start, end)范围内的完整帧追加到events，返回第一个不完整帧的起点"""
+        while end - start >= FRAME_HEADER.size:
+            (length, version, frame_type, flags, sequence,
+             path_length, new_path_length) = FRAME_HEADER.unpack_from(view, start)
+            if version != BINARY_PROTOCOL_VERSION:
+                raise ValueError(f"Unsupported frame version: {version}")
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame too large: {length}")
+
+            frame_end = start + 4 + length
+            if frame_end > end:
+                break
+
+            path_start = start + FRAME_HEADER.size
+            if frame_type == BATCH_FRAME_TYPE:
+                # 批量帧的负载是完整的事件帧序列
+                self._decode_frames(view, path_start, frame_end, events)
+            elif frame_type == COMPRESSED_FRAME_TYPE:
+                # 解压后的大小同样受MAX_FRAME_SIZE限制，避免很小的帧解压出巨大的数据
+                payload = decompress(flags, bytes(view[path_start:frame_end]), MAX_FRAME_SIZE)
+                self._decode_frames(memoryview(payload), 0, len(payload), events)
+            elif frame_type == RESYNC_FRAME_TYPE:
+                events.append(Event('RESYNC', '', None, flags, sequence))
+            elif frame_type == WATERMARK_FRAME_TYPE:
+                events.append(Event('WATERMARK', '', None, flags, sequence))
+            else:
+                new_path_start = path_start + path_length
+                event_type = EVENT_TYPES.get(frame_type)
+                if event_type is not None:
+                    file_path = str(view[path_start:new_path_start], 'utf-8', 'surrogateescape')
+                    new_file_path = None
+                    if new_path_length:
+                        new_file_path = str(view[new_path_start:new_path_start + new_path_length],
+                                            'utf-8', 'surrogateescape')
+                    events.append(Event(event_type, file_path, new_file_path, flags, sequence))
+            start = frame_end
+        return start
+
+    def decode(self):
+        """解析缓冲区中所有完整的帧，返回事件列表"""
+        events = []
+        with memoryview(self.buffer) as view:
+            self.start = self._decode_frames(view, self.start, self.end, events)
+
+        if self.start == self.end:
+            # 缓冲区已全部解析，复位以复用空间
+            self.start = self.end = 0
+        elif self.end - self.start >= FRAME_HEADER.size:
+            # 为不完整的大帧预留空间
+            length, = struct.unpack_from('>I', self.buffer, self.start)
+            self._reserve(4 + length - (self.end - self.start))
+        return events
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+# 持久化方式：none（不调用fsync）、file（每个文件替换前fsync）、batch（每批文件完成后统一提交）
+FSYNC_MODES = ('none', 'file', 'batch')
+# 临时文件与目标文件位于同一目录：.文件名.partial
+STAGING_SUFFIX = '.partial'
+# batch模式下累计多少个文件或目录后立即提交一次
+BATCH_COMMIT_FILES = 1000
+# 实时事件应用完时两次提交之间的最小间隔（秒）
+COMMIT_INTERVAL = 1.0
+
+COMMIT_SECONDS = REGISTRY.histogram('filesync_client_fsync_commit_seconds', 'Duration of batch fsync commits')
+
+
+def staging_path(target_path):
+    """目标文件对应的临时文件路径"""
+    return os.path.join(os.path.dirname(target_path), f".{os.path.basename(target_path)}{STAGING_SUFFIX}")
+
+
+def _fsync_path(path, data_only=False):
+    """fsync一个文件（Windows下fsync需要写权限），data_only为True时支持的系统上只同步数据"""
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        if data_only and hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(path):
+    """fsync目录使其中的创建、重命名和删除持久化，Windows和不支持的文件系统上忽略"""
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class StagedWriter:
+    def __init__(self, fsync_mode='batch'):
+        """目标文件的原子写入：内容先写入同一目录中的临时文件，完成后再替换目标文件
+
+        读取方不会看到写了一半的文件，异常退出时目标文件保持旧内容。fsync_mode决定持久化方式：
+        file模式在替换前fsync文件、替换后fsync目录；batch模式在替换前只同步文件数据（fdatasync），
+        保证替换持久化时内容已经落盘，目录和原地修改的文件只记录下来，commit()时每个只提交一次，
+        避免同一目录中的大量小文件各付出一次目录fsync的代价
+        """
+        if fsync_mode not in FSYNC_MODES:
+            print(f"Unknown fsync mode {fsync_mode!r}, using batch")
+            fsync_mode = 'batch'
+        self.fsync_mode = fsync_mode
+        self.lock = threading.Lock()
+        # 正在写入的临时文件，清理目标目录时不应删除
+        self.staging = set()
+        # batch模式下尚未提交的文件和目录
+        self.pending_files = set()
+        self.pending_dirs = set()
+        self.commits = 0
+        self.last_commit = 0.0
+        # 推迟的提交
+        self.commit_timer = None
+
+    def stage(self, target_path):
+        """返回目标文件的临时文件路径，删除上次异常退出时遗留的临时文件"""
+        temp_path = staging_path(target_path)
+        with self.lock:
+            self.staging.add(temp_path)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        return temp_path
+
+    def is_staging(self, path):
+        """是否为正在写入的临时文件"""
+        with self.lock:
+            return path in self.staging
+
+    def publish(self, temp_path, target_path):
+        """用已写完的临时文件替换目标文件"""
+        if self.fsync_mode != 'none':
+            # 内容必须先于替换落盘，否则异常断电后目标文件可能是替换后的空文件
+            _fsync_path(temp_path, data_only=self.fsync_mode == 'batch')
+        os.replace(temp_path, target_path)
+        with self.lock:
+            self.staging.discard(temp_path)
+        # 文件内容已在替换前同步，只需再提交目录
+        self.record(target_path, is_file=False)
+
+    def discard(self, temp_path):
+        """删除未使用或写入失败的临时文件，已替换目标文件的临时文件不做处理"""
+        with self.lock:
+            if temp_path not in self.staging:
+                return
+            self.staging.discard(temp_path)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def record(self, path, is_file=True):
+        """登记原地修改的文件或发生了创建、删除、重命名的路径，按持久化方式提交"""
+        if self.fsync_mode == 'none':
+            return
+        directory = os.path.dirname(path)
+        if self.fsync_mode == 'file':
+            if is_file and os.path.isfile(path):
+                _fsync_path(path)
+            _fsync_directory(directory)
+            return
+        with self.lock:
+            if is_file:
+                self.pending_files.add(path)
+            self.pending_dirs.add(directory)
+            full = len(self.pending_files) + len(self.pending_dirs) >= BATCH_COMMIT_FILES
+        if full:
+            self.commit()
+
+    def commit_soon(self):
+        """实时事件应用完时调用：距上次提交不足COMMIT_INTERVAL秒时推迟到间隔结束再提交，
+        事件稀疏到达时不会每个事件都提交一次
+        """
+        with self.lock:
+            if (not self.pending_files and not self.pending_dirs) or self.commit_timer is not None:
+                return
+            delay = self.last_commit + COMMIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                self.commit_timer = threading.Timer(delay, self._deferred_commit)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+                return
+        self.commit()
+
+    def _deferred_commit(self):
+        with self.lock:
+            self.commit_timer = None
+        self.commit()
+
+    def commit(self):
+        """batch模式：fsync自上次提交以来原地修改过的文件和发生过变化的目录，只涉及目标目录中的路径"""
+        with self.lock:
+            if not self.pending_files and not self.pending_dirs:
+                return
+            files, self.pending_files = self.pending_files, set()
+            directories, self.pending_dirs = self.pending_dirs, set()
+            self.last_commit = time.monotonic()
+        start_time = time.perf_counter()
+        for path in files:
+            try:
+                _fsync_path(path)
+            except OSError:
+                # 文件已被后续事件删除或重命名
+                pass
+        for directory in directories:
+            _fsync_directory(directory)
+        COMMIT_SECONDS.observe(time.perf_counter() - start_time)
+        with self.lock:
+            self.commits += 1
@@ -0,0 +1,101 @@
+import re
+
+from path_filter import translate_pattern
+
+# 含有这些字符的路径组件按glob模式匹配，之前的组件作为订阅前缀
+GLOB_CHARS = '*?[\\'
+
+
+class Subscription:
+    def __init__(self, pattern):
+        """一条订阅：相对于监控目录的路径前缀（如 projects/a）或glob模式（如 docs/**/*.pdf）
+
+        前缀订阅匹配该路径本身及其下的所有路径；glob模式匹配的目录下的路径也被订阅。
+        prefix为第一个含通配符的组件之前的路径组件，用于前缀索引和扫描时剪枝
+        """
+        self.pattern = pattern.strip().strip('/')
+        components = [component for component in self.pattern.split('/') if component]
+        prefix = []
+        for component in components:
+            if any(c in component for c in GLOB_CHARS):
+                break
+            prefix.append(component)
+        self.prefix = tuple(prefix)
+        self.prefix_path = '/'.join(prefix)
+        self.regex = None
+        if len(prefix) < len(components):
+            self.regex = re.compile(translate_pattern('/' + '/'.join(components)), re.DOTALL)
+
+    def matches(self, relative_path):
+        """相对路径（/分隔）是否被订阅"""
+        if self.prefix_path and relative_path != self.prefix_path and \
+                not relative_path.startswith(self.prefix_path + '/'):
+            return False
+        if self.regex is None:
+            return True
+        # glob模式匹配路径本身或其上级目录
+        path = relative_path
+        while len(path) > len(self.prefix_path):
+            if self.regex.fullmatch(path):
+                return True
+            path = path.rpartition('/')[0]
+        return False
+
+    def may_contain(self, relative_dir):
+        """目录中是否可能有被订阅的路径：是订阅前缀的上级目录或位于订阅前缀下"""
+        if not relative_dir or not self.prefix_path:
+            return True
+        return relative_dir == self.prefix_path or relative_dir.startswith(self.prefix_path + '/') or \
+            self.prefix_path.startswith(relative_dir + '/')
+
+    def wants(self, relative_path, is_dir=False):
+        """是否需要收到该路径的事件：目录事件作用于整个子树，子树中有订阅的路径时也需要"""
+        return self.matches(relative_path) or (is_dir and self.may_contain(relative_path))
+
+
+def parse_subscriptions(patterns):
+    """解析订阅模式列表，返回Subscription列表；空列表或包含根目录时表示订阅全部事件"""
+    subscriptions = []
+    for pattern in patterns:
+        if not pattern.strip():
+            continue
+        subscription = Subscription(pattern)
+        if not subscription.prefix and subscription.regex is None:
+            return []
+        subscriptions.append(subscription)
+    return subscriptions
+
+
+class SubscriptionFilter:
+    def __init__(self, path_filter, subscriptions):
+        """在PathFilter的排除规则之外只保留订阅的路径，接口与PathFilter相同
+
+        不可能包含订阅路径的目录视为被排除，扫描时不进入；订阅的文件再按排除规则过滤
+        """
+        self.path_filter = path_filter
+        self.subscriptions = subscriptions
+
+    def __bool__(self):
+        return True
+
+    def _subscribed(self, relative_path, is_dir):
+        if is_dir:
+            return any(subscription.may_contain(relative_path) for subscription in self.subscriptions)
+        return any(subscription.matches(relative_path) for subscription in self.subscriptions)
+
+    def match(self, relative_path, is_dir=False):
+        """只按路径本身判断是否被排除，不检查上级目录（扫描时上级目录已经检查过）"""
+        return not self._subscribed(relative_path, is_dir) or self.path_filter.match(relative_path, is_dir)
+
+    def is_excluded(self, relative_path, is_dir=False):
+        """相对路径（/分隔）是否被排除，上级目录被排除时路径也被排除"""
+        if not relative_path:
+            return False
+        return not self._subscribed(relative_path, is_dir) or self.path_filter.is_excluded(relative_path, is_dir)
+
+    def relative_path(self, path):
+        return self.path_filter.relative_path(path)
+
+    def is_ignored(self, path, is_dir=False):
+        """根目录下的绝对路径是否被排除"""
+        return self.is_excluded(self.relative_path(path), is_dir)
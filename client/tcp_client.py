@@ -2,17 +2,43 @@ import socket
 import threading
 import time
 
+from metrics import REGISTRY
+from protocol import (BINARY_PROTOCOL_VERSION, TEXT_PROTOCOL_VERSION, FrameDecoder, decode_text_event,
+                      encode_subscriptions)
+
+EVENTS_RECEIVED = REGISTRY.counter('filesync_client_events_received_total', 'Events received from the server',
+                                   ('type',))
+CONNECTS = REGISTRY.counter('filesync_client_connects_total', 'Successful connections to the server')
+CONNECTED = REGISTRY.gauge('filesync_client_connected', 'Whether the event connection is up')
+
 class TCPClient:
-    def __init__(self, server_ip, server_port, message_callback):
-        """初始化TCP客户端"""
+    def __init__(self, server_ip, server_port, event_callback, reconnect_callback=None, codecs=None,
+                 subscriptions=None):
+        """初始化TCP客户端，event_callback接收解析后的protocol.Event
+
+        reconnect_callback在断线重连成功、但服务端无法从事件日志补发断线期间的事件时调用，由调用方重新对比；
+        codecs为本端支持的压缩算法列表，握手时提供给服务端选择；
+        subscriptions为订阅的路径前缀或glob模式（相对于服务端监控目录），服务端只发送匹配的事件
+        """
         self.server_ip = server_ip
         self.server_port = server_port
-        self.message_callback = message_callback
+        self.event_callback = event_callback
+        self.reconnect_callback = reconnect_callback
+        self.codecs = codecs or []
+        self.subscriptions = subscriptions or []
+        self.codec = None
+        # 服务端事件日志标识和最后收到的事件序号，重连时据此请求补发
+        self.journal_id = None
+        self.last_sequence = 0
+        self.reconnecting = False
+        self.resume_requested = False
+        self.protocol_version = TEXT_PROTOCOL_VERSION
         self.client_socket = None
         self.running = False
         self.receive_thread = None
         self.reconnect_thread = None
         self.is_connected = False
+        CONNECTED.set_function(lambda: int(self.is_connected))
     
     def connect(self):
         """连接到服务端"""
@@ -50,6 +76,7 @@ class TCPClient:
     
     def _reconnect_loop(self):
         """重连循环：如果连接断开，自动重连"""
+        connected_before = False
         while self.running:
             try:
                 # 创建TCP套接字
@@ -60,8 +87,22 @@ class TCPClient:
                 print(f"Connecting to server {self.server_ip}:{self.server_port}...")
                 self.client_socket.connect((self.server_ip, self.server_port))
                 self.is_connected = True
+                CONNECTS.inc()
                 print(f"Connected to server {self.server_ip}:{self.server_port}")
                 
+                # 请求使用二进制帧协议，旧版本服务端会忽略该握手行；
+                # 重连时附带续传位置，支持压缩时附带压缩算法列表，订阅了部分路径时附带订阅列表
+                hello = ['HELLO', str(BINARY_PROTOCOL_VERSION), '', '', ','.join(self.codecs),
+                         encode_subscriptions(self.subscriptions)]
+                if connected_before and self.journal_id:
+                    hello[2:4] = [self.journal_id, str(self.last_sequence)]
+                while not hello[-1]:
+                    hello.pop()
+                self.client_socket.sendall(('|'.join(hello) + '\n').encode('utf-8'))
+                self.reconnecting = connected_before
+                self.resume_requested = connected_before and bool(self.journal_id)
+                connected_before = True
+                
                 # 启动接收线程
                 self.receive_thread = threading.Thread(target=self._receive_messages)
                 self.receive_thread.daemon = True
@@ -81,27 +122,102 @@ class TCPClient:
             # 重置接收线程
             self.receive_thread = None
     
+    def _dispatch_event(self, event):
+        """按序号去除重复事件后交给回调：续传补发的事件可能与实时广播重复"""
+        if event.event_type == 'WATERMARK':
+            # 订阅了部分路径时，服务端告知之前的事件都已发送，只推进续传位置
+            self.last_sequence = max(self.last_sequence, event.sequence)
+            return
+        if event.event_type == 'RESYNC':
+            self.last_sequence = max(self.last_sequence, event.sequence)
+        elif event.sequence:
+            if event.sequence <= self.last_sequence:
+                return
+            self.last_sequence = event.sequence
+        EVENTS_RECEIVED.inc(type=event.event_type)
+        self.event_callback(event)
+    
+    def _on_welcome(self, line):
+        """处理WELCOME|版本|日志标识|起始序号|压缩算法确认，服务端不支持续传时在重连后通知调用方"""
+        parts = line.decode('utf-8').split('|')
+        self.codec = parts[4] if len(parts) >= 5 and parts[4] else None
+        print(f"Using binary frame protocol ({self.codec or 'no'} compression)")
+        if len(parts) < 4 or not parts[2]:
+            self.journal_id = None
+            self._on_resume_unsupported()
+            return
+        
+        journal_id = parts[2]
+        if not self.resume_requested or journal_id != self.journal_id:
+            # 从服务端告知的序号开始接收；请求续传但日志已更换时服务端会发送RESYNC
+            self.journal_id = journal_id
+            self.last_sequence = int(parts[3])
+        if not self.resume_requested:
+            self._on_resume_unsupported()
+        self.reconnecting = False
+    
+    def _on_resume_unsupported(self):
+        """服务端无法补发断线期间的事件"""
+        if self.reconnecting and self.reconnect_callback:
+            self.reconnect_callback()
+        self.reconnecting = False
+    
+    def _dispatch_text_lines(self, buffer):
+        """处理缓冲区中所有完整的文本行，返回最后一个换行符之后的剩余数据"""
+        *lines, remainder = buffer.split(b'\n')
+        for line in lines:
+            if line:
+                event = decode_text_event(line.decode('utf-8'))
+                if event is None:
+                    print(f"Invalid message format: {line!r}")
+                    continue
+                self._dispatch_event(event)
+        return remainder
+    
     def _receive_messages(self):
-        """接收服务端消息"""
+        """接收服务端消息：先按文本读取，收到WELCOME确认后切换为二进制帧"""
+        self.protocol_version = TEXT_PROTOCOL_VERSION
+        decoder = None
+        buffer = b''
+        first_line_checked = False
+        
         while self.running and self.is_connected:
             try:
                 # 设置超时，方便退出循环
                 self.client_socket.settimeout(1)
                 
-                # 接收数据
-                buffer = b''
-                while b'\n' not in buffer:
-                    data = self.client_socket.recv(1024)
-                    if not data:
+                if decoder is not None:
+                    # 二进制帧：直接接收到解析器的缓冲区
+                    if not decoder.recv_into(self.client_socket):
                         raise Exception("Connection closed by server")
-                    buffer += data
+                    for event in decoder.decode():
+                        self._dispatch_event(event)
+                    continue
+                
+                data = self.client_socket.recv(65536)
+                if not data:
+                    raise Exception("Connection closed by server")
+                buffer += data
+                
+                if not first_line_checked:
+                    if b'\n' not in buffer:
+                        continue
+                    first_line_checked = True
+                    line, rest = buffer.split(b'\n', 1)
+                    if line.startswith(b'WELCOME|'):
+                        self.protocol_version = BINARY_PROTOCOL_VERSION
+                        self._on_welcome(line)
+                        decoder = FrameDecoder()
+                        decoder.feed(rest)
+                        for event in decoder.decode():
+                            self._dispatch_event(event)
+                        buffer = b''
+                        continue
+                    # 旧版本服务端只支持文本协议
+                    self._on_resume_unsupported()
                 
-                # 处理接收到的消息
-                messages = buffer.split(b'\n')
-                for message in messages:
-                    if message:
-                        message_str = message.decode('utf-8')
-                        self.message_callback(message_str)
+                # 文本协议：未以换行结尾的数据保留到下一次接收
+                buffer = self._dispatch_text_lines(buffer)
             except socket.timeout:
                 continue
             except Exception as e:
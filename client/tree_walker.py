@@ -0,0 +1,107 @@
+import os
+import queue
+import threading
+
+# 扫描线程每次向结果队列提交的文件数
+RESULT_BATCH = 256
+# 结果队列最多积压的批数：消费方跟不上时扫描线程在此等待，内存占用不随目录规模增长
+RESULT_QUEUE_BATCHES = 64
+# 扫描线程等待结果队列时检查停止标志的间隔（秒）
+PUT_TIMEOUT = 0.5
+
+
+def walk_files(root_dir, max_workers=4, path_filter=None):
+    """多线程扫描目录树，以生成器方式逐个返回(文件路径, stat结果)
+
+    每个线程用os.scandir扫描一个目录，子目录放回目录队列由空闲线程继续扫描；
+    stat结果直接取自DirEntry（Windows下无需额外系统调用）。与os.walk相同，
+    不进入指向目录的符号链接。path_filter（PathFilter）按相对于root_dir的路径排除文件，
+    被排除的目录不进入。返回顺序不固定，调用方提前结束迭代时扫描线程随之停止
+    """
+    dir_queue = queue.Queue()
+    results = queue.Queue(maxsize=RESULT_QUEUE_BATCHES)
+    stop_event = threading.Event()
+    done = object()
+    lock = threading.Lock()
+    # 已放入目录队列但尚未扫描完成的目录数，降为0时扫描结束
+    outstanding = [1]
+
+    def put_result(item):
+        while not stop_event.is_set():
+            try:
+                results.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan(directory, relative_dir):
+        batch = []
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    relative_path = None
+                    if path_filter:
+                        relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink() and not (
+                                    relative_path and path_filter.match(relative_path, True)):
+                                subdirs.append((entry.path, relative_path))
+                            continue
+                        if relative_path and path_filter.match(relative_path):
+                            continue
+                        file_stat = entry.stat()
+                    except OSError:
+                        # 失效的符号链接与os.walk一样作为文件返回
+                        try:
+                            file_stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                    batch.append((entry.path, file_stat))
+                    if len(batch) >= RESULT_BATCH:
+                        if not put_result(batch):
+                            return
+                        batch = []
+        except OSError as e:
+            print(f"Error scanning directory {directory}: {e}")
+
+        with lock:
+            outstanding[0] += len(subdirs)
+        for subdir in subdirs:
+            dir_queue.put(subdir)
+        if batch:
+            put_result(batch)
+
+    def worker():
+        while True:
+            item = dir_queue.get()
+            if item is None:
+                return
+            if not stop_event.is_set():
+                scan(*item)
+            with lock:
+                outstanding[0] -= 1
+                finished = outstanding[0] == 0
+            if finished:
+                put_result(done)
+
+    threads = []
+    for _ in range(max(1, max_workers)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    dir_queue.put((root_dir, ''))
+
+    try:
+        while True:
+            batch = results.get()
+            if batch is done:
+                return
+            yield from batch
+    finally:
+        stop_event.set()
+        for _ in threads:
+            dir_queue.put(None)
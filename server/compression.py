@@ -0,0 +1,132 @@
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# 压缩算法编号，写入压缩帧的标志位和数据块中
+CODEC_IDS = {'zlib': 1, 'zstd': 2, 'lz4': 3}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# 已经是压缩格式的文件不再压缩
+COMPRESSED_EXTENSIONS = frozenset([
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar', '.jar', '.whl', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.mp4', '.m4a', '.mkv', '.avi', '.mov',
+    '.webm', '.ogg', '.flac', '.pdf', '.docx', '.xlsx', '.pptx', '.msi', '.cab', '.dmg', '.iso',
+])
+# 压缩后不小于原大小的该比例视为不可压缩
+INCOMPRESSIBLE_RATIO = 0.9
+# 连续多少个数据块不可压缩后，文件剩余部分不再尝试压缩
+INCOMPRESSIBLE_SAMPLES = 2
+# 小于该大小的数据不压缩
+MIN_COMPRESS_SIZE = 512
+
+# 压缩数据流中的块：类型(1字节) 长度(4字节)
+CHUNK_HEADER = struct.Struct('>cI')
+CHUNK_COMPRESSED = b'Z'
+CHUNK_RAW = b'R'
+CHUNK_END = b'E'
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _zstd_decompress(data, max_size):
+    try:
+        # 帧头中记录了原始大小时按该大小一次分配，需要先检查
+        content_size = zstandard.frame_content_size(data)
+        if content_size > max_size:
+            raise ValueError(f"Decompressed data too large: {content_size} > {max_size}")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Invalid zstd data: {e}")
+
+
+def _lz4_decompress(data, max_size):
+    return lz4_frame.LZ4FrameDecompressor().decompress(data, max_length=max_size + 1)
+
+
+def _zlib_decompress(data, max_size):
+    return zlib.decompressobj().decompress(data, max_size + 1)
+
+
+# 可用的压缩算法：名称 -> (压缩函数, 解压函数(数据, 最大解压大小))，按优先顺序排列
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compress, _zstd_decompress)
+if lz4_frame is not None:
+    CODECS['lz4'] = (lz4_frame.compress, _lz4_decompress)
+CODECS['zlib'] = (lambda data: zlib.compress(data, ZLIB_LEVEL), _zlib_decompress)
+
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+
+def parse_codec_list(value):
+    """解析逗号分隔的压缩算法列表，只保留本机可用的算法"""
+    names = [name.strip().lower() for name in (value or '').split(',')]
+    return [name for name in names if name in CODECS]
+
+
+def choose_codec(offered, allowed):
+    """从对方提供的算法中选择本端允许的第一个算法（按本端优先顺序），没有时返回None"""
+    for name in allowed:
+        if name in offered:
+            return name
+    return None
+
+
+def compress(codec, data):
+    return CODECS[codec][0](data)
+
+
+def decompress(codec_id, data, max_size):
+    """按算法编号解压，解压后超过max_size字节时抛出ValueError，不会分配超出上限的内存"""
+    name = CODEC_NAMES.get(codec_id)
+    if name is None or name not in CODECS:
+        raise ValueError(f"Unsupported compression codec: {codec_id}")
+    result = CODECS[name][1](data, max_size)
+    if len(result) > max_size:
+        raise ValueError(f"Decompressed data too large: more than {max_size} bytes")
+    return result
+
+
+def is_compressible_path(path):
+    """按扩展名判断文件是否值得压缩"""
+    return os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+class ChunkCompressor:
+    def __init__(self, codec):
+        """将文件数据块编码为压缩数据流中的块，持续不可压缩时改为原样发送"""
+        self.codec = codec
+        self.poor_samples = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    @property
+    def sampling(self):
+        """是否仍在尝试压缩"""
+        return self.poor_samples < INCOMPRESSIBLE_SAMPLES
+
+    def encode(self, data):
+        """返回编码后的块（含块头）"""
+        self.raw_bytes += len(data)
+        if self.sampling and len(data) >= MIN_COMPRESS_SIZE:
+            compressed = compress(self.codec, data)
+            if len(compressed) < len(data) * INCOMPRESSIBLE_RATIO:
+                self.poor_samples = 0
+                self.wire_bytes += CHUNK_HEADER.size + len(compressed)
+                return CHUNK_HEADER.pack(CHUNK_COMPRESSED, len(compressed)) + compressed
+            self.poor_samples += 1
+        self.wire_bytes += CHUNK_HEADER.size + len(data)
+        return CHUNK_HEADER.pack(CHUNK_RAW, len(data)) + data
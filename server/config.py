@@ -26,6 +26,25 @@ class Config:
             self.monitor_dir = config.get('Server', 'MonitorDir', fallback='D:/source')
             self.bind_ip = config.get('Server', 'BindIP', fallback='0.0.0.0')
             self.port = config.getint('Server', 'Port', fallback=8080)
+            self.batch_latency = config.getint('Server', 'BatchLatency', fallback=50)
+            self.batch_max_size = config.getint('Server', 'BatchMaxSize', fallback=1000)
+            self.debounce_delay = config.getint('Server', 'DebounceDelay', fallback=500)
+            self.debounce_max_delay = config.getint('Server', 'DebounceMaxDelay', fallback=2000)
+            self.monitor_backend = config.get('Server', 'MonitorBackend', fallback='auto')
+            self.poll_interval = config.getint('Server', 'PollInterval', fallback=2000)
+            self.exclude = config.get('Server', 'Exclude', fallback='.*, *.tmp')
+            self.exclude_file = config.get('Server', 'ExcludeFile', fallback='')
+            self.send_queue_limit = config.getint('Server', 'SendQueueLimit', fallback=16777216)
+            self.overflow_policy = config.get('Server', 'OverflowPolicy', fallback='resync')
+            self.journal_dir = config.get('Server', 'JournalDir', fallback='journal')
+            self.journal_segment_size = config.getint('Server', 'JournalSegmentSize', fallback=67108864)
+            self.journal_max_segments = config.getint('Server', 'JournalMaxSegments', fallback=8)
+            self.hash_cache_file = config.get('Server', 'HashCacheFile', fallback='hashcache.db')
+            self.compression = config.get('Server', 'Compression', fallback='zstd,lz4,zlib')
+            self.metrics_bind = config.get('Server', 'MetricsBind', fallback='127.0.0.1')
+            self.metrics_port = config.getint('Server', 'MetricsPort', fallback=0)
+            self.metrics_file = config.get('Server', 'MetricsFile', fallback='')
+            self.metrics_interval = config.getint('Server', 'MetricsInterval', fallback=60)
         except Exception as e:
             print(f"Error loading config: {e}")
             self.set_default_config()
@@ -35,13 +54,51 @@ class Config:
         self.monitor_dir = 'D:/source'
         self.bind_ip = '0.0.0.0'
         self.port = 8080
+        self.batch_latency = 50  # 事件批处理窗口（毫秒）
+        self.batch_max_size = 1000  # 每批最多合并的事件数
+        self.debounce_delay = 500  # 同一文件最后一次变化后等待的安静时间（毫秒）
+        self.debounce_max_delay = 2000  # 持续变化的文件最多等待的时间（毫秒），0表示不限制
+        self.monitor_backend = 'auto'  # 监控后端：auto（Linux上使用inotify，网络文件系统上轮询）、inotify、watchdog 或 polling
+        self.poll_interval = 2000  # 轮询监控的最小扫描间隔（毫秒）
+        self.exclude = '.*, *.tmp'  # gitignore格式的排除规则，逗号分隔，!开头表示重新包含
+        self.exclude_file = ''  # 每行一条排除规则的文件，留空表示不使用
+        self.send_queue_limit = 16777216  # 每个客户端发送队列的最大积压字节数
+        self.overflow_policy = 'resync'  # 发送队列溢出策略：resync（通知客户端重新同步）或 disconnect（断开连接）
+        self.journal_dir = 'journal'  # 事件日志目录，留空表示不记录日志
+        self.journal_segment_size = 67108864  # 每个日志段文件的大小（字节）
+        self.journal_max_segments = 8  # 保留的日志段数量
+        self.hash_cache_file = 'hashcache.db'  # 文件内容哈希缓存数据库，留空表示只缓存在内存中
+        self.compression = 'zstd,lz4,zlib'  # 允许的压缩算法（按优先顺序），留空表示不压缩
+        self.metrics_bind = '127.0.0.1'  # 指标HTTP端点监听的地址
+        self.metrics_port = 0  # 指标HTTP端点的端口，0表示不启用
+        self.metrics_file = ''  # 定期写入指标的JSON文件，留空表示不写入
+        self.metrics_interval = 60  # 写入JSON文件的间隔（秒）
         
         # 保存默认配置到文件
         config = configparser.ConfigParser()
         config['Server'] = {
             'MonitorDir': self.monitor_dir,
             'BindIP': self.bind_ip,
-            'Port': str(self.port)
+            'Port': str(self.port),
+            'BatchLatency': str(self.batch_latency),
+            'BatchMaxSize': str(self.batch_max_size),
+            'DebounceDelay': str(self.debounce_delay),
+            'DebounceMaxDelay': str(self.debounce_max_delay),
+            'MonitorBackend': self.monitor_backend,
+            'PollInterval': str(self.poll_interval),
+            'Exclude': self.exclude,
+            'ExcludeFile': self.exclude_file,
+            'SendQueueLimit': str(self.send_queue_limit),
+            'OverflowPolicy': self.overflow_policy,
+            'JournalDir': self.journal_dir,
+            'JournalSegmentSize': str(self.journal_segment_size),
+            'JournalMaxSegments': str(self.journal_max_segments),
+            'HashCacheFile': self.hash_cache_file,
+            'Compression': self.compression,
+            'MetricsBind': self.metrics_bind,
+            'MetricsPort': str(self.metrics_port),
+            'MetricsFile': self.metrics_file,
+            'MetricsInterval': str(self.metrics_interval)
         }
         
         with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+
+
+class TimerWheel:
+    def __init__(self, tick=0.05, slot_count=256):
+        """哈希时间轮：按到期刻度把键散列到固定数量的槽中
+
+        每个键只登记在一个槽里；槽到期时再检查键的实际到期刻度，
+        尚未到期的键重新散列到对应的槽（惰性重排），因此推迟到期时间是O(1)操作
+        """
+        self.tick = tick
+        self.slot_count = slot_count
+        self.slots = [set() for _ in range(slot_count)]
+        # 键 -> 到期刻度
+        self.deadlines = {}
+        self.start_time = time.monotonic()
+        self.current_tick = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def _now_tick(self):
+        """当前时间对应的刻度"""
+        return int((time.monotonic() - self.start_time) / self.tick)
+
+    def schedule(self, key, delay):
+        """设置键在delay秒后到期，已登记的键只更新到期时间"""
+        deadline = self._now_tick() + max(1, int(delay / self.tick + 0.999))
+        if key not in self.deadlines:
+            self.slots[deadline % self.slot_count].add(key)
+        self.deadlines[key] = deadline
+
+    def cancel(self, key):
+        """取消键的计时，槽中残留的键在到期时被忽略"""
+        self.deadlines.pop(key, None)
+
+    def advance(self):
+        """推进到当前时间，返回已到期的键列表（按到期刻度顺序）"""
+        target = self._now_tick()
+        expired = []
+        # 长时间未推进时最多扫描一整圈
+        first = max(self.current_tick + 1, target - self.slot_count + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % self.slot_count]
+            if not slot:
+                continue
+            self.slots[tick % self.slot_count] = set()
+            for key in slot:
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline <= target:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    self.slots[deadline % self.slot_count].add(key)
+        self.current_tick = max(self.current_tick, target)
+        return expired
+
+    def time_until_next(self):
+        """距下一个刻度的秒数，没有登记的键时返回None"""
+        if not self.deadlines:
+            return None
+        return max(0.0, (self.current_tick + 1) * self.tick - (time.monotonic() - self.start_time))
+
+    def pop_all(self):
+        """取出所有登记的键并清空时间轮"""
+        keys = list(self.deadlines)
+        self.deadlines.clear()
+        self.slots = [set() for _ in range(self.slot_count)]
+        return keys
+
+
+class TrailingDebouncer:
+    def __init__(self, callback, delay=0.5, tick=0.05, max_delay=2.0):
+        """尾沿防抖：同一路径的CREATE/MODIFY在安静delay秒后只转发一次
+
+        持续写入的文件（日志、下载中的文件）从第一个未转发的事件起最多等待max_delay秒就转发一次，
+        不会在写入停止前一直不发送；max_delay为0时不限制
+
+        DELETE/RENAME立即转发，并先处理相关路径（目录事件为整个子树）上尚未转发的事件以保持顺序；
+        事件转发后立即从时间轮中移除，内存占用只与待转发的路径数量有关
+        """
+        self.callback = callback
+        self.delay = delay
+        self.wheel = TimerWheel(tick)
+        # 路径 -> 待转发的事件类型（CREATE或MODIFY）
+        self.pending = {}
+        self.max_delay = max_delay
+        # 路径 -> 第一个未转发事件的时间
+        self.first_seen = {}
+        self.condition = threading.Condition()
+        self.running = False
+        self.timer_thread = None
+
+    def start(self):
+        """启动计时线程"""
+        if self.running:
+            return
+        self.running = True
+        self.timer_thread = threading.Thread(target=self._timer_loop)
+        self.timer_thread.daemon = True
+        self.timer_thread.start()
+
+    def stop(self):
+        """停止计时线程，并立即转发所有待转发的事件"""
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.timer_thread.join()
+
+        with self.condition:
+            for file_path in self.wheel.pop_all():
+                self.callback(self.pending.pop(file_path), file_path)
+            self.pending.clear()
+            self.first_seen.clear()
+
+    def add(self, event_type, file_path, new_file_path=None, is_dir=False):
+        """接收一个文件事件，is_dir表示DELETE/RENAME作用于整个目录"""
+        with self.condition:
+            if event_type in ('CREATE', 'MODIFY'):
+                # CREATE+MODIFY仍为CREATE
+                if self.pending.get(file_path) != 'CREATE':
+                    self.pending[file_path] = event_type
+                was_idle = len(self.wheel) == 0
+                self._schedule(file_path)
+                if was_idle:
+                    self.condition.notify()
+                return
+
+            if is_dir:
+                self._add_directory_event(event_type, file_path, new_file_path)
+                return
+
+            if event_type == 'DELETE':
+                self._cancel(file_path)
+                self.callback(event_type, file_path)
+                return
+
+            if event_type == 'RENAME':
+                # 目标路径被覆盖，其上尚未转发的事件已无意义
+                self._cancel(new_file_path)
+                first_seen = self.first_seen.get(file_path)
+                pending_type = self._cancel(file_path)
+                if pending_type == 'CREATE':
+                    # 客户端尚未得知该文件，直接在新路径上等待创建
+                    self.pending[new_file_path] = 'CREATE'
+                    self._schedule(new_file_path, first_seen)
+                    return
+                self.callback(event_type, file_path, new_file_path)
+                if pending_type == 'MODIFY':
+                    self.pending[new_file_path] = 'MODIFY'
+                    self._schedule(new_file_path, first_seen)
+                return
+
+            self.callback(event_type, file_path, new_file_path)
+
+    def _add_directory_event(self, event_type, dir_path, new_dir_path):
+        """目录删除或重命名：取消目录下尚未转发的事件，重命名时将其移到新目录下继续等待"""
+        moved = {}
+        prefix = os.path.join(dir_path, '')
+        for file_path in [path for path in self.pending if path.startswith(prefix)]:
+            first_seen = self.first_seen.get(file_path)
+            pending_type = self._cancel(file_path)
+            if event_type == 'RENAME':
+                moved[os.path.join(new_dir_path, file_path[len(prefix):])] = (pending_type, first_seen)
+        if event_type == 'RENAME':
+            new_prefix = os.path.join(new_dir_path, '')
+            for file_path in [path for path in self.pending if path.startswith(new_prefix)]:
+                self._cancel(file_path)
+
+        self.callback(event_type, dir_path, new_dir_path, is_dir=True)
+        for file_path, (pending_type, first_seen) in moved.items():
+            self.pending[file_path] = pending_type
+            self._schedule(file_path, first_seen)
+
+    def _schedule(self, file_path, first_seen=None):
+        """推迟路径的转发时间：安静delay秒，但不晚于第一个未转发事件之后max_delay秒
+
+        first_seen为重命名前路径上第一个未转发事件的时间
+        """
+        now = time.monotonic()
+        first_seen = self.first_seen.setdefault(file_path, first_seen or now)
+        delay = self.delay
+        if self.max_delay > 0:
+            delay = max(0.0, min(delay, first_seen + self.max_delay - now))
+        self.wheel.schedule(file_path, delay)
+
+    def _cancel(self, file_path):
+        """取消路径上待转发的事件，返回其事件类型"""
+        self.wheel.cancel(file_path)
+        self.first_seen.pop(file_path, None)
+        return self.pending.pop(file_path, None)
+
+    def _timer_loop(self):
+        """计时线程：按刻度推进时间轮，转发到期的事件"""
+        with self.condition:
+            while self.running:
+                timeout = self.wheel.time_until_next()
+                if timeout is None:
+                    # 没有待转发的事件时不唤醒
+                    self.condition.wait()
+                    continue
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                for file_path in self.wheel.advance():
+                    self.first_seen.pop(file_path, None)
+                    self.callback(self.pending.pop(file_path), file_path)
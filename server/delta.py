@@ -0,0 +1,162 @@
+import bisect
+import hashlib
+import struct
+import zlib
+
+# 每个块签名：4字节弱校验（Adler-32）+ 16字节强校验（BLAKE2b）
+SIGNATURE_FORMAT = '>I16s'
+SIGNATURE_SIZE = struct.calcsize(SIGNATURE_FORMAT)
+
+# 差异指令：C=复制客户端已有的块，L=字面数据，E=结束
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+OP_END = b'E'
+
+# Adler-32的模数
+ADLER_MOD = 65521
+
+# 每次从源文件读取的数据量
+READ_SIZE = 4 * 1024 * 1024
+# 字面数据累积到该大小即发送，避免占用过多内存
+LITERAL_FLUSH_SIZE = 256 * 1024
+# 连续逐字节滚动超过该块数仍无匹配时，改为按块跳跃，避免完全不同的文件在Python层逐字节计算；
+# 每发送一段字面数据后恢复逐字节滚动，插入数据导致块边界错位后仍能重新找到匹配
+MAX_ROLLING_BLOCKS = 16
+
+
+def strong_hash(data):
+    """计算块的强校验值"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def parse_signatures(data, count):
+    """解析客户端发送的块签名，返回{弱校验: {强校验: [块序号, ...]}}，块序号升序"""
+    table = {}
+    for index in range(count):
+        weak, strong = struct.unpack_from(SIGNATURE_FORMAT, data, index * SIGNATURE_SIZE)
+        table.setdefault(weak, {}).setdefault(strong, []).append(index)
+    return table
+
+
+class DeltaGenerator:
+    def __init__(self, block_size, signature_table):
+        """根据客户端的块签名生成差异指令（rsync算法）
+
+        客户端原地打补丁，因此只使用偏移不小于写入位置的块，
+        保证复制时读取的块尚未被覆盖
+        """
+        self.block_size = block_size
+        self.table = signature_table
+        self.output = bytearray()
+        # 已输出的新文件长度，即下一条指令的写入位置
+        self.position = 0
+        self.literal_bytes = 0
+        self.matched_blocks = 0
+
+    def _lookup(self, weak, window, position):
+        """查找与窗口内容相同且可原地复制的客户端块，返回块序号或None"""
+        candidates = self.table.get(weak)
+        if candidates is None:
+            return None
+        indexes = candidates.get(strong_hash(window))
+        if indexes is None:
+            return None
+        # 选择偏移不小于写入位置的第一个块，恰好相同时客户端无需任何I/O
+        first_allowed = -(-position // self.block_size)
+        i = bisect.bisect_left(indexes, first_allowed)
+        return indexes[i] if i < len(indexes) else None
+
+    def _emit_literal(self, data, send):
+        """输出字面数据指令"""
+        if not data:
+            return
+        self.output += OP_LITERAL + struct.pack('>I', len(data))
+        self.output += data
+        self.literal_bytes += len(data)
+        self.position += len(data)
+        self._flush_output(send)
+
+    def _emit_copy(self, index, send):
+        """输出块复制指令"""
+        self.output += OP_COPY + struct.pack('>Q', index)
+        self.matched_blocks += 1
+        self.position += self.block_size
+        self._flush_output(send)
+
+    def _flush_output(self, send, force=False):
+        """批量发送已生成的指令"""
+        if self.output and (force or len(self.output) >= LITERAL_FLUSH_SIZE):
+            send(bytes(self.output))
+            self.output.clear()
+
+    def generate(self, src_file, send):
+        """扫描源文件并通过send发送差异指令"""
+        block_size = self.block_size
+        buffer = bytearray()
+        start = 0           # 当前窗口在缓冲区中的起点
+        literal_start = 0   # 尚未发送的字面数据起点
+        eof = False
+        weak = None
+        a = b = 0
+        rolled = 0          # 当前字面数据段（自上次匹配或发送字面数据以来）逐字节滚动的字节数
+
+        while True:
+            # 保证缓冲区中至少有一个完整窗口加一个字节（用于滚动）
+            if len(buffer) - start <= block_size and not eof:
+                # 丢弃已处理的数据，避免缓冲区无限增长
+                if literal_start > 0:
+                    del buffer[:literal_start]
+                    start -= literal_start
+                    literal_start = 0
+                data = src_file.read(READ_SIZE)
+                if data:
+                    buffer += data
+                else:
+                    eof = True
+                continue
+
+            if len(buffer) - start < block_size:
+                break
+
+            window = memoryview(buffer)[start:start + block_size]
+            if weak is None:
+                weak = zlib.adler32(window)
+                a = weak & 0xffff
+                b = weak >> 16
+
+            index = self._lookup(weak, window, self.position + start - literal_start)
+            window.release()
+            if index is not None:
+                self._emit_literal(bytes(buffer[literal_start:start]), send)
+                self._emit_copy(index, send)
+                start += block_size
+                literal_start = start
+                weak = None
+                rolled = 0
+                continue
+
+            if rolled >= MAX_ROLLING_BLOCKS * block_size:
+                # 按块跳跃：整块作为字面数据，下一个窗口重新计算校验值
+                start += block_size
+                weak = None
+            elif start + block_size < len(buffer):
+                # 滚动更新Adler-32：移出首字节，移入下一个字节
+                out_byte = buffer[start]
+                in_byte = buffer[start + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+                start += 1
+                rolled += 1
+            else:
+                # 已到文件末尾，剩余数据全部作为字面数据
+                break
+
+            if start - literal_start >= LITERAL_FLUSH_SIZE:
+                self._emit_literal(bytes(buffer[literal_start:start]), send)
+                literal_start = start
+                rolled = 0
+
+        self._emit_literal(bytes(buffer[literal_start:]), send)
+        self.output += OP_END
+        self._flush_output(send, force=True)
@@ -0,0 +1,247 @@
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+EVENTS_RECEIVED = REGISTRY.counter('filesync_server_events_received_total',
+                                   'File events received by the batcher (after debounce)', ('type',))
+EVENTS_COALESCED = REGISTRY.counter('filesync_server_events_coalesced_total',
+                                    'File events merged away by batching')
+BATCH_SIZE = REGISTRY.histogram('filesync_server_batch_events', 'Events per broadcast batch',
+                                (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000))
+
+
+class EventBatcher:
+    def __init__(self, callback, max_latency=0.05, max_size=1000):
+        """初始化事件批处理器
+
+        在max_latency秒的窗口内收集事件并按路径合并，窗口到期或事件数达到max_size时
+        以列表形式调用callback([(事件类型, 路径, 新路径, 是否目录), ...])
+        """
+        self.callback = callback
+        self.max_latency = max_latency
+        self.max_size = max_size
+        # 按最终路径记录待发送的事件，保持插入顺序
+        # 值为[事件类型, 路径, 原路径(仅RENAME), 是否在重命名后被修改, 是否目录]
+        self.pending = {}
+        self.batch_start = None
+        # 已封装、等待后台线程发送的批次，保证回调按顺序在同一线程中执行
+        self.ready_batches = []
+        self.received_count = 0
+        self.emitted_count = 0
+        # 当前批次收到的事件数，用于统计被合并掉的事件
+        self.batch_received = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.flush_thread = None
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self.running:
+            return
+        self.running = True
+        self.flush_thread = threading.Thread(target=self._flush_loop)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def stop(self):
+        """停止后台线程并发送剩余事件"""
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.flush_thread.join()
+
+        with self.condition:
+            self._seal_batch_locked()
+            batches = self.ready_batches
+            self.ready_batches = []
+        for events in batches:
+            self.callback(events)
+
+    def add(self, event_type, file_path, new_file_path=None, is_dir=False):
+        """添加一个事件并与同一路径上的待发送事件合并，is_dir表示DELETE/RENAME作用于整个目录"""
+        EVENTS_RECEIVED.inc(type=event_type)
+        with self.condition:
+            self.received_count += 1
+            self.batch_received += 1
+
+            # 目录事件不与同一路径上的其他事件合并，先发送已有事件
+            entries = [self.pending[path] for path in (file_path, new_file_path) if path in self.pending]
+            if entries and (is_dir or any(entry[4] for entry in entries)):
+                self._seal_batch_locked()
+
+            if is_dir:
+                self._add_directory_event(event_type, file_path, new_file_path)
+            elif event_type == 'RENAME':
+                self._add_rename(file_path, new_file_path)
+            elif event_type == 'DELETE':
+                self._add_delete(file_path)
+            else:
+                self._add_content_change(event_type, file_path)
+
+            # 批次的第一个事件开始计时
+            if self.pending and self.batch_start is None:
+                self.batch_start = time.monotonic()
+                self.condition.notify()
+            elif len(self.pending) >= self.max_size:
+                self.condition.notify()
+
+    def add_rescan(self, directories):
+        """监控后端丢失了事件，请求重新扫描这些目录：先发送已收集的事件，再单独发送一批RESCAN"""
+        with self.condition:
+            self._seal_batch_locked()
+            self.ready_batches.append([('RESCAN', directory, None, True) for directory in directories])
+            self.condition.notify()
+
+    def _add_content_change(self, event_type, file_path):
+        """合并CREATE/MODIFY事件"""
+        entry = self.pending.get(file_path)
+        if entry is None:
+            self.pending[file_path] = [event_type, file_path, None, False, False]
+        elif entry[0] == 'DELETE':
+            # 删除后重新创建，等同于内容被替换
+            entry[0] = 'MODIFY'
+        elif entry[0] == 'RENAME':
+            entry[3] = True
+        # CREATE+MODIFY→CREATE，MODIFY+MODIFY→MODIFY，无需处理
+
+    def _add_delete(self, file_path):
+        """合并DELETE事件"""
+        entry = self.pending.get(file_path)
+        if entry is None:
+            self.pending[file_path] = ['DELETE', file_path, None, False, False]
+        elif entry[0] == 'CREATE':
+            # CREATE+DELETE→无事件
+            del self.pending[file_path]
+        elif entry[0] == 'RENAME':
+            # 重命名后被删除，等同于删除原路径
+            old_path = entry[2]
+            if old_path in self.pending:
+                # 原路径已被重新使用，无法安全合并，先发送已有事件
+                self._seal_batch_locked()
+                self.pending[file_path] = ['DELETE', file_path, None, False, False]
+            else:
+                del self.pending[file_path]
+                self.pending[old_path] = ['DELETE', old_path, None, False, False]
+        else:
+            entry[0] = 'DELETE'
+
+    def _add_rename(self, old_path, new_path):
+        """合并RENAME事件，连续的重命名折叠为一次"""
+        source = self.pending.get(old_path)
+        target = self.pending.get(new_path)
+
+        # 目标路径上有未完成的重命名，或重命名链的起点已被重新使用时，合并可能打乱顺序
+        if (target is not None and target[0] == 'RENAME') or \
+                (source is not None and source[0] == 'RENAME' and source[2] in self.pending):
+            self._seal_batch_locked()
+            source = target = None
+
+        if target is not None:
+            # 目标文件被覆盖，其上的待发送事件已无意义
+            del self.pending[new_path]
+
+        if source is None or source[0] == 'DELETE':
+            self.pending[new_path] = ['RENAME', new_path, old_path, False, False]
+            return
+
+        del self.pending[old_path]
+        if source[0] == 'CREATE':
+            # 新建后重命名，等同于在新路径创建
+            self.pending[new_path] = ['CREATE', new_path, None, False, False]
+        elif source[0] == 'MODIFY':
+            self.pending[new_path] = ['RENAME', new_path, old_path, True, False]
+        elif source[2] == new_path:
+            # 改名后又改回原名
+            if source[3]:
+                self.pending[new_path] = ['MODIFY', new_path, None, False, False]
+        else:
+            # RENAME x→a + RENAME a→b → RENAME x→b
+            self.pending[new_path] = ['RENAME', new_path, source[2], source[3], False]
+
+    def _add_directory_event(self, event_type, dir_path, new_dir_path):
+        """目录删除：丢弃目录下待发送的删除和内容变化事件（如递归删除时先于目录到达的逐个文件删除）；
+        目录重命名：目录下待发送的内容变化改用新路径并在重命名之后发送，客户端按新路径获取文件；
+        删除、重命名和子目录事件作用于重命名之前的状态，仍使用原路径在其之前发送"""
+        if event_type == 'DELETE':
+            prefix = os.path.join(dir_path, '')
+            for file_path in [path for path in self.pending if path.startswith(prefix)]:
+                entry = self.pending[file_path]
+                if entry[0] == 'RENAME' and not entry[2].startswith(prefix):
+                    # 从目录外移入后随目录一起删除，等同于删除原路径；原路径已被重新使用时保留重命名
+                    if entry[2] in self.pending:
+                        continue
+                    self.pending[entry[2]] = ['DELETE', entry[2], None, False, entry[4]]
+                del self.pending[file_path]
+            self.pending[dir_path] = ['DELETE', dir_path, None, False, True]
+        else:
+            prefix = os.path.join(dir_path, '')
+            if any(new_dir_path + path[len(dir_path):] in self.pending
+                   for path in self.pending if path.startswith(prefix)):
+                # 新路径上已有待发送的事件，无法安全合并，先发送已有事件
+                self._seal_batch_locked()
+            moved = []
+            for file_path in [path for path in self.pending if path.startswith(prefix)]:
+                entry = self.pending[file_path]
+                if entry[4]:
+                    continue
+                moved_path = new_dir_path + file_path[len(dir_path):]
+                if entry[0] in ('CREATE', 'MODIFY'):
+                    del self.pending[file_path]
+                    moved.append([entry[0], moved_path, None, False, False])
+                elif entry[0] == 'RENAME' and entry[3]:
+                    # 重命名保留在原位置，重命名后的修改随目录移到新路径
+                    entry[3] = False
+                    moved.append(['MODIFY', moved_path, None, False, False])
+            self.pending[new_dir_path] = ['RENAME', new_dir_path, dir_path, False, True]
+            for entry in moved:
+                self.pending[entry[1]] = entry
+
+    def _seal_batch_locked(self):
+        """将当前批次展开为事件列表并放入待发送队列"""
+        events = []
+        for event_type, file_path, old_path, modified, is_dir in self.pending.values():
+            if event_type == 'RENAME':
+                events.append(('RENAME', old_path, file_path, is_dir))
+                if modified:
+                    events.append(('MODIFY', file_path, None, False))
+            else:
+                events.append((event_type, file_path, None, is_dir))
+        self.pending = {}
+        self.batch_start = None
+        if self.batch_received > len(events):
+            EVENTS_COALESCED.inc(self.batch_received - len(events))
+        self.batch_received = 0
+        if events:
+            BATCH_SIZE.observe(len(events))
+            self.emitted_count += len(events)
+            self.ready_batches.append(events)
+            self.condition.notify()
+
+    def _flush_loop(self):
+        """后台线程：批次窗口到期或达到最大数量时发送"""
+        while True:
+            with self.condition:
+                while self.running and not self.ready_batches:
+                    if self.batch_start is None:
+                        self.condition.wait()
+                        continue
+
+                    remaining = self.batch_start + self.max_latency - time.monotonic()
+                    if remaining > 0 and len(self.pending) < self.max_size:
+                        self.condition.wait(remaining)
+                        continue
+
+                    self._seal_batch_locked()
+
+                if not self.running:
+                    return
+                batches = self.ready_batches
+                self.ready_batches = []
+
+            # 在锁外执行回调，避免广播阻塞事件的接收
+            for events in batches:
+                self.callback(events)
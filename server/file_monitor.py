@@ -1,13 +1,51 @@
 import os
-import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from debouncer import TrailingDebouncer
+from event_batcher import EventBatcher
+from inotify_monitor import INOTIFY_SUPPORTED, InotifyWatcher
+from path_filter import DEFAULT_EXCLUDE, PathFilter
+from polling_monitor import PollingWatcher, filesystem_type, is_network_filesystem
+
+# 监控后端：auto（Linux上使用inotify，网络文件系统上轮询，其他系统使用watchdog）、inotify、watchdog、polling
+MONITOR_BACKENDS = ('auto', 'inotify', 'watchdog', 'polling')
+
+
 class FileMonitor:
-    def __init__(self, monitor_dir, event_callback):
-        """初始化文件监控器"""
+    def __init__(self, monitor_dir, event_callback, batch_latency=0.05, batch_max_size=1000,
+                 debounce_delay=0.5, backend='auto', poll_interval=2.0, path_filter=None,
+                 debounce_max_delay=2.0):
+        """初始化文件监控器
+        
+        事件经过尾沿防抖和批处理合并后以列表形式回调：
+        event_callback([(事件类型, 路径, 新路径, 是否目录), ...])；
+        监控后端丢失事件时（inotify队列溢出）回调一批[('RESCAN', 目录, None, True), ...]。
+        path_filter（PathFilter）排除的文件不产生事件，被排除的目录不监控；未提供时使用默认规则；
+        持续变化的文件最多每debounce_max_delay秒发送一次
+        """
         self.monitor_dir = monitor_dir
+        if path_filter is None:
+            path_filter = PathFilter(DEFAULT_EXCLUDE.split(','), monitor_dir)
+        self.path_filter = path_filter
         self.event_callback = event_callback
+        if backend not in MONITOR_BACKENDS:
+            print(f"Unknown monitor backend {backend!r}, using auto")
+            backend = 'auto'
+        if backend == 'auto':
+            if is_network_filesystem(monitor_dir):
+                # NFS/CIFS等文件系统上其他客户端的修改不会产生inotify事件
+                print(f"{monitor_dir} is on {filesystem_type(monitor_dir)}, using polling monitor")
+                backend = 'polling'
+            else:
+                backend = 'inotify' if INOTIFY_SUPPORTED else 'watchdog'
+        elif backend == 'inotify' and not INOTIFY_SUPPORTED:
+            print("inotify is not available on this system, using watchdog")
+            backend = 'watchdog'
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.batcher = EventBatcher(event_callback, batch_latency, batch_max_size)
+        self.debouncer = TrailingDebouncer(self.batcher.add, debounce_delay, max_delay=debounce_max_delay)
         self.observer = None
         self.running = False
     
@@ -16,15 +54,35 @@ class FileMonitor:
         if self.running:
             return
         
-        # 创建事件处理器
-        event_handler = FileMonitorHandler(self.event_callback, self.monitor_dir)
+        # 启动批处理器和防抖器
+        self.batcher.start()
+        self.debouncer.start()
+        
+        if self.backend == 'polling':
+            self.observer = PollingWatcher(self.monitor_dir, self.debouncer.add, self.path_filter.is_ignored,
+                                           self.poll_interval)
+            self.observer.start()
+        
+        if self.backend == 'inotify':
+            self.observer = InotifyWatcher(self.monitor_dir, self.debouncer.add, self.batcher.add_rescan,
+                                           self.path_filter.is_ignored)
+            try:
+                self.observer.start()
+            except OSError as e:
+                print(f"Failed to start inotify monitor, using watchdog: {e}")
+                self.observer.join()
+                self.backend = 'watchdog'
         
-        # 创建并启动观察者
-        self.observer = Observer()
-        self.observer.schedule(event_handler, self.monitor_dir, recursive=True)
-        self.observer.start()
+        if self.backend == 'watchdog':
+            # 创建事件处理器
+            event_handler = FileMonitorHandler(self.debouncer.add, self.monitor_dir, self.path_filter.is_ignored)
+            
+            # 创建并启动观察者
+            self.observer = Observer()
+            self.observer.schedule(event_handler, self.monitor_dir, recursive=True)
+            self.observer.start()
         self.running = True
-        print(f"File monitor started on {self.monitor_dir}")
+        print(f"File monitor started on {self.monitor_dir} ({self.backend})")
     
     def stop(self):
         """停止文件监控"""
@@ -34,32 +92,44 @@ class FileMonitor:
         self.running = False
         self.observer.stop()
         self.observer.join()
+        self.debouncer.stop()
+        self.batcher.stop()
         print("File monitor stopped")
 
 class FileMonitorHandler(FileSystemEventHandler):
-    def __init__(self, callback, root_dir):
-        """初始化事件处理器"""
+    def __init__(self, callback, root_dir, is_ignored):
+        """初始化事件处理器，is_ignored(路径, is_dir)判断路径是否被排除"""
         self.callback = callback
         self.root_dir = root_dir
-        self.last_event_time = {}
+        self.is_ignored = is_ignored
+        # 最近一次目录重命名(原路径, 新路径)，用于丢弃随后为其中每个文件生成的重命名事件
+        self.moved_dir = None
     
     def on_any_event(self, event):
         """处理所有文件系统事件"""
-        # 忽略目录事件
-        if event.is_directory:
+        # 忽略opened/closed等不涉及内容变化的事件
+        if event.event_type not in ('created', 'modified', 'deleted', 'moved'):
             return
         
-        # 忽略临时文件和隐藏文件
-        filename = os.path.basename(event.src_path)
-        if filename.startswith('.') or filename.endswith('.tmp'):
+        if event.event_type == 'moved' and self._is_sub_move(event.src_path, event.dest_path):
+            # 目录重命名已作为一个子树事件发送，其中各文件和子目录的重命名事件是多余的
             return
         
-        # 防抖处理：同一文件短时间内的多次事件只处理一次
-        current_time = time.time()
-        if event.src_path in self.last_event_time:
-            if current_time - self.last_event_time[event.src_path] < 0.5:
-                return
-        self.last_event_time[event.src_path] = current_time
+        # 目录的创建和修改不需要同步，其中的文件有各自的事件
+        if event.is_directory and event.event_type in ('created', 'modified'):
+            return
+        self.moved_dir = None
+        
+        if event.is_directory:
+            self._on_directory_event(event)
+            return
+        
+        # 忽略被排除的文件（默认为临时文件和隐藏文件）
+        if self._is_ignored(event.src_path):
+            # 编辑器常先写临时文件再重命名为目标文件，此时等同于目标文件被创建
+            if event.event_type == 'moved' and not self._is_ignored(event.dest_path):
+                self.callback('CREATE', event.dest_path)
+            return
         
         # 处理不同类型的事件
         event_type = ''
@@ -71,11 +141,48 @@ class FileMonitorHandler(FileSystemEventHandler):
         elif event.event_type == 'deleted':
             event_type = 'DELETE'
         elif event.event_type == 'moved':
-            event_type = 'RENAME'
             old_path = event.src_path
             new_path = event.dest_path
+            if self._is_ignored(new_path):
+                # 重命名为临时文件或隐藏文件，等同于删除
+                self.callback('DELETE', old_path)
+                return
+            event_type = 'RENAME'
             self.callback(event_type, old_path, new_path)
             return
         
         # 发送事件通知
         self.callback(event_type, event.src_path)
+    
+    def _on_directory_event(self, event):
+        """目录被删除或重命名时发送一个作用于整个子树的事件，客户端一次完成删除或重命名"""
+        if os.path.normpath(event.src_path) == os.path.normpath(self.root_dir):
+            return
+        if event.event_type == 'deleted':
+            if not self._is_ignored(event.src_path, True):
+                self.callback('DELETE', event.src_path, is_dir=True)
+            return
+        
+        old_path = event.src_path
+        new_path = event.dest_path
+        if self._is_ignored(old_path, True):
+            # 从被排除的目录移入：其中的文件随后作为各自的事件到达
+            return
+        if self._is_ignored(new_path, True):
+            # 重命名为被排除的目录，等同于删除
+            self.callback('DELETE', old_path, is_dir=True)
+        else:
+            self.callback('RENAME', old_path, new_path, is_dir=True)
+        self.moved_dir = (old_path, new_path)
+    
+    def _is_sub_move(self, old_path, new_path):
+        """是否为最近一次目录重命名中某个子路径的重命名"""
+        if self.moved_dir is None:
+            return False
+        old_dir, new_dir = self.moved_dir
+        old_prefix = os.path.join(old_dir, '')
+        return old_path.startswith(old_prefix) and new_path == os.path.join(new_dir, old_path[len(old_prefix):])
+    
+    def _is_ignored(self, file_path, is_dir=False):
+        """检查路径是否被排除规则排除"""
+        return self.is_ignored(file_path, is_dir)
@@ -0,0 +1,279 @@
+import os
+import urllib.parse
+
+from compression import CHUNK_END, CHUNK_HEADER, CHUNK_RAW, ChunkCompressor, choose_codec, is_compressible_path
+from delta import SIGNATURE_SIZE, DeltaGenerator, parse_signatures
+from metrics import REGISTRY
+
+# 数据通道每次发送的块大小
+CHUNK_SIZE = 256 * 1024
+# 压缩数据流中原样发送的单个块的最大长度
+MAX_RAW_CHUNK = 1024 * 1024 * 1024
+# 不小于该大小的文件压缩发送后显示压缩效果
+COMPRESS_REPORT_SIZE = 1024 * 1024
+# 差异传输允许的块大小范围
+MIN_DELTA_BLOCK_SIZE = 512
+MAX_DELTA_BLOCK_SIZE = 16 * 1024 * 1024
+# 差异传输请求中块签名的最大数量（签名数据约80MB），客户端按文件大小的平方根选择块大小，
+# 块大小上限为1MB时可覆盖4TB的文件
+MAX_DELTA_BLOCKS = 4 * 1024 * 1024
+# 已知的数据请求类型，其他请求按unknown统计
+DATA_COMMANDS = ('FETCH', 'DELTA', 'TREE', 'COMPRESS', 'HASH')
+
+DATA_REQUESTS = REGISTRY.counter('filesync_server_data_requests_total', 'Data channel requests', ('request',))
+DATA_BYTES_SENT = REGISTRY.counter('filesync_server_data_bytes_sent_total',
+                                   'File payload bytes sent on data connections', ('encoding',))
+DEDUP_SKIPS = REGISTRY.counter('filesync_server_dedup_skipped_bytes_total',
+                               'File bytes not sent because the client had the content')
+
+
+class FileProvider:
+    def __init__(self, root_dir, chunk_size=CHUNK_SIZE, tree=None, hash_cache=None, codecs=None):
+        """初始化文件内容提供者：通过TCP数据通道向客户端发送监控目录中的文件
+
+        tree为MerkleTree实例时支持TREE请求，客户端据此只对比摘要不同的子树；
+        hash_cache为HashCache实例时支持HASH请求，供客户端校验模式比较文件内容；
+        codecs为允许的压缩算法列表（按优先顺序），客户端通过COMPRESS请求为每个数据连接协商
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.real_root_dir = os.path.realpath(root_dir)
+        self.chunk_size = chunk_size
+        self.tree = tree
+        self.hash_cache = hash_cache
+        self.codecs = codecs or []
+
+    def resolve_path(self, relative_path):
+        """将客户端请求的相对路径解析为监控目录下的绝对路径，拒绝越界访问
+
+        按解析符号链接后的真实路径检查，监控目录中指向外部的符号链接不能用于读取外部文件
+        """
+        relative_path = relative_path.replace('\\', '/').lstrip('/')
+        full_path = os.path.realpath(os.path.join(self.root_dir, relative_path))
+        try:
+            if os.path.commonpath([self.real_root_dir, full_path]) != self.real_root_dir:
+                return None
+        except ValueError:
+            # Windows下不同盘符无法比较
+            return None
+        return full_path
+
+    def _send_error(self, stream, reason):
+        """发送错误响应"""
+        encoded_reason = urllib.parse.quote(str(reason), safe='')
+        stream.sendall(f"ERROR|{encoded_reason}\n".encode('utf-8'))
+
+    def handle_connection(self, stream, first_line):
+        """处理一个数据连接上的所有请求，直到客户端断开"""
+        line = first_line
+        while line is not None:
+            if not self.handle_request(stream, line):
+                break
+            line = stream.readline()
+
+    def handle_request(self, stream, line):
+        """处理单条数据请求，返回False表示连接已不可用"""
+        parts = line.split('|')
+        command = parts[0]
+        DATA_REQUESTS.inc(request=command if command in DATA_COMMANDS else 'unknown')
+
+        if command == 'FETCH' and len(parts) >= 2:
+            relative_path = urllib.parse.unquote(parts[1])
+            dedup_min_size = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else None
+            return self._send_file(stream, relative_path, dedup_min_size)
+
+        if command == 'DELTA' and len(parts) >= 4:
+            relative_path = urllib.parse.unquote(parts[1])
+            try:
+                block_size, count = int(parts[2]), int(parts[3])
+            except ValueError:
+                # 块数未知时无法跳过随后的签名数据，只能关闭连接
+                self._send_error(stream, f"Invalid delta request: {parts[2]}|{parts[3]}")
+                return False
+            return self._send_delta(stream, relative_path, block_size, count)
+
+        if command == 'TREE' and len(parts) >= 2 and self.tree is not None:
+            relative_path = urllib.parse.unquote(parts[1]).replace('\\', '/').strip('/')
+            return self._send_tree(stream, relative_path)
+
+        if command == 'COMPRESS' and len(parts) >= 2:
+            stream.codec = choose_codec(parts[1].split(','), self.codecs)
+            stream.sendall(f"COMPRESS|{stream.codec or 'none'}\n".encode('utf-8'))
+            return True
+
+        if command == 'HASH' and len(parts) >= 2 and self.hash_cache is not None:
+            relative_path = urllib.parse.unquote(parts[1])
+            return self._send_hash(stream, relative_path)
+
+        self._send_error(stream, f"Unknown request: {command}")
+        return True
+
+    def _open_file(self, stream, relative_path):
+        """打开请求的文件，失败时发送错误响应并返回(None, None)"""
+        full_path = self.resolve_path(relative_path)
+        if full_path is None:
+            self._send_error(stream, f"Invalid path: {relative_path}")
+            return None, None
+
+        try:
+            src_file = open(full_path, 'rb')
+        except FileNotFoundError:
+            self._send_error(stream, f"File not found: {relative_path}")
+            return None, None
+        except OSError as e:
+            self._send_error(stream, e)
+            return None, None
+
+        try:
+            return src_file, os.fstat(src_file.fileno())
+        except OSError as e:
+            src_file.close()
+            self._send_error(stream, e)
+            return None, None
+
+    def _send_file(self, stream, relative_path, dedup_min_size=None):
+        """发送文件内容：先发送DATA|大小|修改时间头，再发送原始字节
+
+        客户端请求去重且文件不小于dedup_min_size时，先发送HASH|大小|修改时间|哈希，
+        客户端已有相同内容时回复SKIP，否则回复SEND后再发送文件内容
+        """
+        src_file, file_stat = self._open_file(stream, relative_path)
+        if src_file is None:
+            return True
+
+        with src_file:
+            file_size = file_stat.st_size
+            if dedup_min_size is not None and self.hash_cache is not None and file_size >= dedup_min_size:
+                file_hash = self.hash_cache.get_hash(src_file.name, file_stat)
+                if file_hash is not None:
+                    stream.sendall(f"HASH|{file_size}|{file_stat.st_mtime_ns}|{file_hash}\n".encode('utf-8'))
+                    reply = stream.readline()
+                    if reply is None:
+                        return False
+                    if reply.strip() == 'SKIP':
+                        DEDUP_SKIPS.inc(file_size)
+                        return True
+            if stream.codec is not None and file_size > 0 and is_compressible_path(relative_path):
+                return self._send_compressed(stream, relative_path, src_file, file_stat)
+
+            stream.sendall(f"DATA|{file_size}|{file_stat.st_mtime_ns}\n".encode('utf-8'))
+
+            # 优先使用socket.sendfile（Linux下为零拷贝），不足时自动回退到普通发送
+            sent = stream.sock.sendfile(src_file, 0, file_size) if file_size > 0 else 0
+            if sent != file_size:
+                # 文件在发送过程中被截断，客户端收不到完整数据，只能断开连接
+                print(f"File changed during transfer, closing data connection: {src_file.name}")
+                return False
+            DATA_BYTES_SENT.inc(sent, encoding='raw')
+        return True
+
+    def _send_compressed(self, stream, relative_path, src_file, file_stat):
+        """发送压缩的文件内容：CDATA|大小|修改时间|算法头，随后是数据块流
+
+        每块为Z+4字节长度+压缩数据或R+4字节长度+原始数据，以E+4字节0结束；
+        连续几块压缩无效后，剩余部分作为原始块零拷贝发送
+        """
+        file_size = file_stat.st_size
+        stream.sendall(f"CDATA|{file_size}|{file_stat.st_mtime_ns}|{stream.codec}\n".encode('utf-8'))
+        compressor = ChunkCompressor(stream.codec)
+        offset = 0
+        while offset < file_size:
+            if compressor.sampling:
+                data = src_file.read(min(self.chunk_size, file_size - offset))
+                if data:
+                    stream.sendall(compressor.encode(data))
+                count = sent = len(data)
+            else:
+                count = min(file_size - offset, MAX_RAW_CHUNK)
+                stream.sendall(CHUNK_HEADER.pack(CHUNK_RAW, count))
+                sent = stream.sock.sendfile(src_file, offset, count)
+                compressor.raw_bytes += sent
+                compressor.wire_bytes += CHUNK_HEADER.size + sent
+            if not sent or sent != count:
+                # 文件在发送过程中被截断，客户端收不到完整数据，只能断开连接
+                print(f"File changed during transfer, closing data connection: {src_file.name}")
+                return False
+            offset += sent
+        stream.sendall(CHUNK_HEADER.pack(CHUNK_END, 0))
+        DATA_BYTES_SENT.inc(compressor.wire_bytes, encoding='compressed')
+        if file_size >= COMPRESS_REPORT_SIZE:
+            print(f"Compressed {relative_path} with {stream.codec}: "
+                  f"{compressor.raw_bytes/1024/1024:.1f}MB -> {compressor.wire_bytes/1024/1024:.1f}MB")
+        return True
+
+    def _send_delta(self, stream, relative_path, block_size, count):
+        """根据客户端的块签名发送差异指令：DELTA|大小|修改时间头，随后是指令流"""
+        # 块数由客户端提供，读取签名数据前先检查，避免异常请求导致分配任意大小的内存；
+        # 签名数据未读取时连接上的数据边界已无法恢复，只能关闭连接
+        if not 0 <= count <= MAX_DELTA_BLOCKS:
+            self._send_error(stream, f"Invalid block count: {count}")
+            return False
+
+        # 无论块大小是否有效，都必须先读完签名数据，保持连接上的数据边界
+        signature_data = stream.read_exact(count * SIGNATURE_SIZE)
+        if signature_data is None:
+            return False
+
+        if not MIN_DELTA_BLOCK_SIZE <= block_size <= MAX_DELTA_BLOCK_SIZE:
+            self._send_error(stream, f"Invalid block size: {block_size}")
+            return True
+
+        src_file, file_stat = self._open_file(stream, relative_path)
+        if src_file is None:
+            return True
+
+        with src_file:
+            stream.sendall(f"DELTA|{file_stat.st_size}|{file_stat.st_mtime_ns}\n".encode('utf-8'))
+            generator = DeltaGenerator(block_size, parse_signatures(signature_data, count))
+            generator.generate(src_file, stream.sendall)
+        DATA_BYTES_SENT.inc(generator.literal_bytes, encoding='delta')
+
+        print(f"Delta sent for {relative_path}: {generator.matched_blocks} blocks matched, "
+              f"{generator.literal_bytes} literal bytes")
+        return True
+
+    def _send_hash(self, stream, relative_path):
+        """发送文件内容的哈希：HASH|大小|修改时间(纳秒)|哈希，文件未变化时使用缓存的结果"""
+        full_path = self.resolve_path(relative_path)
+        if full_path is None:
+            self._send_error(stream, f"Invalid path: {relative_path}")
+            return True
+
+        try:
+            file_stat = os.stat(full_path)
+        except FileNotFoundError:
+            self._send_error(stream, f"File not found: {relative_path}")
+            return True
+        except OSError as e:
+            self._send_error(stream, e)
+            return True
+
+        file_hash = self.hash_cache.get_hash(full_path, file_stat)
+        if file_hash is None:
+            self._send_error(stream, f"File changed while hashing: {relative_path}")
+            return True
+        stream.sendall(f"HASH|{file_stat.st_size}|{file_stat.st_mtime_ns}|{file_hash}\n".encode('utf-8'))
+        return True
+
+    def _send_tree(self, stream, relative_dir):
+        """发送目录摘要及其直接包含的文件和子目录
+
+        TREE|摘要|文件数|子目录数头之后，每个文件一行F|大小|修改时间|名称，
+        每个非空子目录一行D|摘要|名称；目录不存在或子树没有文件时摘要为-
+        """
+        if self.resolve_path(relative_dir) is None:
+            self._send_error(stream, f"Invalid path: {relative_dir}")
+            return True
+
+        listing = self.tree.list_dir(relative_dir)
+        if listing is None:
+            self._send_error(stream, "Tree not ready")
+            return True
+
+        digest, files, subdirs = listing
+        lines = [f"TREE|{digest.hex() if digest else '-'}|{len(files)}|{len(subdirs)}\n"]
+        for name, size, mtime_ns in files:
+            lines.append(f"F|{size}|{mtime_ns}|{urllib.parse.quote(name, safe='')}\n")
+        for name, subdir_digest in subdirs:
+            lines.append(f"D|{subdir_digest.hex()}|{urllib.parse.quote(name, safe='')}\n")
+        stream.sendall(''.join(lines).encode('utf-8', 'surrogateescape'))
+        return True
@@ -0,0 +1,154 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import REGISTRY
+
+# 内容哈希：BLAKE2b-128，服务端和客户端使用相同的算法
+HASH_DIGEST_SIZE = 16
+READ_BUFFER_SIZE = 1024 * 1024
+# 不小于该大小的文件通过mmap读取，每次交给哈希函数MMAP_CHUNK字节（期间释放GIL）
+MMAP_THRESHOLD = 4 * 1024 * 1024
+MMAP_CHUNK = 16 * 1024 * 1024
+# 不小于该大小的文件交给进程池计算，多个大文件可同时使用多个CPU核心
+PROCESS_POOL_THRESHOLD = 64 * 1024 * 1024
+# 累计多少次写入或多少秒后提交一次事务
+COMMIT_BATCH = 1000
+COMMIT_INTERVAL = 2.0
+
+LOOKUPS = REGISTRY.counter('filesync_hash_cache_lookups_total', 'Content hash cache lookups', ('result',))
+
+
+def hash_file(path):
+    """计算文件内容的哈希（十六进制字符串）"""
+    digest = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), MMAP_CHUNK):
+                        digest.update(view[offset:offset + MMAP_CHUNK])
+                finally:
+                    view.release()
+        else:
+            while True:
+                data = f.read(READ_BUFFER_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+    return digest.hexdigest()
+
+
+class HashCache:
+    def __init__(self, db_path=None, process_workers=None):
+        """文件内容哈希缓存：以(设备, inode, 大小, 修改时间)为键保存哈希
+
+        文件未变化时直接返回缓存的哈希，不再读取内容。同时校验状态变更时间(ctime)，
+        修改内容后又恢复修改时间的文件也会重新计算；db_path为空时只缓存在内存中。
+        大文件在进程池中计算，process_workers为进程数（默认为CPU核心数）
+        """
+        self.db_path = db_path or ':memory:'
+        self.process_workers = process_workers
+        self.process_pool = None
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        if db_path:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        # 每个文件(设备, inode)只保留最新的一条记录
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dev INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, ctime_ns INTEGER NOT NULL, hash TEXT NOT NULL, "
+            "PRIMARY KEY (dev, inode))")
+        self.connection.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, file_stat):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM hashes WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?",
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns,
+                 file_stat.st_ctime_ns)).fetchone()
+            if row is None:
+                self.misses += 1
+                LOOKUPS.inc(result='miss')
+                return None
+            self.hits += 1
+            LOOKUPS.inc(result='hit')
+            return row[0]
+
+    def put(self, file_stat, file_hash):
+        """记录文件当前状态对应的哈希"""
+        if not file_stat.st_ino:
+            # 文件系统不提供inode时无法可靠地识别文件，不缓存
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes (dev, inode, size, mtime_ns, ctime_ns, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns,
+                 file_stat.st_ctime_ns, file_hash))
+            self.pending_writes += 1
+            if self.pending_writes >= COMMIT_BATCH or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+                self._commit_locked()
+
+    def _compute(self, path, size):
+        """计算哈希，大文件交给进程池"""
+        if size >= PROCESS_POOL_THRESHOLD:
+            with self.lock:
+                if self.process_pool is None:
+                    # 进程中有多个线程和打开的数据库连接，不能fork；不支持forkserver的平台使用spawn
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self.process_pool = ProcessPoolExecutor(max_workers=self.process_workers,
+                                                            mp_context=multiprocessing.get_context(method))
+                process_pool = self.process_pool
+            return process_pool.submit(hash_file, path).result()
+        return hash_file(path)
+
+    def get_hash(self, path, file_stat=None):
+        """返回文件内容的哈希，文件无法读取或计算期间被修改时返回None"""
+        try:
+            if file_stat is None:
+                file_stat = os.stat(path)
+            if file_stat.st_ino:
+                cached = self._lookup(file_stat)
+                if cached is not None:
+                    return cached
+            file_hash = self._compute(path, file_stat.st_size)
+            current_stat = os.stat(path)
+        except OSError as e:
+            print(f"Error hashing {path}: {e}")
+            return None
+        if (current_stat.st_size, current_stat.st_mtime_ns) != (file_stat.st_size, file_stat.st_mtime_ns):
+            return None
+        self.put(current_stat, file_hash)
+        return file_hash
+
+    def _commit_locked(self):
+        self.connection.commit()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        """提交尚未提交的记录"""
+        with self.lock:
+            if self.pending_writes:
+                self._commit_locked()
+
+    def close(self):
+        """提交并关闭数据库，停止进程池"""
+        with self.lock:
+            self._commit_locked()
+            self.connection.close()
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+                self.process_pool = None
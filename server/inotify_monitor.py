@@ -0,0 +1,366 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+from polling_monitor import PollingWatcher
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# 每个目录关注的事件：不跟随符号链接，已删除但仍打开的文件不再产生事件
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# inotify_event头：wd mask cookie len，随后是len字节以\0填充的文件名
+EVENT_HEADER = struct.Struct('iIII')
+# 一次读取的缓冲区大小，内核在其中放入尽可能多的完整事件
+READ_BUFFER_SIZE = 256 * 1024
+# MOVED_FROM之后等待配对的MOVED_TO的时间（秒），超时视为移出监控目录
+MOVE_PAIR_TIMEOUT = 0.01
+# 监视数达到上限时，未能监视的目录每隔多少秒与快照对比一次（轮询代替事件）
+UNWATCHED_RESCAN_INTERVAL = 30
+MAX_WATCHES_FILE = '/proc/sys/fs/inotify/max_user_watches'
+
+OVERFLOWS = REGISTRY.counter('filesync_server_inotify_overflows_total', 'inotify event queue overflows')
+WATCHES = REGISTRY.gauge('filesync_server_inotify_watches', 'Directories watched by inotify')
+UNWATCHED = REGISTRY.gauge('filesync_server_inotify_unwatched_dirs',
+                           'Directories not watched because the inotify watch limit was reached')
+
+
+def _load_libc():
+    """加载libc中的inotify函数，非Linux系统或不支持时返回None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+INOTIFY_SUPPORTED = _libc is not None
+
+
+def _max_user_watches():
+    try:
+        with open(MAX_WATCHES_FILE) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+class InotifyWatcher:
+    def __init__(self, root_dir, callback, rescan_callback, is_ignored):
+        """Linux inotify监控：一次读取一大块事件并批量解析，按cookie配对MOVED_FROM/MOVED_TO
+
+        新目录出现时才为其添加监视；监视数达到上限的目录记录下来并建立快照，有监视释放时再补上，
+        并定期与快照对比，其中的变化作为普通事件发送；事件队列溢出时请求重新扫描整个监控目录，不静默丢失事件。
+        callback与watchdog处理器相同：callback(事件类型, 路径, 新路径=None, is_dir=False)，
+        rescan_callback([目录, ...])在事件可能丢失时调用；is_ignored(路径, is_dir)排除的目录不添加监视
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.callback = callback
+        self.rescan_callback = rescan_callback
+        self.is_ignored = is_ignored
+        self.fd = -1
+        # 监视描述符 -> 目录路径，目录路径 -> 监视描述符
+        self.paths = {}
+        self.watches = {}
+        # 因监视数达到上限而未能监视的目录
+        self.unwatched = set()
+        # 未能监视的目录子树的快照（PollingWatcher，不启动轮询线程），达到上限时才建立
+        self.poller = None
+        self.limit_warned = False
+        self.watch_freed = False
+        self.next_unwatched_rescan = 0
+        # cookie -> (原路径, 是否目录)，等待配对的MOVED_FROM
+        self.moved_from = {}
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.running = False
+        self.thread = None
+        WATCHES.set_function(lambda: len(self.paths))
+        UNWATCHED.set_function(lambda: len(self.unwatched))
+
+    def start(self):
+        """建立inotify实例、为整个目录树添加监视并启动读取线程"""
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        self._watch_tree(self.root_dir)
+        print(f"inotify watching {len(self.paths)} directories")
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        self.running = True
+        self.thread = threading.Thread(target=self._read_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """停止读取线程"""
+        if not self.running:
+            return
+        self.running = False
+        os.write(self.wakeup_writer, b'\0')
+
+    def join(self):
+        """等待读取线程结束并关闭inotify实例"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.fd, self.wakeup_reader, self.wakeup_writer):
+            if fd is not None and fd >= 0:
+                os.close(fd)
+        self.fd = -1
+        self.wakeup_reader = self.wakeup_writer = None
+
+    def _read_loop(self):
+        """读取线程：有未配对的MOVED_FROM时只短暂等待后续事件"""
+        while self.running:
+            timeout = None
+            if self.unwatched:
+                timeout = max(0.0, self.next_unwatched_rescan - time.monotonic())
+            if self.moved_from:
+                timeout = MOVE_PAIR_TIMEOUT if timeout is None else min(timeout, MOVE_PAIR_TIMEOUT)
+            readable, _, _ = select.select([self.fd, self.wakeup_reader], [], [], timeout)
+            if self.wakeup_reader in readable:
+                return
+            try:
+                if readable:
+                    self._process(os.read(self.fd, READ_BUFFER_SIZE))
+                else:
+                    self._flush_moves()
+                # 每次读取之后最多重试一次，避免递归删除时每个IN_IGNORED都重试
+                if self.unwatched and (self.watch_freed or time.monotonic() >= self.next_unwatched_rescan):
+                    self._retry_unwatched()
+            except (BlockingIOError, InterruptedError):
+                continue
+            except Exception as e:
+                print(f"Error processing inotify events: {e}")
+
+    def _process(self, data):
+        """解析一次读取到的所有事件"""
+        offset = 0
+        end = len(data)
+        header_size = EVENT_HEADER.size
+        while offset + header_size <= end:
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name_start = offset + header_size
+            offset = name_start + length
+            name = data[name_start:offset].split(b'\0', 1)[0]
+            if self.moved_from and not (mask & IN_MOVED_TO and cookie in self.moved_from):
+                # MOVED_TO总是紧跟在配对的MOVED_FROM之后，其他事件出现说明原文件已移出监控目录
+                self._flush_moves()
+            self._handle(wd, mask, cookie, name)
+
+    def _handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            OVERFLOWS.inc()
+            print("inotify event queue overflowed, rescanning monitor directory")
+            # 丢失的事件中可能有新建目录，为尚未监视的目录补上监视
+            self._watch_tree(self.root_dir)
+            self.rescan_callback([self.root_dir])
+            return
+        if mask & IN_IGNORED:
+            self._forget_watch(wd)
+            if self.unwatched:
+                self.watch_freed = True
+            return
+
+        directory = self.paths.get(wd)
+        if directory is None or not name:
+            # 已移除的监视或监视目录自身的事件，目录自身的变化由上级目录的事件报告
+            return
+        path = os.path.join(directory, os.fsdecode(name))
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & IN_MOVED_FROM:
+            self.moved_from[cookie] = (path, is_dir)
+        elif mask & IN_MOVED_TO:
+            source = self.moved_from.pop(cookie, None)
+            if source is None:
+                # 从监控目录外移入
+                self._on_created(path, is_dir)
+            else:
+                self._on_moved(source[0], path, is_dir)
+        elif mask & IN_CREATE:
+            self._on_created(path, is_dir)
+        elif mask & IN_DELETE:
+            self._on_deleted(path, is_dir)
+        elif not is_dir and not self.is_ignored(path):
+            self.callback('MODIFY', path)
+
+    def _on_created(self, path, is_dir):
+        """新文件或新目录：目录需要添加监视，并报告添加监视之前已写入其中的文件"""
+        if is_dir:
+            if not self.is_ignored(path, True):
+                self._watch_tree(path, report_files=True)
+        elif not self.is_ignored(path):
+            self.callback('CREATE', path)
+
+    def _on_deleted(self, path, is_dir):
+        """删除文件或整个目录，目录的监视由内核在IN_IGNORED时移除"""
+        if not self.is_ignored(path, is_dir):
+            self.callback('DELETE', path, is_dir=is_dir)
+
+    def _on_moved(self, old_path, new_path, is_dir):
+        """监控目录内的重命名，规则与watchdog处理器相同"""
+        if is_dir:
+            if self.is_ignored(old_path, True):
+                # 从被排除的目录移入：原目录没有监视，客户端也没有其中的文件
+                if not self.is_ignored(new_path, True):
+                    self._watch_tree(new_path, report_files=True)
+                return
+            self._move_watches(old_path, new_path)
+            if self.is_ignored(new_path, True):
+                self._unwatch_tree(new_path)
+                self.callback('DELETE', old_path, is_dir=True)
+            else:
+                self.callback('RENAME', old_path, new_path, is_dir=True)
+            return
+
+        if self.is_ignored(old_path):
+            # 编辑器常先写临时文件再重命名为目标文件，此时等同于目标文件被创建
+            if not self.is_ignored(new_path):
+                self.callback('CREATE', new_path)
+        elif self.is_ignored(new_path):
+            self.callback('DELETE', old_path)
+        else:
+            self.callback('RENAME', old_path, new_path)
+
+    def _flush_moves(self):
+        """未配对的MOVED_FROM：文件或目录已移出监控目录，等同于删除"""
+        moves = list(self.moved_from.values())
+        self.moved_from.clear()
+        for path, is_dir in moves:
+            if is_dir:
+                self._unwatch_tree(path)
+            self._on_deleted(path, is_dir)
+
+    def _add_watch(self, path):
+        """为目录添加监视，返回是否成功"""
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                if not self.unwatched:
+                    self.next_unwatched_rescan = time.monotonic() + UNWATCHED_RESCAN_INTERVAL
+                self.unwatched.add(path)
+                if self.poller is None:
+                    self.poller = PollingWatcher(self.root_dir, self.callback, self.is_ignored,
+                                                 UNWATCHED_RESCAN_INTERVAL)
+                self.poller.add_tree(path)
+                if not self.limit_warned:
+                    self.limit_warned = True
+                    print(f"inotify watch limit reached ({_max_user_watches()} watches), changes in {path} "
+                          f"and other new directories are not monitored; "
+                          f"raise fs.inotify.max_user_watches to monitor the whole tree")
+            elif error not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                print(f"Failed to watch {path}: {os.strerror(error)}")
+            return False
+        old_path = self.paths.get(wd)
+        if old_path is not None and self.watches.get(old_path) == wd:
+            del self.watches[old_path]
+        self.paths[wd] = path
+        self.watches[path] = wd
+        return True
+
+    def _forget_watch(self, wd):
+        path = self.paths.pop(wd, None)
+        if path is not None and self.watches.get(path) == wd:
+            del self.watches[path]
+
+    def _watch_tree(self, top, report_files=False):
+        """为目录及其所有子目录添加监视，report_files为True时为其中已有的文件发送CREATE"""
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            self._add_watch(directory)
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        # 不进入被排除的目录
+                        if not self.is_ignored(entry.path, True):
+                            stack.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                if report_files and not self.is_ignored(entry.path):
+                    self.callback('CREATE', entry.path)
+
+    def _subtree_watches(self, top):
+        prefix = os.path.join(top, '')
+        return [(path, wd) for path, wd in self.watches.items() if path == top or path.startswith(prefix)]
+
+    def _move_watches(self, old_path, new_path):
+        """目录重命名后监视描述符不变，更新其下所有监视对应的路径"""
+        for path, wd in self._subtree_watches(old_path):
+            moved = new_path + path[len(old_path):]
+            del self.watches[path]
+            self.watches[moved] = wd
+            self.paths[wd] = moved
+        prefix = os.path.join(old_path, '')
+        for path in [path for path in self.unwatched if path == old_path or path.startswith(prefix)]:
+            self.unwatched.discard(path)
+            self.unwatched.add(new_path + path[len(old_path):])
+        if self.poller is not None:
+            self.poller.move_tree(old_path, new_path)
+
+    def _unwatch_tree(self, top):
+        """移除已移出监控目录的目录树上的监视"""
+        for path, wd in self._subtree_watches(top):
+            _libc.inotify_rm_watch(self.fd, wd)
+            self._forget_watch(wd)
+        prefix = os.path.join(top, '')
+        self.unwatched = {path for path in self.unwatched if path != top and not path.startswith(prefix)}
+        if self.poller is not None:
+            self.poller.retain(self._unwatched_tops())
+
+    def _unwatched_tops(self):
+        """未能监视的目录中最上层的目录，下级目录随之一起处理"""
+        directories = []
+        for path in sorted(self.unwatched):
+            if not any(path.startswith(os.path.join(directory, '')) for directory in directories):
+                directories.append(path)
+        return directories
+
+    def _retry_unwatched(self):
+        """未能监视的目录中的变化没有事件：与快照对比后作为普通事件发送，再重新添加监视
+
+        只在服务端内部处理，不请求客户端重新对比；仍无法监视的目录保留对比后的快照
+        """
+        self.watch_freed = False
+        self.next_unwatched_rescan = time.monotonic() + UNWATCHED_RESCAN_INTERVAL
+        directories = self._unwatched_tops()
+        self.poller.poll(directories)
+        self.unwatched = set()
+        for path in directories:
+            self._watch_tree(path)
+        self.poller.retain(self._unwatched_tops())
@@ -0,0 +1,181 @@
+import bisect
+import os
+import threading
+import uuid
+
+from protocol import FRAME_HEADER
+
+# 段文件名：首个事件序号（补零便于排序）
+SEGMENT_SUFFIX = '.seg'
+# 每隔多少条记录保存一个稀疏索引点
+INDEX_INTERVAL = 1024
+
+
+class JournalSegment:
+    def __init__(self, path, first_sequence):
+        """日志的一个段文件：连续的二进制事件帧"""
+        self.path = path
+        self.first_sequence = first_sequence
+        self.last_sequence = first_sequence - 1
+        self.size = 0
+        self.count = 0
+        # 稀疏索引：[(序号, 偏移), ...]
+        self.index = []
+
+    def record(self, sequence, offset):
+        """登记一条已写入的记录"""
+        if self.count % INDEX_INTERVAL == 0:
+            self.index.append((sequence, offset))
+        self.count += 1
+        self.last_sequence = sequence
+
+    def find_offset(self, sequence, size):
+        """查找序号不小于sequence的第一条记录在段内的偏移，只查找前size字节"""
+        position = bisect.bisect_right(self.index, (sequence, float('inf'))) - 1
+        if position < 0:
+            return 0
+        _, offset = self.index[position]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while offset < size:
+                header = f.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                length, _, _, _, frame_sequence, _, _ = FRAME_HEADER.unpack(header)
+                if frame_sequence >= sequence:
+                    return offset
+                offset += 4 + length
+                f.seek(offset)
+        return size
+
+
+class EventJournal:
+    def __init__(self, journal_dir, segment_size=64 * 1024 * 1024, max_segments=8):
+        """服务端事件日志：按序号追加所有广播的事件帧，分段存储并只保留最近max_segments个段
+
+        日志标识在日志目录首次创建时生成，客户端断线重连时携带标识和最后收到的序号，
+        日志仍包含之后的全部事件时只补发缺失的事件
+        """
+        self.journal_dir = journal_dir
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self.lock = threading.Lock()
+        self.segments = []
+        self.current_file = None
+        self.journal_id = None
+        self.last_sequence = 0
+
+    def open(self):
+        """打开日志目录，恢复已有的段并找到最后一个序号"""
+        os.makedirs(self.journal_dir, exist_ok=True)
+        id_path = os.path.join(self.journal_dir, 'journal.id')
+        if os.path.exists(id_path):
+            with open(id_path, 'r', encoding='utf-8') as f:
+                self.journal_id = f.read().strip()
+        if not self.journal_id:
+            self.journal_id = uuid.uuid4().hex
+            with open(id_path, 'w', encoding='utf-8') as f:
+                f.write(self.journal_id)
+
+        names = sorted(name for name in os.listdir(self.journal_dir) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            try:
+                first_sequence = int(name[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            segment = JournalSegment(os.path.join(self.journal_dir, name), first_sequence)
+            self._scan_segment(segment)
+            self.segments.append(segment)
+
+        if self.segments:
+            self.last_sequence = self.segments[-1].last_sequence
+            self.current_file = open(self.segments[-1].path, 'ab')
+        print(f"Event journal opened: {self.journal_dir}, {len(self.segments)} segments, "
+              f"last sequence {self.last_sequence}")
+
+    def _scan_segment(self, segment):
+        """扫描段文件重建索引，截断异常退出时写了一半的记录"""
+        offset = 0
+        with open(segment.path, 'r+b') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            while offset + FRAME_HEADER.size <= file_size:
+                f.seek(offset)
+                length, _, _, _, sequence, _, _ = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+                if offset + 4 + length > file_size:
+                    break
+                segment.record(sequence, offset)
+                offset += 4 + length
+            if offset < file_size:
+                f.truncate(offset)
+        segment.size = offset
+
+    def close(self):
+        """关闭当前段文件"""
+        with self.lock:
+            if self.current_file is not None:
+                self.current_file.close()
+                self.current_file = None
+
+    def _start_segment_locked(self, first_sequence):
+        """开始新的段文件，并删除超出保留数量的旧段"""
+        if self.current_file is not None:
+            self.current_file.close()
+        path = os.path.join(self.journal_dir, f"{first_sequence:020d}{SEGMENT_SUFFIX}")
+        self.current_file = open(path, 'ab')
+        self.segments.append(JournalSegment(path, first_sequence))
+        while len(self.segments) > self.max_segments:
+            old_segment = self.segments.pop(0)
+            try:
+                os.remove(old_segment.path)
+            except OSError as e:
+                print(f"Failed to remove journal segment {old_segment.path}: {e}")
+
+    def append(self, frames, first_sequence):
+        """追加一批已编码的事件帧，序号从first_sequence开始连续递增"""
+        with self.lock:
+            if not self.segments or self.segments[-1].size >= self.segment_size:
+                self._start_segment_locked(first_sequence)
+            segment = self.segments[-1]
+            for index, frame in enumerate(frames):
+                segment.record(first_sequence + index, segment.size)
+                segment.size += len(frame)
+            self.current_file.write(b''.join(frames))
+            self.current_file.flush()
+            self.last_sequence = first_sequence + len(frames) - 1
+
+    def read_since(self, last_sequence, max_bytes):
+        """读取序号大于last_sequence的所有事件帧
+
+        日志已不包含这些事件（被截断）或数据超过max_bytes时返回None。
+        只在锁内记下各段当前的大小，段文件只追加，读取在锁外进行，不阻塞追加
+        """
+        with self.lock:
+            if last_sequence > self.last_sequence:
+                return None
+            if last_sequence == self.last_sequence:
+                return b''
+            if not self.segments or self.segments[0].first_sequence > last_sequence + 1:
+                return None
+
+            position = bisect.bisect_right([s.first_sequence for s in self.segments], last_sequence + 1) - 1
+            segments = [(segment, segment.size) for segment in self.segments[position:]]
+
+        ranges = []
+        total = 0
+        try:
+            for index, (segment, size) in enumerate(segments):
+                offset = segment.find_offset(last_sequence + 1, size) if index == 0 else 0
+                ranges.append((segment.path, offset, size))
+                total += size - offset
+                if total > max_bytes:
+                    return None
+
+            data = []
+            for path, start, end in ranges:
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    data.append(f.read(end - start))
+        except FileNotFoundError:
+            # 读取期间段文件已被轮换删除
+            return None
+        return b''.join(data)
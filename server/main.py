@@ -1,55 +1,107 @@
 import os
 import sys
+from compression import parse_codec_list
 from config import Config
 from file_monitor import FileMonitor
+from file_transfer import FileProvider
+from hash_cache import HashCache
+from journal import EventJournal
+from merkle import MerkleTree
+from metrics import MetricsExporter
+from path_filter import load_filter
 from tcp_server import TCPServer
 
+# 单批事件不超过该数量时逐条显示
+SHOW_EVENT_LIMIT = 20
+
 class FileSyncServer:
     def __init__(self):
         """初始化文件同步服务端"""
         # 加载配置
         self.config = Config()
         
+        # 包含/排除规则：被排除的路径不监控、不广播，也不出现在目录对比中
+        self.path_filter = load_filter(self.config.exclude, self.config.exclude_file, self.config.monitor_dir)
+        
+        # 监控目录的Merkle树，客户端重连时据此只对比有变化的子树
+        self.merkle_tree = MerkleTree(self.config.monitor_dir, self.path_filter)
+        
+        # 本机可用且配置允许的压缩算法
+        self.codecs = parse_codec_list(self.config.compression)
+        
+        # 文件内容哈希缓存：客户端校验模式通过HASH请求比较文件内容
+        self.hash_cache = HashCache(self.config.hash_cache_file)
+        
+        # 初始化文件内容提供者（TCP数据通道）
+        self.file_provider = FileProvider(self.config.monitor_dir, tree=self.merkle_tree,
+                                          hash_cache=self.hash_cache, codecs=self.codecs)
+        
+        # 事件日志：重连的客户端从日志补发断线期间的事件
+        self.journal = None
+        if self.config.journal_dir:
+            self.journal = EventJournal(
+                self.config.journal_dir,
+                self.config.journal_segment_size,
+                self.config.journal_max_segments
+            )
+        
         # 初始化TCP服务器
-        self.tcp_server = TCPServer(self.config.bind_ip, self.config.port)
+        self.tcp_server = TCPServer(
+            self.config.bind_ip, 
+            self.config.port, 
+            self.file_provider.handle_connection,
+            self.config.send_queue_limit,
+            self.config.overflow_policy,
+            self.journal,
+            self.codecs,
+            self.config.monitor_dir
+        )
+        
+        # 指标输出：本地HTTP端点和定期写入的JSON文件
+        self.metrics_exporter = MetricsExporter(
+            bind_ip=self.config.metrics_bind,
+            port=self.config.metrics_port,
+            json_file=self.config.metrics_file,
+            interval=self.config.metrics_interval
+        )
         
         # 初始化文件监控器
         self.file_monitor = FileMonitor(
             self.config.monitor_dir, 
-            self.handle_file_event
+            self.handle_file_events,
+            self.config.batch_latency / 1000.0,
+            self.config.batch_max_size,
+            self.config.debounce_delay / 1000.0,
+            self.config.monitor_backend,
+            self.config.poll_interval / 1000.0,
+            self.path_filter,
+            self.config.debounce_max_delay / 1000.0
         )
     
-    def _encode_file_path(self, file_path):
-        """编码文件路径，处理特殊字符"""
-        try:
-            # 对路径进行URL编码，处理特殊字符
-            import urllib.parse
-            encoded_path = urllib.parse.quote(file_path, safe='')
-            return encoded_path
-        except Exception as e:
-            print(f"Error encoding path {file_path}: {e}")
-            return file_path
-    
-    def handle_file_event(self, event_type, file_path, new_file_path=None):
-        """处理文件事件并广播给客户端"""
-        # 格式化事件信息
-        timestamp = ""  # 可以添加时间戳
-        print(f"[{timestamp}] {event_type}: {file_path}")
-        
-        # 编码文件路径，处理特殊字符
-        encoded_file_path = self._encode_file_path(file_path)
-        encoded_new_file_path = self._encode_file_path(new_file_path) if new_file_path else None
-        
-        if event_type == 'RENAME' and encoded_new_file_path:
-            print(f"  -> {new_file_path}")
-            # 构造重命名事件消息
-            message = f"{event_type}|{encoded_file_path}|{encoded_new_file_path}"
+    def handle_file_events(self, events):
+        """处理一批合并后的文件事件并广播给客户端"""
+        if events[0][0] == 'RESCAN':
+            # 监控后端丢失了事件：重新扫描这些目录，并通知客户端重新对比
+            for _event_type, directory, _new_path, _is_dir in events:
+                print(f"Rescan requested: {directory}")
+                self.merkle_tree.rescan(directory)
+            self.tcp_server.broadcast_resync()
+            return
+        
+        # 事件较少时逐条显示，大批量事件只显示汇总，避免大量输出拖慢处理
+        if len(events) <= SHOW_EVENT_LIMIT:
+            for event_type, file_path, new_file_path, is_dir in events:
+                print(f"{event_type}{' directory' if is_dir else ''}: {file_path}")
+                if event_type == 'RENAME' and new_file_path:
+                    print(f"  -> {new_file_path}")
         else:
-            # 构造其他事件消息
-            message = f"{event_type}|{encoded_file_path}"
+            print(f"Broadcasting batch of {len(events)} events")
+        
+        # 向所有客户端广播事件，由TCP服务器按各客户端协商的协议编码
+        self.tcp_server.broadcast_events(events)
         
-        # 向所有客户端广播消息
-        self.tcp_server.broadcast(message)
+        # 标记Merkle树中需要重新扫描的目录，放在广播之后，不延迟事件发送
+        self.merkle_tree.apply_events(events)
     
     def start(self):
         """启动服务端"""
@@ -60,12 +112,29 @@ class FileSyncServer:
         print(f"  Monitor Directory: {self.config.monitor_dir}")
         print(f"  Bind IP: {self.config.bind_ip}")
         print(f"  Port: {self.config.port}")
+        print(f"  Batch Window: {self.config.batch_latency}ms / {self.config.batch_max_size} events")
+        print(f"  Debounce Delay: {self.config.debounce_delay}ms (max {self.config.debounce_max_delay or 'unlimited'}ms)")
+        print(f"  Monitor Backend: {self.config.monitor_backend}")
+        print(f"  Poll Interval: {self.config.poll_interval}ms")
+        print(f"  Exclude: {self.config.exclude or 'none'}{f' + {self.config.exclude_file}' if self.config.exclude_file else ''}")
+        print(f"  Send Queue Limit: {self.config.send_queue_limit} bytes ({self.config.overflow_policy} on overflow)")
+        print(f"  Event Journal: {self.config.journal_dir or 'disabled'}")
+        print(f"  Compression: {','.join(self.codecs) or 'disabled'}")
+        print(f"  Metrics: port {self.config.metrics_port or 'disabled'}, file {self.config.metrics_file or 'disabled'}")
         
         # 确保监控目录存在
         if not os.path.exists(self.config.monitor_dir):
             os.makedirs(self.config.monitor_dir)
             print(f"Created monitor directory: {self.config.monitor_dir}")
         
+        # 打开事件日志，广播序号从日志中最后一个序号继续
+        if self.journal is not None:
+            try:
+                self.journal.open()
+            except OSError as e:
+                print(f"Failed to open event journal, resume disabled: {e}")
+                self.journal = self.tcp_server.journal = None
+        
         # 启动TCP服务器
         if not self.tcp_server.start():
             print("Failed to start TCP server")
@@ -74,6 +143,11 @@ class FileSyncServer:
         # 启动文件监控器
         self.file_monitor.start()
         
+        self.metrics_exporter.start()
+        
+        # 在后台建立Merkle树
+        self.merkle_tree.start()
+        
         print("\nServer started successfully!")
         print("Press Ctrl+C to stop...")
         return True
@@ -88,6 +162,11 @@ class FileSyncServer:
         # 停止TCP服务器
         self.tcp_server.stop()
         
+        if self.journal is not None:
+            self.journal.close()
+        self.hash_cache.close()
+        self.metrics_exporter.stop()
+        
         print("Server stopped")
 
 def main():
@@ -0,0 +1,254 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from metrics import REGISTRY
+
+# 文件条目：大小 修改时间(纳秒)
+FILE_ENTRY = struct.Struct('>QQ')
+DIGEST_SIZE = 16
+
+TREE_BUILD_SECONDS = REGISTRY.gauge('filesync_server_tree_build_seconds', 'Duration of the initial Merkle tree scan')
+
+
+def relative_dir_of(relative_path):
+    """相对路径（使用/分隔）的上级目录，根目录为空字符串"""
+    return relative_path.rpartition('/')[0]
+
+
+def join_relative(relative_dir, name):
+    return f"{relative_dir}/{name}" if relative_dir else name
+
+
+def files_digest(entries):
+    """目录中直接包含的文件的摘要，entries为[(名称, 大小, 修改时间), ...]，没有文件时返回None"""
+    if not entries:
+        return None
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for name, size, mtime_ns in sorted(entries, key=lambda entry: entry[0].encode('utf-8', 'surrogateescape')):
+        digest.update(b'F' + name.encode('utf-8', 'surrogateescape') + b'\0')
+        digest.update(FILE_ENTRY.pack(size, mtime_ns))
+    return digest.digest()
+
+
+def directory_digest(file_part, subdirs):
+    """目录摘要：由文件摘要和各子目录的(名称, 摘要)组成，整个子树没有文件时返回None
+
+    客户端根据清单用相同的方法计算，两端摘要相同说明子树内所有文件的大小和修改时间一致
+    """
+    subdirs = [(name, digest) for name, digest in subdirs if digest is not None]
+    if file_part is None and not subdirs:
+        return None
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    digest.update(file_part or b'\0' * DIGEST_SIZE)
+    for name, subdir_digest in sorted(subdirs, key=lambda item: item[0].encode('utf-8', 'surrogateescape')):
+        digest.update(b'D' + name.encode('utf-8', 'surrogateescape') + b'\0' + subdir_digest)
+    return digest.digest()
+
+
+class DirNode:
+    def __init__(self):
+        """Merkle树中的一个目录节点"""
+        self.file_part = None
+        self.subdirs = set()
+        self.digest = None
+
+
+class MerkleTree:
+    def __init__(self, root_dir, path_filter=None):
+        """监控目录的Merkle树：每个目录保存其子树的摘要
+
+        文件事件只把所在目录标记为待重新扫描，查询时才重新扫描这些目录并向上重算摘要，
+        因此维护代价与发生变化的目录数量成正比。文件以大小和修改时间参与摘要，不读取内容。
+        path_filter为PathFilter实例时不包含被排除的文件和目录
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.path_filter = path_filter
+        self.nodes = {}
+        self.dirty = set()
+        # 建树期间请求重新扫描的目录，安装节点后再展开到其下所有目录
+        self.pending_rescans = set()
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def start(self):
+        """在后台线程中建立整棵树，完成前的查询返回未就绪"""
+        build_thread = threading.Thread(target=self._build)
+        build_thread.daemon = True
+        build_thread.start()
+
+    def _build(self):
+        """不持有锁扫描整棵树，完成后再安装；扫描期间的事件记入dirty，安装后的首次查询重新扫描"""
+        start_time = time.time()
+        nodes = {}
+        self._update(nodes, [''])
+        with self.lock:
+            self.nodes = nodes
+            for relative_path in self.pending_rescans:
+                self._rescan_locked(relative_path)
+            self.pending_rescans.clear()
+            self.ready = True
+        TREE_BUILD_SECONDS.set(time.time() - start_time)
+        print(f"Merkle tree built: {len(nodes)} directories in {time.time() - start_time:.2f} seconds")
+
+    def relative_path(self, file_path):
+        """监控目录下的绝对路径转换为相对路径，不在监控目录下时返回None"""
+        relative_path = os.path.relpath(os.path.abspath(file_path), self.root_dir)
+        if relative_path == os.curdir:
+            return ''
+        if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+            return None
+        return relative_path.replace(os.sep, '/')
+
+    def apply_events(self, events):
+        """根据一批文件事件[(事件类型, 路径, 新路径, 是否目录), ...]标记需要重新扫描的目录"""
+        with self.lock:
+            for _event_type, file_path, new_file_path, _is_dir in events:
+                for path in (file_path, new_file_path):
+                    if not path:
+                        continue
+                    relative_path = self.relative_path(path)
+                    if relative_path is None:
+                        continue
+                    # 路径本身是目录时（目录被删除或重命名）连同该目录一起重新扫描
+                    if relative_path in self.nodes:
+                        self.dirty.add(relative_path)
+                    if relative_path:
+                        self.dirty.add(relative_dir_of(relative_path))
+
+    def rescan(self, directory):
+        """目录下的事件可能已丢失（如监控队列溢出），将目录及其下所有目录标记为待重新扫描"""
+        relative_path = self.relative_path(directory)
+        if relative_path is None:
+            return
+        with self.lock:
+            if not self.ready:
+                self.pending_rescans.add(relative_path)
+                return
+            self._rescan_locked(relative_path)
+
+    def _rescan_locked(self, relative_path):
+        prefix = relative_path + '/' if relative_path else ''
+        self.dirty.update(relative_dir for relative_dir in self.nodes
+                          if relative_dir == relative_path or relative_dir.startswith(prefix))
+        self.dirty.add(relative_path)
+
+    def _scan_dir(self, relative_dir):
+        """扫描目录，返回(文件列表[(名称, 大小, 修改时间)], 子目录名称列表)，目录不存在时返回None"""
+        full_path = os.path.join(self.root_dir, relative_dir) if relative_dir else self.root_dir
+        path_filter = self.path_filter or None
+        if path_filter is not None and path_filter.is_excluded(relative_dir, True):
+            return None
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink() and not (
+                                    path_filter is not None and
+                                    path_filter.match(join_relative(relative_dir, entry.name), True)):
+                                subdirs.append(entry.name)
+                            continue
+                        if path_filter is not None and path_filter.match(join_relative(relative_dir, entry.name)):
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except OSError as e:
+            print(f"Error scanning directory {full_path}: {e}")
+            return None
+        return files, subdirs
+
+    def _drop(self, nodes, relative_dir):
+        """移除目录及其下所有节点"""
+        node = nodes.pop(relative_dir, None)
+        if node is None:
+            return
+        for name in node.subdirs:
+            self._drop(nodes, join_relative(relative_dir, name))
+
+    def _refresh_locked(self):
+        """重新扫描待更新的目录并向上重算摘要（调用方持有锁）"""
+        if not self.dirty:
+            return
+        to_scan = list(self.dirty)
+        self.dirty.clear()
+        self._update(self.nodes, to_scan)
+
+    def _update(self, nodes, to_scan):
+        """扫描to_scan中的目录，更新nodes中的节点并向上重算摘要"""
+        changed = set()
+        while to_scan:
+            relative_dir = to_scan.pop()
+            scanned = self._scan_dir(relative_dir)
+            if scanned is None:
+                self._drop(nodes, relative_dir)
+                if relative_dir:
+                    changed.add(relative_dir_of(relative_dir))
+                continue
+
+            files, subdirs = scanned
+            node = nodes.get(relative_dir)
+            if node is None:
+                node = nodes[relative_dir] = DirNode()
+                if relative_dir:
+                    parent = nodes.get(relative_dir_of(relative_dir))
+                    if parent is None:
+                        # 上级目录也是新建的，扫描上级目录以建立连接
+                        to_scan.append(relative_dir_of(relative_dir))
+                    else:
+                        parent.subdirs.add(relative_dir.rpartition('/')[2])
+            node.file_part = files_digest(files)
+            subdirs = set(subdirs)
+            for name in node.subdirs - subdirs:
+                self._drop(nodes, join_relative(relative_dir, name))
+            for name in subdirs - node.subdirs:
+                # 新出现的子目录需要完整扫描
+                to_scan.append(join_relative(relative_dir, name))
+            node.subdirs = subdirs
+            changed.add(relative_dir)
+
+        # 从最深的目录开始向上重算摘要
+        pending = set()
+        for relative_dir in changed:
+            while relative_dir not in pending:
+                pending.add(relative_dir)
+                if not relative_dir:
+                    break
+                relative_dir = relative_dir_of(relative_dir)
+        for relative_dir in sorted(pending, key=lambda path: path.count('/') + bool(path), reverse=True):
+            node = nodes.get(relative_dir)
+            if node is None:
+                continue
+            node.digest = directory_digest(node.file_part, [
+                (name, nodes[join_relative(relative_dir, name)].digest)
+                for name in node.subdirs if join_relative(relative_dir, name) in nodes])
+
+    def list_dir(self, relative_dir):
+        """返回(目录摘要, 文件列表, [(子目录名称, 摘要), ...])，未就绪时返回None
+
+        目录不存在时摘要为None，列表为空
+        """
+        with self.lock:
+            if not self.ready:
+                return None
+            self._refresh_locked()
+            node = self.nodes.get(relative_dir)
+            if node is None:
+                return None, [], []
+            subdirs = []
+            for name in sorted(node.subdirs):
+                child = self.nodes.get(join_relative(relative_dir, name))
+                if child is not None and child.digest is not None:
+                    subdirs.append((name, child.digest))
+            digest = node.digest
+        scanned = self._scan_dir(relative_dir)
+        files = scanned[0] if scanned else []
+        return digest, files, subdirs
@@ -0,0 +1,289 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 延迟直方图的默认分桶上界（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    """Prometheus文本格式中的数值"""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    """格式化标签{name="value",...}，extra为附加的(名称, 值)"""
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        """一个指标及其各标签组合的值"""
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        """标签字典转换为按声明顺序排列的标签值元组"""
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def remove(self, **labels):
+        """删除一个标签组合（如已断开的客户端）"""
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def collect(self):
+        """返回[(标签值, 值), ...]"""
+        with self.lock:
+            return list(self.values.items())
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """计数器加amount"""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        """设置当前值"""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        """读取指标时调用function取值：无标签时返回数值，有标签时返回{标签值元组: 数值}"""
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        try:
+            value = self.function()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            return []
+        if isinstance(value, dict):
+            return [(tuple(str(v) for v in key), item) for key, item in value.items()]
+        return [((), value)]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS, labels=()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """记录一次观测值（如耗时秒数）"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        """返回[(标签值, (累计分桶计数, 总和, 次数)), ...]"""
+        with self.lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self.values.items()]
+        result = []
+        for key, (counts, total, count) in items:
+            cumulative = []
+            running = 0
+            for bucket_count in counts:
+                running += bucket_count
+                cumulative.append(running)
+            result.append((key, (cumulative, total, count)))
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """指标注册表：模块在导入时注册指标，同名指标只注册一次"""
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, labels=()):
+        return self._register(Histogram, name, help_text, buckets, labels)
+
+    def render_prometheus(self):
+        """以Prometheus文本格式输出所有指标"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            for key, value in metric.collect():
+                if isinstance(metric, Histogram):
+                    cumulative, total, count = value
+                    for bound, bucket_count in zip(metric.buckets + (float('inf'),), cumulative):
+                        labels = _format_labels(metric.label_names, key, ('le', _format_value(bound)))
+                        lines.append(f"{metric.name}_bucket{labels} {bucket_count}")
+                    labels = _format_labels(metric.label_names, key)
+                    lines.append(f"{metric.name}_sum{labels} {_format_value(total)}")
+                    lines.append(f"{metric.name}_count{labels} {count}")
+                else:
+                    lines.append(f"{metric.name}{_format_labels(metric.label_names, key)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """以字典形式返回所有指标的当前值，用于JSON输出"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        result = {}
+        for metric in metrics:
+            samples = []
+            for key, value in metric.collect():
+                sample = {'labels': dict(zip(metric.label_names, key))}
+                if isinstance(metric, Histogram):
+                    cumulative, total, count = value
+                    sample['count'] = count
+                    sample['sum'] = total
+                    sample['buckets'] = {_format_value(bound): bucket_count for bound, bucket_count
+                                         in zip(metric.buckets + (float('inf'),), cumulative)}
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            result[metric.name] = {'type': metric.metric_type, 'help': metric.help_text, 'samples': samples}
+        return result
+
+
+# 进程内共享的注册表
+REGISTRY = MetricsRegistry()
+
+
+class MetricsExporter:
+    def __init__(self, registry=REGISTRY, bind_ip='127.0.0.1', port=0, json_file='', interval=60):
+        """指标输出：port大于0时在本地HTTP端口提供/metrics（Prometheus文本格式）和/metrics.json，
+        json_file不为空时每interval秒将全部指标写入JSON文件
+        """
+        self.registry = registry
+        self.bind_ip = bind_ip
+        self.port = port
+        self.json_file = json_file
+        self.interval = max(1, interval)
+        self.http_server = None
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """启动HTTP服务和定期写入线程"""
+        if self.port > 0:
+            registry = self.registry
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    path = self.path.split('?', 1)[0]
+                    if path == '/metrics':
+                        body = registry.render_prometheus().encode('utf-8')
+                        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    elif path == '/metrics.json':
+                        body = json.dumps(registry.snapshot()).encode('utf-8')
+                        content_type = 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    # 不为每次抓取输出访问日志
+                    pass
+
+            try:
+                self.http_server = ThreadingHTTPServer((self.bind_ip, self.port), MetricsHandler)
+                self.http_server.daemon_threads = True
+            except OSError as e:
+                print(f"Failed to start metrics endpoint on {self.bind_ip}:{self.port}: {e}")
+            else:
+                thread = threading.Thread(target=self.http_server.serve_forever)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+                print(f"Metrics endpoint: http://{self.bind_ip}:{self.port}/metrics")
+
+        if self.json_file:
+            thread = threading.Thread(target=self._dump_loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """停止HTTP服务，最后写入一次JSON文件"""
+        self.stop_event.set()
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+        for thread in self.threads:
+            thread.join(1)
+        self.threads = []
+        if self.json_file:
+            self.dump()
+
+    def dump(self):
+        """将全部指标写入JSON文件（先写临时文件再替换）"""
+        data = {'timestamp': time.time(), 'metrics': self.registry.snapshot()}
+        temp_path = f"{self.json_file}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temp_path, self.json_file)
+        except OSError as e:
+            print(f"Failed to write metrics file {self.json_file}: {e}")
+
+    def _dump_loop(self):
+        """后台线程：定期写入JSON文件"""
+        while not self.stop_event.wait(self.interval):
+            self.dump()
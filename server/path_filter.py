@@ -0,0 +1,170 @@
+import os
+import re
+
+# 默认排除规则：隐藏文件和目录、临时文件
+DEFAULT_EXCLUDE = '.*, *.tmp'
+# 目录排除结果缓存的最大条目数，超过时清空
+DIR_CACHE_SIZE = 65536
+
+
+def translate_pattern(pattern):
+    """将gitignore模式（已去掉!前缀和末尾的/）转换为匹配相对路径（/分隔）的正则表达式"""
+    # 含有/的模式相对于根目录，否则匹配任意层级的名称
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = [] if anchored else ['(?:.*/)?']
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**/', i):
+                # 零个或多个目录
+                parts.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                parts.append('.*')
+                i += 2
+                continue
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            start = i + 1
+            negate = pattern[start:start + 1] in ('!', '^')
+            if negate:
+                start += 1
+            # 紧跟在[之后的]是普通字符
+            end = pattern.find(']', start + 1 if pattern[start:start + 1] == ']' else start)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                content = ''.join('\\' + ch if ch in '\\[]' else ch for ch in pattern[start:end])
+                parts.append(f"[{'^' if negate else ''}{content}]")
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def parse_rules(lines):
+    """解析gitignore格式的规则行，返回[(是否排除, 是否只匹配目录, 正则表达式), ...]"""
+    rules = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        exclude = True
+        if line.startswith('!'):
+            exclude = False
+            line = line[1:]
+        elif line.startswith('\\'):
+            # \!和\#表示以该字符开头的名称
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        rules.append((exclude, dir_only, translate_pattern(line)))
+    return rules
+
+
+class PathFilter:
+    def __init__(self, lines=(), root_dir=None):
+        """gitignore格式的包含/排除规则，编译为少量合并的正则表达式
+
+        规则按顺序生效，后面的规则覆盖前面的，!开头的规则重新包含被排除的路径；
+        末尾为/的规则只匹配目录，含/的规则相对于根目录。与git相同，目录被排除后其中的
+        路径不能再被包含，扫描时不进入被排除的目录。
+        连续的同类规则合并为一个正则表达式，匹配代价与规则数量基本无关
+        """
+        self.root_dir = os.path.abspath(root_dir) if root_dir else None
+        self.rule_count = 0
+        # [(是否排除, 匹配文件和目录的正则, 只匹配目录的正则), ...]
+        self.groups = []
+        # 目录相对路径 -> 是否被排除（包括上级目录被排除）
+        self.dir_cache = {}
+        current = None
+        for exclude, dir_only, regex in parse_rules(lines):
+            self.rule_count += 1
+            if current is None or current[0] != exclude:
+                current = (exclude, [], [])
+                self.groups.append(current)
+            current[2 if dir_only else 1].append(regex)
+        self.groups = [(exclude, self._compile(any_rules), self._compile(dir_rules))
+                       for exclude, any_rules, dir_rules in reversed(self.groups)]
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    @staticmethod
+    def _compile(regexes):
+        if not regexes:
+            return None
+        return re.compile('|'.join(f'(?:{regex})' for regex in regexes), re.DOTALL)
+
+    def match(self, relative_path, is_dir=False):
+        """只按路径本身判断是否被排除，不检查上级目录（扫描时上级目录已经检查过）"""
+        for exclude, any_regex, dir_regex in self.groups:
+            if any_regex is not None and any_regex.fullmatch(relative_path):
+                return exclude
+            if is_dir and dir_regex is not None and dir_regex.fullmatch(relative_path):
+                return exclude
+        return False
+
+    def is_excluded(self, relative_path, is_dir=False):
+        """相对路径（/分隔）是否被排除，上级目录被排除时路径也被排除"""
+        if not self.groups or not relative_path:
+            return False
+        parent = relative_path.rpartition('/')[0]
+        if parent and self._dir_excluded(parent):
+            return True
+        return self.match(relative_path, is_dir)
+
+    def _dir_excluded(self, relative_dir):
+        excluded = self.dir_cache.get(relative_dir)
+        if excluded is None:
+            parent = relative_dir.rpartition('/')[0]
+            excluded = bool(parent) and self._dir_excluded(parent) or self.match(relative_dir, True)
+            if len(self.dir_cache) >= DIR_CACHE_SIZE:
+                self.dir_cache.clear()
+            self.dir_cache[relative_dir] = excluded
+        return excluded
+
+    def relative_path(self, path):
+        """根目录下的绝对路径转换为/分隔的相对路径，不在根目录下时只使用文件名"""
+        if self.root_dir is not None:
+            if not os.path.isabs(path):
+                path = os.path.abspath(path)
+            if path == self.root_dir:
+                return ''
+            prefix = os.path.join(self.root_dir, '')
+            if path.startswith(prefix):
+                return path[len(prefix):].replace(os.sep, '/')
+        return os.path.basename(path)
+
+    def is_ignored(self, path, is_dir=False):
+        """根目录下的绝对路径是否被排除"""
+        if not self.groups:
+            return False
+        return self.is_excluded(self.relative_path(path), is_dir)
+
+
+def load_filter(exclude, exclude_file, root_dir):
+    """由配置创建PathFilter：exclude为逗号分隔的规则，exclude_file为每行一条规则的文件"""
+    lines = exclude.split(',') if exclude else []
+    if exclude_file:
+        try:
+            with open(exclude_file, encoding='utf-8') as f:
+                lines.extend(f.read().splitlines())
+        except OSError as e:
+            print(f"Failed to read exclude file {exclude_file}: {e}")
+    path_filter = PathFilter(lines, root_dir)
+    if path_filter.rule_count:
+        print(f"Loaded {path_filter.rule_count} include/exclude rules")
+    return path_filter
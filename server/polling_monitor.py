@@ -0,0 +1,401 @@
+import collections
+import os
+import struct
+import threading
+import time
+
+from metrics import REGISTRY
+
+# 文件状态：大小 修改时间(纳秒) inode，打包为bytes以减少百万级文件快照的内存占用
+FILE_STATE = struct.Struct('=QqQ')
+# 目录修改时间距扫描开始不足该值（纳秒）时，下次扫描仍重新列出该目录，
+# 避免同一时间精度内（NFS/CIFS常为1~2秒）发生的后续变化被漏掉
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+# 没有变化时扫描间隔每次乘以该系数，最多增大到最小间隔的POLL_BACKOFF_LIMIT倍
+POLL_BACKOFF = 2
+POLL_BACKOFF_LIMIT = 8
+# 扫描耗时占总时间的最大比例，限制大目录树的CPU和I/O开销
+POLL_MAX_DUTY = 0.1
+# 收不到文件变化通知的文件系统类型，auto后端在这些文件系统上使用轮询
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p',
+                       'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs', 'glusterfs', 'ceph', 'fuse.ceph')
+MOUNTS_FILE = '/proc/self/mounts'
+
+POLL_SECONDS = REGISTRY.histogram('filesync_server_poll_scan_seconds', 'Duration of one polling scan')
+POLL_FILES = REGISTRY.gauge('filesync_server_poll_files', 'Files in the polling snapshot')
+POLL_INTERVAL = REGISTRY.gauge('filesync_server_poll_interval_seconds', 'Current polling interval')
+
+
+def _decode_mount_path(path):
+    """/proc/self/mounts中的空格等字符以\\040形式转义"""
+    return path.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+
+def filesystem_type(path):
+    """目录所在文件系统的类型（Linux），无法确定时返回None"""
+    try:
+        with open(MOUNTS_FILE, encoding='utf-8', errors='surrogateescape') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best = None
+    best_length = -1
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = _decode_mount_path(fields[1])
+        if path != mount_point and not path.startswith(os.path.join(mount_point, '')):
+            continue
+        # 同一挂载点可能被多次挂载，以最后一次为准
+        if len(mount_point) >= best_length:
+            best = fields[2]
+            best_length = len(mount_point)
+    return best
+
+
+def is_network_filesystem(path):
+    """目录是否位于收不到inotify事件的网络文件系统上"""
+    return filesystem_type(path) in NETWORK_FILESYSTEMS
+
+
+class DirSnapshot:
+    def __init__(self):
+        """快照中的一个目录：mtime_ns为None表示下次扫描需要重新列出目录"""
+        self.ino = 0
+        self.mtime_ns = None
+        # 文件名 -> FILE_STATE打包的状态，不包含忽略的文件
+        self.files = {}
+        self.subdirs = set()
+
+
+class ScanChanges:
+    def __init__(self):
+        """一次扫描发现的变化，等待按inode配对重命名"""
+        # [路径, 是否目录, 原状态, 所属重命名的删除列表]，目录的原状态为其子树的{路径: DirSnapshot}
+        self.removed = []
+        # (路径, 是否目录, 文件状态)，只记录新出现的最上层条目
+        self.added = []
+        self.modified = []
+
+
+class PollingWatcher:
+    def __init__(self, root_dir, callback, is_ignored, interval=2.0):
+        """轮询监控：适用于NFS/CIFS等收不到变化通知的文件系统
+
+        内存中保存目录树快照（每个文件的大小、修改时间和inode），每次扫描与快照对比。
+        目录修改时间未变时不重新列出目录，只检查已知文件的状态；消失和新出现的条目按inode
+        配对为重命名，目录重命名作为一个子树事件发送。有变化时按最小间隔扫描，没有变化时
+        逐渐增大间隔，扫描耗时不超过总时间的POLL_MAX_DUTY。
+        callback与其他监控后端相同：callback(事件类型, 路径, 新路径=None, is_dir=False)，
+        is_ignored(路径, is_dir)排除的文件和目录不进入快照
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.callback = callback
+        self.is_ignored = is_ignored
+        self.min_interval = interval
+        self.max_interval = interval * POLL_BACKOFF_LIMIT
+        self.interval = interval
+        # 目录路径 -> DirSnapshot
+        self.dirs = {}
+        self.file_count = 0
+        self.scan_start_ns = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        POLL_FILES.set_function(lambda: self.file_count)
+        POLL_INTERVAL.set_function(lambda: self.interval)
+
+    def start(self):
+        """建立初始快照并启动轮询线程"""
+        if not os.path.isdir(self.root_dir):
+            raise OSError(f"{self.root_dir} is not a directory")
+        start_time = time.monotonic()
+        self.scan_start_ns = time.time_ns()
+        self._build(self.root_dir)
+        seconds = time.monotonic() - start_time
+        self.interval = max(self.min_interval, seconds * (1 / POLL_MAX_DUTY - 1))
+        self._count_files()
+        print(f"Polling snapshot: {len(self.dirs)} directories, {self.file_count} files "
+              f"in {seconds:.2f} seconds, interval {self.interval:.1f}s")
+        self.thread = threading.Thread(target=self._poll_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """停止轮询线程（正在进行的扫描在下一个目录处中止）"""
+        self.stop_event.set()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _poll_loop(self):
+        while not self.stop_event.wait(self.interval):
+            start_time = time.monotonic()
+            try:
+                changes = self.poll()
+            except Exception as e:
+                print(f"Error polling {self.root_dir}: {e}")
+                changes = 0
+            seconds = time.monotonic() - start_time
+            POLL_SECONDS.observe(seconds)
+            self.interval = self._next_interval(changes, seconds, self.interval)
+
+    def _next_interval(self, changes, seconds, interval):
+        """有变化时恢复最小间隔，没有变化时逐渐增大；扫描越慢间隔越大，限制扫描开销"""
+        if changes:
+            interval = self.min_interval
+        else:
+            interval = min(interval * POLL_BACKOFF, self.max_interval)
+        return max(interval, seconds * (1 / POLL_MAX_DUTY - 1))
+
+    def poll(self, tops=None):
+        """扫描一次目录树，发送与快照之间的差异，返回发送的事件数；tops为只扫描的目录列表"""
+        self.scan_start_ns = time.time_ns()
+        changes = ScanChanges()
+        stack = list(tops) if tops is not None else [self.root_dir]
+        while stack:
+            if self.stop_event.is_set():
+                return 0
+            path = stack.pop()
+            state = self.dirs.get(path)
+            if state is None:
+                continue
+            stack.extend(os.path.join(path, name) for name in self._scan_dir(path, state, changes))
+        events = self._resolve(changes)
+        for event_type, path, new_path, is_dir in events:
+            self.callback(event_type, path, new_path, is_dir=is_dir)
+        if events:
+            self._count_files()
+        return len(events)
+
+    def _count_files(self):
+        self.file_count = sum(len(state.files) for state in self.dirs.values())
+
+    def _listed_mtime(self, dir_stat):
+        """列出目录后记录的修改时间，修改时间太接近本次扫描时下次仍需重新列出"""
+        if self.scan_start_ns - dir_stat.st_mtime_ns < RACY_WINDOW_NS:
+            return None
+        return dir_stat.st_mtime_ns
+
+    def _read_dir(self, path):
+        """列出目录，返回(目录stat, {文件名: 文件状态}, 子目录名称集合)，无法读取时返回None"""
+        files = {}
+        subdirs = set()
+        try:
+            # 先取目录的修改时间，列出期间发生的变化会在下次扫描时发现
+            dir_stat = os.stat(path)
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            # 被排除的目录不进入快照
+                            if not entry.is_symlink() and not self.is_ignored(entry.path, True):
+                                subdirs.add(entry.name)
+                            continue
+                        if self.is_ignored(entry.path):
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files[entry.name] = FILE_STATE.pack(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except OSError as e:
+            print(f"Error scanning directory {path}: {e}")
+            return None
+        return dir_stat, files, subdirs
+
+    def _build(self, top):
+        """为目录及其整个子树建立快照，不发送事件"""
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            state = DirSnapshot()
+            self.dirs[path] = state
+            listing = self._read_dir(path)
+            if listing is None:
+                continue
+            dir_stat, state.files, state.subdirs = listing
+            state.ino = dir_stat.st_ino
+            state.mtime_ns = self._listed_mtime(dir_stat)
+            stack.extend(os.path.join(path, name) for name in state.subdirs)
+
+    def add_tree(self, top):
+        """将目录及其子树加入快照，不发送事件；已在快照中时不变"""
+        if top not in self.dirs:
+            self.scan_start_ns = time.time_ns()
+            self._build(top)
+
+    def move_tree(self, old_path, new_path):
+        """目录被重命名后更新其子树在快照中的路径"""
+        prefix = os.path.join(old_path, '')
+        for path in [path for path in self.dirs if path == old_path or path.startswith(prefix)]:
+            self.dirs[new_path + path[len(old_path):]] = self.dirs.pop(path)
+
+    def retain(self, tops):
+        """只保留tops中各目录子树的快照"""
+        tops = set(tops)
+        prefixes = tuple(os.path.join(top, '') for top in tops)
+        self.dirs = {path: state for path, state in self.dirs.items() if path in tops or path.startswith(prefixes)}
+
+    def _drop(self, top):
+        """从快照中移除目录及其子树，返回被移除的{路径: DirSnapshot}"""
+        dropped = {}
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            state = self.dirs.pop(path, None)
+            if state is None:
+                continue
+            dropped[path] = state
+            stack.extend(os.path.join(path, name) for name in state.subdirs)
+        return dropped
+
+    def _scan_dir(self, path, state, changes):
+        """对比一个目录与快照，返回需要继续扫描的子目录名称"""
+        try:
+            dir_stat = os.stat(path)
+        except OSError:
+            # 目录已被删除，由上级目录的列表变化报告
+            return ()
+        if state.mtime_ns == dir_stat.st_mtime_ns and self._check_files(path, state, changes):
+            return state.subdirs
+
+        listing = self._read_dir(path)
+        if listing is None:
+            return ()
+        dir_stat, files, subdirs = listing
+        for name, file_state in files.items():
+            old = state.files.get(name)
+            if old is None:
+                changes.added.append((os.path.join(path, name), False, file_state))
+            elif old != file_state:
+                changes.modified.append(os.path.join(path, name))
+        for name, old in state.files.items():
+            if name not in files:
+                changes.removed.append([os.path.join(path, name), False, old, None])
+        for name in state.subdirs - subdirs:
+            sub_path = os.path.join(path, name)
+            changes.removed.append([sub_path, True, self._drop(sub_path), None])
+        for name in subdirs - state.subdirs:
+            sub_path = os.path.join(path, name)
+            self._build(sub_path)
+            changes.added.append((sub_path, True, None))
+        existing = state.subdirs & subdirs
+        state.ino = dir_stat.st_ino
+        state.mtime_ns = self._listed_mtime(dir_stat)
+        state.files = files
+        state.subdirs = subdirs
+        return existing
+
+    def _check_files(self, path, state, changes):
+        """目录内容未变时只检查已知文件的状态；有文件消失时返回False，改为重新列出目录"""
+        updated = []
+        for name, old in state.files.items():
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                return False
+            file_state = FILE_STATE.pack(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            if file_state != old:
+                updated.append((name, file_state))
+        for name, file_state in updated:
+            state.files[name] = file_state
+            changes.modified.append(os.path.join(path, name))
+        return True
+
+    def _resolve(self, changes):
+        """按inode将消失和新出现的条目配对为重命名，返回[(事件类型, 路径, 新路径, 是否目录), ...]
+
+        删除最先发送，随后是重命名（重命名目录中消失的条目紧跟在该目录的重命名之后删除），
+        最后是创建和修改。路径不变而inode改变的文件（编辑器保存时替换文件）按修改处理
+        """
+        deletes = []
+        by_inode = {}
+        for entry in changes.removed:
+            entry[3] = deletes
+            self._index_removed(by_inode, entry)
+        renames = []
+        creates = []
+        queue = collections.deque(changes.added)
+        while queue:
+            path, is_dir, file_state = queue.popleft()
+            if is_dir:
+                state = self.dirs.get(path)
+                inode = state.ino if state is not None else 0
+            else:
+                inode = FILE_STATE.unpack(file_state)[2]
+            source = by_inode.get((is_dir, inode))
+            if source is not None:
+                del by_inode[(is_dir, inode)]
+                # 已配对的条目不再删除
+                source[3] = None
+                moved_deletes = []
+                renames.append((source[0], path, is_dir, moved_deletes))
+                if is_dir:
+                    self._diff_moved(source, path, queue, by_inode, moved_deletes, changes)
+                elif source[2] != file_state:
+                    changes.modified.append(path)
+            elif is_dir:
+                # 新目录：逐个处理其中的条目，子目录可能是从别处移入的
+                state = self.dirs.get(path)
+                if state is not None:
+                    queue.extend((os.path.join(path, name), False, item) for name, item in state.files.items())
+                    queue.extend((os.path.join(path, name), True, None) for name in state.subdirs)
+            else:
+                creates.append(path)
+
+        for path, is_dir, _old, delete_list in changes.removed:
+            if delete_list is not None:
+                delete_list.append(('DELETE', path, None, is_dir))
+        events = deletes
+        for old_path, new_path, is_dir, moved_deletes in renames:
+            events.append(('RENAME', old_path, new_path, is_dir))
+            events.extend(moved_deletes)
+        events.extend(('CREATE', path, None, False) for path in creates)
+        events.extend(('MODIFY', path, None, False) for path in changes.modified)
+        return events
+
+    def _index_removed(self, by_inode, entry):
+        path, is_dir, old, _delete_list = entry
+        inode = old[path].ino if is_dir else FILE_STATE.unpack(old)[2]
+        # 部分文件系统不提供inode编号，不参与配对
+        if inode:
+            by_inode[(is_dir, inode)] = entry
+
+    def _diff_moved(self, source, new_top, queue, by_inode, moved_deletes, changes):
+        """对比重命名前的目录子树快照与新位置的快照，其中的变化继续参与配对"""
+        old_top, _is_dir, old_states, _delete_list = source
+        prefix = os.path.join(old_top, '')
+        moved = {new_top + path[len(old_top):]: state for path, state in old_states.items()
+                 if path == old_top or path.startswith(prefix)}
+        stack = [new_top]
+        while stack:
+            path = stack.pop()
+            old_state = moved[path]
+            state = self.dirs.get(path)
+            if state is None:
+                continue
+            for name, file_state in state.files.items():
+                old = old_state.files.get(name)
+                if old is None:
+                    queue.append((os.path.join(path, name), False, file_state))
+                elif old != file_state:
+                    changes.modified.append(os.path.join(path, name))
+            for name, old in old_state.files.items():
+                if name not in state.files:
+                    self._add_moved_removed(os.path.join(path, name), False, old, moved_deletes, by_inode, changes)
+            for name in old_state.subdirs - state.subdirs:
+                self._add_moved_removed(os.path.join(path, name), True, moved, moved_deletes, by_inode, changes)
+            for name in state.subdirs - old_state.subdirs:
+                queue.append((os.path.join(path, name), True, None))
+            stack.extend(os.path.join(path, name) for name in state.subdirs & old_state.subdirs)
+
+    def _add_moved_removed(self, path, is_dir, old, moved_deletes, by_inode, changes):
+        """重命名目录中消失的条目：在该目录的重命名之后删除，也可能与别处新出现的条目配对"""
+        entry = [path, is_dir, old, moved_deletes]
+        changes.removed.append(entry)
+        self._index_removed(by_inode, entry)
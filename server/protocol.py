@@ -0,0 +1,136 @@
+import struct
+import urllib.parse
+
+# 协议版本：1为换行分隔的文本协议，2为长度前缀的二进制帧协议
+TEXT_PROTOCOL_VERSION = 1
+BINARY_PROTOCOL_VERSION = 2
+
+# 帧头：长度(不含自身) 版本 类型 标志 序号 路径长度 新路径长度
+FRAME_HEADER = struct.Struct('>IBBHQII')
+# 长度字段之后的帧头大小
+FRAME_HEADER_BODY_SIZE = FRAME_HEADER.size - 4
+
+# 事件类型与帧类型的对应关系
+FRAME_TYPES = {
+    'CREATE': 1,
+    'MODIFY': 2,
+    'DELETE': 3,
+    'RENAME': 4,
+}
+# 批量帧：负载为连续的多个事件帧
+BATCH_FRAME_TYPE = 5
+# 重新同步帧：服务端丢弃了发给该客户端的事件，客户端需要重新对比目录
+RESYNC_FRAME_TYPE = 6
+# 压缩帧：标志位为压缩算法编号，负载为压缩后的事件帧序列
+COMPRESSED_FRAME_TYPE = 7
+# 序号水位帧：只订阅部分路径的客户端在该序号之前没有未收到的相关事件，用于推进续传位置
+WATERMARK_FRAME_TYPE = 8
+
+# 事件帧标志位：路径是目录，DELETE/RENAME作用于整个子树
+FLAG_DIR = 0x1
+
+
+def encode_path(file_path):
+    """对文本协议中的路径进行URL编码，处理特殊字符"""
+    return urllib.parse.quote(file_path, safe='')
+
+
+def encode_text_event(event_type, file_path, new_file_path=None):
+    """编码为文本协议消息：事件类型|文件路径|可选新路径"""
+    if event_type == 'RENAME' and new_file_path:
+        message = f"{event_type}|{encode_path(file_path)}|{encode_path(new_file_path)}\n"
+    else:
+        message = f"{event_type}|{encode_path(file_path)}\n"
+    return message.encode('utf-8')
+
+
+def encode_event_frame(event_type, file_path, new_file_path=None, sequence=0, flags=0):
+    """编码为二进制帧，路径使用原始UTF-8字节"""
+    path_bytes = file_path.encode('utf-8', 'surrogateescape')
+    new_path_bytes = new_file_path.encode('utf-8', 'surrogateescape') if new_file_path else b''
+    length = FRAME_HEADER_BODY_SIZE + len(path_bytes) + len(new_path_bytes)
+    header = FRAME_HEADER.pack(length, BINARY_PROTOCOL_VERSION, FRAME_TYPES[event_type],
+                               flags, sequence, len(path_bytes), len(new_path_bytes))
+    return header + path_bytes + new_path_bytes
+
+
+def encode_batch_frame(frames, sequence=0):
+    """将多个事件帧合并为一个批量帧"""
+    payload = b''.join(frames)
+    header = FRAME_HEADER.pack(FRAME_HEADER_BODY_SIZE + len(payload), BINARY_PROTOCOL_VERSION,
+                               BATCH_FRAME_TYPE, 0, sequence, 0, 0)
+    return header + payload
+
+
+def encode_resync_frame(sequence=0):
+    """编码重新同步通知帧"""
+    return FRAME_HEADER.pack(FRAME_HEADER_BODY_SIZE, BINARY_PROTOCOL_VERSION,
+                             RESYNC_FRAME_TYPE, 0, sequence, 0, 0)
+
+
+def encode_watermark_frame(sequence):
+    """编码序号水位帧"""
+    return FRAME_HEADER.pack(FRAME_HEADER_BODY_SIZE, BINARY_PROTOCOL_VERSION,
+                             WATERMARK_FRAME_TYPE, 0, sequence, 0, 0)
+
+
+def encode_compressed_frame(codec_id, payload):
+    """将压缩后的事件帧序列封装为压缩帧"""
+    header = FRAME_HEADER.pack(FRAME_HEADER_BODY_SIZE + len(payload), BINARY_PROTOCOL_VERSION,
+                               COMPRESSED_FRAME_TYPE, codec_id, 0, 0, 0)
+    return header + payload
+
+
+def parse_hello(line):
+    """解析客户端握手行HELLO|版本，返回协商后的协议版本，不是握手行时返回None"""
+    parts = line.split('|')
+    if parts[0] != 'HELLO':
+        return None
+    try:
+        version = int(parts[1])
+    except (IndexError, ValueError):
+        return TEXT_PROTOCOL_VERSION
+    return min(version, BINARY_PROTOCOL_VERSION)
+
+
+def parse_hello_codecs(line):
+    """解析握手行HELLO|版本|日志标识|最后收到的序号|压缩算法列表中客户端支持的压缩算法"""
+    parts = line.split('|')
+    if parts[0] != 'HELLO' or len(parts) < 5:
+        return []
+    return [name for name in parts[4].split(',') if name]
+
+
+def parse_resume(line):
+    """解析握手行HELLO|版本|日志标识|最后收到的序号中的续传信息，没有时返回None"""
+    parts = line.split('|')
+    if parts[0] != 'HELLO' or len(parts) < 4:
+        return None
+    try:
+        return parts[2], int(parts[3])
+    except ValueError:
+        return None
+
+
+def parse_hello_subscriptions(line):
+    """解析握手行HELLO|版本|日志标识|最后收到的序号|压缩算法列表|订阅列表中的订阅模式
+
+    订阅列表为逗号分隔、URL编码的路径前缀或glob模式，没有时返回空列表（订阅全部事件）
+    """
+    parts = line.split('|')
+    if parts[0] != 'HELLO' or len(parts) < 6:
+        return []
+    return [urllib.parse.unquote(pattern) for pattern in parts[5].split(',') if pattern]
+
+
+def iter_frames(data):
+    """遍历连续的单个帧（如事件日志中的数据），返回(帧类型, 标志, 序号, 路径, 新路径, 帧数据)"""
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, _, frame_type, flags, sequence, path_length, new_path_length = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + FRAME_HEADER.size
+        end = offset + 4 + length
+        path = data[start:start + path_length].decode('utf-8', 'surrogateescape')
+        new_path = data[start + path_length:start + path_length + new_path_length].decode('utf-8', 'surrogateescape')
+        yield frame_type, flags, sequence, path, new_path, data[offset:end]
+        offset = end
@@ -0,0 +1,152 @@
+import re
+
+from path_filter import translate_pattern
+
+# 含有这些字符的路径组件按glob模式匹配，之前的组件作为订阅前缀
+GLOB_CHARS = '*?[\\'
+
+
+class Subscription:
+    def __init__(self, pattern):
+        """一条订阅：相对于监控目录的路径前缀（如 projects/a）或glob模式（如 docs/**/*.pdf）
+
+        前缀订阅匹配该路径本身及其下的所有路径；glob模式匹配的目录下的路径也被订阅。
+        prefix为第一个含通配符的组件之前的路径组件，用于前缀索引和扫描时剪枝
+        """
+        self.pattern = pattern.strip().strip('/')
+        components = [component for component in self.pattern.split('/') if component]
+        prefix = []
+        for component in components:
+            if any(c in component for c in GLOB_CHARS):
+                break
+            prefix.append(component)
+        self.prefix = tuple(prefix)
+        self.prefix_path = '/'.join(prefix)
+        self.regex = None
+        if len(prefix) < len(components):
+            self.regex = re.compile(translate_pattern('/' + '/'.join(components)), re.DOTALL)
+
+    def matches(self, relative_path):
+        """相对路径（/分隔）是否被订阅"""
+        if self.prefix_path and relative_path != self.prefix_path and \
+                not relative_path.startswith(self.prefix_path + '/'):
+            return False
+        if self.regex is None:
+            return True
+        # glob模式匹配路径本身或其上级目录
+        path = relative_path
+        while len(path) > len(self.prefix_path):
+            if self.regex.fullmatch(path):
+                return True
+            path = path.rpartition('/')[0]
+        return False
+
+    def may_contain(self, relative_dir):
+        """目录中是否可能有被订阅的路径：是订阅前缀的上级目录或位于订阅前缀下"""
+        if not relative_dir or not self.prefix_path:
+            return True
+        return relative_dir == self.prefix_path or relative_dir.startswith(self.prefix_path + '/') or \
+            self.prefix_path.startswith(relative_dir + '/')
+
+    def wants(self, relative_path, is_dir=False):
+        """是否需要收到该路径的事件：目录事件作用于整个子树，子树中有订阅的路径时也需要"""
+        return self.matches(relative_path) or (is_dir and self.may_contain(relative_path))
+
+
+def parse_subscriptions(patterns):
+    """解析订阅模式列表，返回Subscription列表；空列表或包含根目录时表示订阅全部事件"""
+    subscriptions = []
+    for pattern in patterns:
+        if not pattern.strip():
+            continue
+        subscription = Subscription(pattern)
+        if not subscription.prefix and subscription.regex is None:
+            return []
+        subscriptions.append(subscription)
+    return subscriptions
+
+
+class IndexNode:
+    def __init__(self):
+        """前缀索引中的一级目录"""
+        self.children = {}
+        # 以该目录为前缀的前缀订阅者
+        self.prefix_subscribers = set()
+        # 前缀为该目录的glob订阅：订阅者 -> [Subscription, ...]
+        self.glob_subscribers = {}
+
+    def is_empty(self):
+        return not (self.children or self.prefix_subscribers or self.glob_subscribers)
+
+
+class SubscriptionIndex:
+    def __init__(self):
+        """按订阅前缀组织的目录树，将事件路径映射到订阅者
+
+        事件只沿自身路径的各级目录查找，代价取决于路径深度和实际匹配的订阅数，与订阅者总数无关；
+        没有订阅条件的订阅者接收全部事件，不进入目录树
+        """
+        self.root = IndexNode()
+        # 接收全部事件的订阅者
+        self.everything = set()
+        # 有订阅条件的订阅者 -> [Subscription, ...]
+        self.filtered = {}
+
+    def add(self, subscriber, subscriptions):
+        """登记订阅者，subscriptions为空时接收全部事件"""
+        if not subscriptions:
+            self.everything.add(subscriber)
+            return
+        self.filtered[subscriber] = subscriptions
+        for subscription in subscriptions:
+            node = self.root
+            for component in subscription.prefix:
+                node = node.children.setdefault(component, IndexNode())
+            if subscription.regex is None:
+                node.prefix_subscribers.add(subscriber)
+            else:
+                node.glob_subscribers.setdefault(subscriber, []).append(subscription)
+
+    def remove(self, subscriber):
+        """移除订阅者及其订阅，删除不再使用的目录节点"""
+        self.everything.discard(subscriber)
+        for subscription in self.filtered.pop(subscriber, ()):
+            nodes = [self.root]
+            for component in subscription.prefix:
+                node = nodes[-1].children.get(component)
+                if node is None:
+                    break
+                nodes.append(node)
+            else:
+                nodes[-1].prefix_subscribers.discard(subscriber)
+                nodes[-1].glob_subscribers.pop(subscriber, None)
+                for depth in range(len(nodes) - 1, 0, -1):
+                    if not nodes[depth].is_empty():
+                        break
+                    del nodes[depth - 1].children[subscription.prefix[depth - 1]]
+
+    def lookup(self, relative_path, is_dir, result):
+        """将需要收到该路径事件的有订阅条件的订阅者加入集合result"""
+        node = self.root
+        self._match_globs(node, relative_path, is_dir, result)
+        for component in relative_path.split('/') if relative_path else ():
+            node = node.children.get(component)
+            if node is None:
+                return
+            result.update(node.prefix_subscribers)
+            self._match_globs(node, relative_path, is_dir, result)
+        if is_dir:
+            # 目录事件作用于整个子树，订阅前缀位于该目录下的订阅者也需要收到
+            stack = list(node.children.values())
+            while stack:
+                node = stack.pop()
+                result.update(node.prefix_subscribers)
+                result.update(node.glob_subscribers)
+                stack.extend(node.children.values())
+
+    @staticmethod
+    def _match_globs(node, relative_path, is_dir, result):
+        for subscriber, subscriptions in node.glob_subscribers.items():
+            if subscriber not in result and (
+                    is_dir or any(subscription.matches(relative_path) for subscription in subscriptions)):
+                result.add(subscriber)
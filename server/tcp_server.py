@@ -1,17 +1,179 @@
+import collections
+import os
+import selectors
 import socket
 import threading
 import time
 
+from compression import CODEC_IDS, MIN_COMPRESS_SIZE, choose_codec, compress
+from metrics import REGISTRY
+from protocol import (BINARY_PROTOCOL_VERSION, FLAG_DIR, FRAME_HEADER, RESYNC_FRAME_TYPE, TEXT_PROTOCOL_VERSION,
+                      encode_batch_frame, encode_compressed_frame, encode_event_frame, encode_resync_frame,
+                      encode_text_event, encode_watermark_frame, iter_frames, parse_hello, parse_hello_codecs, parse_hello_subscriptions,
+                      parse_resume)
+from subscriptions import SubscriptionIndex, parse_subscriptions
+
+# 新连接等待首行请求的时间（秒），超时未发送请求的连接视为普通事件订阅客户端
+HANDSHAKE_TIMEOUT = 1.0
+# 每次从套接字读取的最大字节数
+RECV_SIZE = 65536
+# 向只订阅部分路径、跳过了部分广播的客户端发送序号水位的最小间隔（秒）
+WATERMARK_INTERVAL = 5.0
+
+# 发送队列溢出策略：resync=丢弃积压事件并通知客户端重新同步，disconnect=断开连接
+OVERFLOW_RESYNC = 'resync'
+OVERFLOW_DISCONNECT = 'disconnect'
+
+BROADCAST_FANOUT = REGISTRY.histogram('filesync_server_broadcast_fanout_seconds',
+                                      'Time to queue one broadcast batch to all subscribers')
+BROADCAST_EVENTS = REGISTRY.counter('filesync_server_broadcast_events_total', 'Events broadcast to subscribers')
+BYTES_SENT = REGISTRY.counter('filesync_server_event_bytes_sent_total', 'Bytes sent on event connections')
+QUEUE_OVERFLOWS = REGISTRY.counter('filesync_server_queue_overflows_total',
+                                   'Subscriber send queue overflows', ('policy',))
+SUBSCRIBERS = REGISTRY.gauge('filesync_server_subscribers', 'Connected event subscribers')
+CLIENT_QUEUE_BYTES = REGISTRY.gauge('filesync_server_client_queue_bytes',
+                                    'Bytes queued for each subscriber', ('client',))
+DATA_CONNECTIONS = REGISTRY.gauge('filesync_server_data_connections', 'Open data channel connections')
+FILTERED_SUBSCRIBERS = REGISTRY.gauge('filesync_server_filtered_subscribers',
+                                      'Connected subscribers with path subscriptions')
+ROUTED_EVENTS = REGISTRY.counter('filesync_server_routed_events_total',
+                                 'Events sent to subscribers with path subscriptions')
+
+
+class SocketStream:
+    def __init__(self, sock, initial_data=b''):
+        """带缓冲的套接字读写封装，用于数据通道按行/按长度读取"""
+        self.sock = sock
+        self.buffer = bytearray(initial_data)
+        # 数据通道协商的压缩算法，None表示不压缩
+        self.codec = None
+
+    def readline(self):
+        """读取一行（不含换行符），连接关闭时返回None"""
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 1]
+                return line.decode('utf-8')
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+
+    def read_exact(self, size):
+        """读取指定长度的数据，连接提前关闭时返回None"""
+        while len(self.buffer) < size:
+            data = self.sock.recv(max(65536, size - len(self.buffer)))
+            if not data:
+                return None
+            self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def sendall(self, data):
+        """发送全部数据"""
+        self.sock.sendall(data)
+
+
+class ClientConnection:
+    def __init__(self, sock, addr):
+        """事件循环中的一个客户端连接（握手中或已订阅）"""
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        # 待发送的数据块及首个数据块已发送的字节数
+        self.outbuf = collections.deque()
+        self.out_offset = 0
+        self.queued_bytes = 0
+        self.dropped_events = 0
+        # 重新同步通知已入队但尚未发送完毕，期间的广播直接丢弃
+        self.resync_pending = False
+        # 连接建立时事件循环已分发的最后一个事件序号
+        self.start_sequence = 0
+        self.writing = False
+        # 协商的协议版本，None表示仍在握手
+        self.protocol_version = None
+        # 协商的事件流压缩算法，None表示不压缩
+        self.codec = None
+        # 握手期间需要补发的广播（Broadcast）
+        self.pending_events = []
+        # 订阅的路径前缀或glob模式（Subscription），空表示接收全部事件
+        self.subscriptions = []
+        # 已告知客户端的最大序号（事件或水位），只用于订阅了部分路径的连接
+        self.sent_sequence = 0
+        self.handshake_deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+        self.closed = False
+
+
+class Broadcast:
+    def __init__(self, last_sequence, encoded, events=None, frames=None, text_lines=None):
+        """一次广播：按协议版本编码的完整数据，以及按订阅过滤时使用的原始事件、各事件的二进制帧和文本行"""
+        self.last_sequence = last_sequence
+        self.encoded = encoded
+        self.events = events
+        self.frames = frames
+        self.text_lines = text_lines
+
+
 class TCPServer:
-    def __init__(self, host, port):
-        """初始化TCP服务器"""
+    def __init__(self, host, port, request_handler=None, send_queue_limit=16 * 1024 * 1024,
+                 overflow_policy=OVERFLOW_RESYNC, journal=None, codecs=None, root_dir=None):
+        """初始化TCP服务器
+
+        所有订阅连接由一个事件循环线程（selectors）处理；
+        request_handler(stream, first_line)用于处理数据通道请求，数据连接交给独立线程阻塞处理，
+        未提供时所有连接都作为事件订阅客户端处理。
+        每个订阅连接的发送队列最多积压send_queue_limit字节，超出时按overflow_policy处理。
+        journal为已打开的EventJournal时，所有广播事件写入日志，重连的客户端可从日志补发缺失的事件；
+        codecs为允许的压缩算法列表（按优先顺序），二进制客户端在握手时协商，之后每批事件压缩后发送；
+        root_dir为监控目录，客户端握手时可订阅其下的路径前缀或glob模式，只接收匹配的事件
+        """
         self.host = host
         self.port = port
+        self.request_handler = request_handler
+        self.send_queue_limit = send_queue_limit
+        self.overflow_policy = overflow_policy
+        self.journal = journal
+        self.codecs = codecs or []
+        self.root_dir = os.path.abspath(root_dir) if root_dir else None
         self.server_socket = None
-        self.clients = []
+        self.selector = None
+        # 已订阅的客户端：socket -> ClientConnection
+        self.clients = {}
+        # 握手中的客户端，按到期时间排序
+        self.handshaking = collections.OrderedDict()
+        # 正在后台线程中读取日志补发数据的客户端，完成后的结果由事件循环取出
+        self.resuming = {}
+        self.resume_results = collections.deque()
+        self.data_clients = set()
         self.clients_lock = threading.Lock()
+        # 订阅连接按订阅前缀索引，只在事件循环线程中访问
+        self.subscriptions = SubscriptionIndex()
+        # 下次发送序号水位的时间，None表示没有跳过广播的客户端
+        self.watermark_deadline = None
+        # 其他线程提交、由事件循环分发的广播
+        self.broadcast_queue = collections.deque()
+        self.broadcast_lock = threading.Lock()
+        # 广播事件序号及事件循环已分发的最后一个序号，使用日志时启动后从日志中最后一个序号继续
+        self.sequence = 0
+        self.dispatched_sequence = 0
+        self.wakeup_reader = None
+        self.wakeup_writer = None
         self.running = False
         self.server_thread = None
+        SUBSCRIBERS.set_function(self.get_client_count)
+        CLIENT_QUEUE_BYTES.set_function(self._queue_depths)
+        DATA_CONNECTIONS.set_function(lambda: len(self.data_clients))
+        FILTERED_SUBSCRIBERS.set_function(lambda: len(self.subscriptions.filtered))
+    
+    def _queue_depths(self):
+        """各订阅连接发送队列中积压的字节数"""
+        with self.clients_lock:
+            connections = list(self.clients.values())
+        return {(f"{connection.addr[0]}:{connection.addr[1]}",): connection.queued_bytes
+                for connection in connections}
     
     def start(self):
         """启动TCP服务器"""
@@ -27,11 +189,23 @@ class TCPServer:
             self.server_socket.bind((self.host, self.port))
             
             # 开始监听
-            self.server_socket.listen(5)
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.server_socket.setblocking(False)
+            
+            # 用于从其他线程唤醒事件循环
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+            
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.server_socket, selectors.EVENT_READ, 'accept')
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ, 'wakeup')
+            if self.journal is not None:
+                self.sequence = self.dispatched_sequence = self.journal.last_sequence
             self.running = True
             
-            # 启动服务器线程
-            self.server_thread = threading.Thread(target=self._accept_clients)
+            # 启动事件循环线程
+            self.server_thread = threading.Thread(target=self._event_loop)
             self.server_thread.daemon = True
             self.server_thread.start()
             
@@ -47,106 +221,607 @@ class TCPServer:
             return
         
         self.running = False
+        self._wakeup()
+        
+        # 等待事件循环线程结束，订阅连接由事件循环在退出时关闭
+        if self.server_thread:
+            self.server_thread.join(5)
         
-        # 关闭所有客户端连接
+        # 关闭数据连接
         with self.clients_lock:
-            for client in self.clients:
+            for client in list(self.data_clients):
                 try:
                     client.close()
                 except Exception as e:
                     print(f"Error closing client: {e}")
-            self.clients.clear()
+            self.data_clients.clear()
+        
+        print("TCP Server stopped")
+    
+    def _wakeup(self):
+        """唤醒事件循环"""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # 缓冲区已满说明已有未处理的唤醒
+            pass
+    
+    def _event_loop(self):
+        """事件循环：接受连接、完成握手、读写所有订阅连接"""
+        try:
+            while self.running:
+                events = self.selector.select(self._select_timeout())
+                for key, mask in events:
+                    if key.data == 'accept':
+                        self._accept_clients()
+                    elif key.data == 'wakeup':
+                        self._drain_wakeup()
+                    else:
+                        connection = key.data
+                        if mask & selectors.EVENT_READ:
+                            self._on_readable(connection)
+                        if mask & selectors.EVENT_WRITE and not connection.closed:
+                            self._on_writable(connection)
+                
+                self._dispatch_broadcasts()
+                self._finish_resumes()
+                self._expire_handshakes()
+                self._send_watermarks()
+        except Exception as e:
+            if self.running:
+                print(f"TCP server event loop error: {e}")
+        finally:
+            self._close_all()
+    
+    def _close_all(self):
+        """关闭所有订阅连接和监听套接字"""
+        for connection in list(self.clients.values()) + list(self.handshaking.values()) + \
+                list(self.resuming.values()):
+            self._close_connection(connection, quiet=True)
         
-        # 关闭服务器套接字
-        if self.server_socket:
+        for sock in (self.server_socket, self.wakeup_reader, self.wakeup_writer):
             try:
-                self.server_socket.close()
+                sock.close()
             except Exception as e:
                 print(f"Error closing server socket: {e}")
         
-        # 等待服务器线程结束
-        if self.server_thread:
-            self.server_thread.join(1)
-        
-        print("TCP Server stopped")
+        try:
+            self.selector.close()
+        except Exception:
+            pass
+    
+    def _drain_wakeup(self):
+        """清空唤醒套接字"""
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
     
     def _accept_clients(self):
-        """接受客户端连接"""
-        while self.running:
+        """接受所有等待中的客户端连接"""
+        while True:
             try:
-                # 设置超时，方便退出循环
-                self.server_socket.settimeout(1)
                 client_socket, client_addr = self.server_socket.accept()
-                
-                # 添加客户端到列表
-                with self.clients_lock:
-                    self.clients.append(client_socket)
-                
-                print(f"Client connected: {client_addr}")
-                
-                # 启动客户端处理线程
-                client_thread = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, client_addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-            except socket.timeout:
-                continue
+            except (BlockingIOError, InterruptedError):
+                return
             except Exception as e:
                 if self.running:
                     print(f"Error accepting client: {e}")
+                return
+            
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = ClientConnection(client_socket, client_addr)
+            # 之后分发的广播都会补发给该连接，握手确认时告知客户端从这里开始接收
+            connection.start_sequence = self.dispatched_sequence
+            
+            # 握手完成前先放入等待列表，期间的广播事件会被暂存
+            self.handshaking[client_socket] = connection
+            self.selector.register(client_socket, selectors.EVENT_READ, connection)
+            print(f"Client connected: {client_addr}")
+    
+    def _handshake_timeout(self):
+        """距最早的握手到期的时间，没有握手中的连接时返回None"""
+        for connection in self.handshaking.values():
+            return max(0.0, connection.handshake_deadline - time.monotonic())
+        return None
+    
+    def _select_timeout(self):
+        """距最早的握手到期或下次发送序号水位的时间，都没有时返回None"""
+        timeout = self._handshake_timeout()
+        if self.watermark_deadline is not None:
+            watermark_timeout = max(0.0, self.watermark_deadline - time.monotonic())
+            timeout = watermark_timeout if timeout is None else min(timeout, watermark_timeout)
+        return timeout
+    
+    def _send_watermarks(self):
+        """向跳过了部分广播的订阅客户端发送序号水位，客户端据此推进续传位置，
+        长时间没有相关事件的客户端重连时也能从日志续传；每WATERMARK_INTERVAL秒最多扫描一次
+        """
+        if self.watermark_deadline is None or time.monotonic() < self.watermark_deadline:
+            return
+        self.watermark_deadline = None
+        frame = None
+        for connection in list(self.subscriptions.filtered):
+            if connection.sent_sequence >= self.dispatched_sequence or \
+                    connection.protocol_version < BINARY_PROTOCOL_VERSION:
+                continue
+            if frame is None:
+                frame = {BINARY_PROTOCOL_VERSION: encode_watermark_frame(self.dispatched_sequence)}
+            connection.sent_sequence = self.dispatched_sequence
+            self._queue_event(connection, frame)
+    
+    def _schedule_watermarks(self):
+        if self.watermark_deadline is None:
+            self.watermark_deadline = time.monotonic() + WATERMARK_INTERVAL
+    
+    def _expire_handshakes(self):
+        """握手超时仍未发送首行的连接作为旧版本文本协议客户端处理"""
+        now = time.monotonic()
+        while self.handshaking:
+            connection = next(iter(self.handshaking.values()))
+            if connection.handshake_deadline > now:
                 break
+            self._promote_client(connection, TEXT_PROTOCOL_VERSION)
+    
+    def _on_readable(self, connection):
+        """处理连接上的可读事件"""
+        try:
+            data = connection.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            data = b''
+        
+        if not data:
+            self._close_connection(connection)
+            return
+        
+        if connection.protocol_version is not None or connection.sock in self.resuming:
+            # 订阅客户端目前不需要发送消息
+            return
+        
+        connection.inbuf += data
+        index = connection.inbuf.find(b'\n')
+        if index < 0:
+            return
+        
+        first_line = connection.inbuf[:index].decode('utf-8').strip()
+        initial_data = bytes(connection.inbuf[index + 1:])
+        connection.inbuf.clear()
+        
+        protocol_version = parse_hello(first_line)
+        if protocol_version is None and first_line and self.request_handler:
+            self._start_data_connection(connection, first_line, initial_data)
+            return
+        # 未发送握手行的旧版本客户端使用文本协议
+        if protocol_version is not None and protocol_version >= BINARY_PROTOCOL_VERSION:
+            connection.codec = choose_codec(parse_hello_codecs(first_line), self.codecs)
+        if protocol_version is not None:
+            self._set_subscriptions(connection, parse_hello_subscriptions(first_line))
+        resume = parse_resume(first_line)
+        if resume is not None and protocol_version is not None and protocol_version >= BINARY_PROTOCOL_VERSION:
+            journal_id, last_sequence = resume
+            if self.journal is not None and journal_id == self.journal.journal_id:
+                self._start_resume(connection, protocol_version, last_sequence)
+                return
+            # 日志已不同（服务端重建了日志或未启用日志），无法补发
+            resume = (last_sequence, None)
+        else:
+            resume = None
+        self._promote_client(connection, protocol_version or TEXT_PROTOCOL_VERSION, resume)
+    
+    def _set_subscriptions(self, connection, patterns):
+        """记录客户端握手时订阅的路径，未配置监控目录时无法按路径过滤，仍发送全部事件"""
+        if not patterns:
+            return
+        if self.root_dir is None:
+            print(f"Ignoring subscriptions from {connection.addr}: server root directory is not configured")
+            return
+        connection.subscriptions = parse_subscriptions(patterns)
+        if connection.subscriptions:
+            print(f"Client {connection.addr} subscribed to {', '.join(s.pattern for s in connection.subscriptions)}")
+    
+    def _promote_client(self, connection, protocol_version, resume=None):
+        """将握手阶段的连接加入订阅列表，并按协商的协议补发等待期间的广播事件
+
+        resume为(最后收到的序号, 日志中之后的事件帧)时先补发这些事件，事件帧为None时发送重新同步通知；
+        补发的事件与等待期间的事件可能重复，由客户端按序号去重
+        """
+        self.handshaking.pop(connection.sock, None)
+        connection.protocol_version = protocol_version
+        with self.clients_lock:
+            self.clients[connection.sock] = connection
+        self.subscriptions.add(connection, connection.subscriptions)
+        connection.sent_sequence = connection.start_sequence
+        
+        if protocol_version >= BINARY_PROTOCOL_VERSION:
+            # 确认使用二进制帧协议，此后该连接上只发送二进制帧；
+            # 使用日志时附带日志标识和本连接开始接收的序号，协商了压缩时附带压缩算法
+            welcome = [f"WELCOME|{BINARY_PROTOCOL_VERSION}"]
+            if self.journal is not None:
+                welcome += [self.journal.journal_id, str(connection.start_sequence)]
+            elif connection.codec:
+                welcome += ['', '']
+            if connection.codec:
+                welcome.append(connection.codec)
+            self._queue_send(connection, ('|'.join(welcome) + '\n').encode('utf-8'))
+            if resume is not None:
+                self._resume_client(connection, *resume)
+        for broadcast in connection.pending_events:
+            encoded = broadcast.encoded
+            if connection.subscriptions and broadcast.events is not None:
+                indices = [index for index, (path, new_path, is_dir) in enumerate(self._event_routes(broadcast))
+                           if self._wants(connection, path, is_dir) or self._wants(connection, new_path, is_dir)]
+                if not indices:
+                    self._schedule_watermarks()
+                    continue
+                if len(indices) < len(broadcast.events):
+                    encoded = self._encode_subset(broadcast, indices)
+                connection.sent_sequence = self._event_sequence(broadcast, indices[-1])
+            self._queue_event(connection, encoded)
+            if connection.closed:
+                return
+        connection.pending_events = None
+    
+    def _start_resume(self, connection, protocol_version, last_sequence):
+        """在独立线程中读取日志中需要补发的事件，不阻塞事件循环；期间的广播仍记入等待列表"""
+        self.handshaking.pop(connection.sock, None)
+        self.resuming[connection.sock] = connection
+        resume_thread = threading.Thread(target=self._read_replay,
+                                         args=(connection, protocol_version, last_sequence))
+        resume_thread.daemon = True
+        resume_thread.start()
+    
+    def _read_replay(self, connection, protocol_version, last_sequence):
+        """后台线程：读取日志，结果交给事件循环完成握手"""
+        try:
+            replay = self.journal.read_since(last_sequence, self.send_queue_limit)
+        except OSError as e:
+            print(f"Failed to read event journal: {e}")
+            replay = None
+        self.resume_results.append((connection, protocol_version, last_sequence, replay))
+        self._wakeup()
+    
+    def _finish_resumes(self):
+        """为已读取完日志的连接完成握手并补发事件"""
+        while self.resume_results:
+            connection, protocol_version, last_sequence, replay = self.resume_results.popleft()
+            self.resuming.pop(connection.sock, None)
+            if not connection.closed:
+                self._promote_client(connection, protocol_version, (last_sequence, replay))
+    
+    def _resume_client(self, connection, last_sequence, replay):
+        """补发客户端断线期间错过的事件，replay为None时日志已不包含这些事件"""
+        if replay is None:
+            print(f"Cannot resume {connection.addr} from sequence {last_sequence}, requesting resync")
+            connection.resync_pending = True
+            self._queue_send(connection, encode_resync_frame(self.sequence))
+            return
+        if replay and connection.subscriptions:
+            replay, replay_sequence = self._filter_replay(connection, replay)
+            connection.sent_sequence = max(connection.sent_sequence, replay_sequence)
+        if replay:
+            print(f"Resuming {connection.addr} from sequence {last_sequence}, replaying {len(replay)} bytes")
+            self._queue_send(connection, self._compress_frames(connection.codec, replay))
+    
+    def _filter_replay(self, connection, replay):
+        """只保留日志补发数据中客户端订阅的事件帧和重新同步帧，返回(补发数据, 最后一帧的序号)
+
+        跳过了末尾的事件时附加序号水位帧，客户端的续传位置推进到日志中的最后一个序号
+        """
+        frames = []
+        last_sequence = kept_sequence = 0
+        for frame_type, flags, sequence, path, new_path, frame in iter_frames(replay):
+            last_sequence = sequence
+            if frame_type != RESYNC_FRAME_TYPE:
+                is_dir = bool(flags & FLAG_DIR)
+                if not self._wants(connection, self._relative_path(path), is_dir) and not (
+                        new_path and self._wants(connection, self._relative_path(new_path), is_dir)):
+                    continue
+            frames.append(frame)
+            kept_sequence = sequence
+        if last_sequence > kept_sequence:
+            frames.append(encode_watermark_frame(last_sequence))
+        return b''.join(frames), last_sequence
+    
+    @staticmethod
+    def _wants(connection, relative_path, is_dir):
+        """连接是否订阅了该相对路径的事件，路径不在监控目录下（None）时不匹配"""
+        return relative_path is not None and any(subscription.wants(relative_path, is_dir) for subscription in connection.subscriptions)
+    
+    def _relative_path(self, path):
+        """事件路径转换为相对于监控目录的/分隔路径，不在监控目录下时返回None"""
+        if path == self.root_dir:
+            return ''
+        prefix = os.path.join(self.root_dir, '')
+        if not path.startswith(prefix):
+            return None
+        return path[len(prefix):].replace(os.sep, '/')
+    
+    def _event_routes(self, broadcast):
+        """广播中各事件的(相对路径, 新相对路径, 是否目录)，不在监控目录下的路径不匹配任何订阅"""
+        routes = []
+        for _event_type, file_path, new_file_path, is_dir in broadcast.events:
+            path = self._relative_path(file_path)
+            new_path = self._relative_path(new_file_path) if new_file_path else None
+            routes.append((path, new_path, is_dir))
+        return routes
     
-    def _handle_client(self, client_socket, client_addr):
-        """处理单个客户端连接"""
-        while self.running:
+    def _start_data_connection(self, connection, first_line, initial_data):
+        """将连接移出事件循环，交给独立线程阻塞处理数据请求"""
+        self.handshaking.pop(connection.sock, None)
+        self.selector.unregister(connection.sock)
+        client_socket = connection.sock
+        with self.clients_lock:
+            self.data_clients.add(client_socket)
+        
+        data_thread = threading.Thread(
+            target=self._serve_data_connection,
+            args=(client_socket, connection.addr, first_line, initial_data)
+        )
+        data_thread.daemon = True
+        data_thread.start()
+    
+    def _serve_data_connection(self, client_socket, client_addr, first_line, initial_data):
+        """处理数据通道连接"""
+        try:
+            client_socket.setblocking(True)
+            self.request_handler(SocketStream(client_socket, initial_data), first_line)
+        except Exception as e:
+            if self.running:
+                print(f"Data connection error from {client_addr}: {e}")
+        finally:
+            with self.clients_lock:
+                self.data_clients.discard(client_socket)
             try:
-                # 设置超时，方便退出循环
-                client_socket.settimeout(1)
-                
-                # 接收客户端消息（实际上客户端不需要发送消息）
-                data = client_socket.recv(1024)
-                if not data:
+                client_socket.close()
+            except Exception:
+                pass
+    
+    def _queue_send(self, connection, data):
+        """将数据加入连接的发送队列并尽量立即发送"""
+        connection.outbuf.append(data)
+        connection.queued_bytes += len(data)
+        if not connection.writing:
+            self._on_writable(connection)
+    
+    def _queue_event(self, connection, encoded):
+        """将广播事件加入订阅连接的发送队列，积压超过上限时按溢出策略处理"""
+        if connection.resync_pending:
+            connection.dropped_events += 1
+            return
+        
+        if connection.codec is None:
+            data = encoded.get(connection.protocol_version)
+            if data is None:
+                # 重新同步通知只发给二进制协议客户端
+                return
+        else:
+            # 同一批事件对每种压缩算法只压缩一次
+            data = encoded.get(connection.codec)
+            if data is None:
+                data = encoded[connection.codec] = self._compress_frames(
+                    connection.codec, encoded[BINARY_PROTOCOL_VERSION])
+        if connection.queued_bytes + len(data) <= self.send_queue_limit:
+            self._queue_send(connection, data)
+            return
+        
+        # 文本协议客户端无法重新同步，只能断开
+        if self.overflow_policy == OVERFLOW_DISCONNECT or \
+                connection.protocol_version < BINARY_PROTOCOL_VERSION:
+            QUEUE_OVERFLOWS.inc(policy=OVERFLOW_DISCONNECT)
+            print(f"Send queue overflow, disconnecting slow client {connection.addr}")
+            self._close_connection(connection)
+            return
+        
+        # 丢弃尚未开始发送的积压数据（正在发送的数据块需保持帧完整），改为发送重新同步通知
+        dropped = len(connection.outbuf) - (1 if connection.out_offset else 0)
+        while len(connection.outbuf) > (1 if connection.out_offset else 0):
+            connection.queued_bytes -= len(connection.outbuf.pop())
+        connection.dropped_events += dropped + 1
+        QUEUE_OVERFLOWS.inc(policy=OVERFLOW_RESYNC)
+        print(f"Send queue overflow for {connection.addr}, dropped {dropped + 1} queued broadcasts, "
+              f"requesting resync")
+        connection.resync_pending = True
+        self._queue_send(connection, encode_resync_frame(self.sequence))
+    
+    def _compress_frames(self, codec, frames):
+        """将事件帧序列压缩为一个压缩帧，未协商压缩、数据太小或压缩无效时原样返回"""
+        if codec is None or len(frames) < MIN_COMPRESS_SIZE:
+            return frames
+        compressed = compress(codec, frames)
+        if FRAME_HEADER.size + len(compressed) >= len(frames):
+            return frames
+        return encode_compressed_frame(CODEC_IDS[codec], compressed)
+    
+    def _on_writable(self, connection):
+        """发送连接队列中的数据，发送不完时等待可写事件"""
+        outbuf = connection.outbuf
+        total_sent = 0
+        try:
+            while outbuf:
+                view = memoryview(outbuf[0])[connection.out_offset:]
+                sent = connection.sock.send(view)
+                connection.queued_bytes -= sent
+                total_sent += sent
+                if sent < len(view):
+                    connection.out_offset += sent
                     break
-                    
-                # 这里可以处理客户端消息（如果需要）
-                # print(f"Received from {client_addr}: {data.decode()}")
-            except socket.timeout:
-                continue
-            except Exception as e:
-                break
+                outbuf.popleft()
+                connection.out_offset = 0
+            # 重新同步通知总是队列中的最后一项，队列清空即已送达
+            if not outbuf:
+                connection.resync_pending = False
+        except (BlockingIOError, InterruptedError):
+            pass
+        except Exception as e:
+            print(f"Error sending to client {connection.addr}: {e}")
+            self._close_connection(connection)
+            return
+        finally:
+            if total_sent:
+                BYTES_SENT.inc(total_sent)
+        
+        # 根据是否还有待发送数据调整关注的事件
+        if outbuf and not connection.writing:
+            connection.writing = True
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        elif not outbuf and connection.writing:
+            connection.writing = False
+            self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+    
+    def _close_connection(self, connection, quiet=False):
+        """关闭连接并从所有列表中移除"""
+        if connection.closed:
+            return
+        connection.closed = True
+        was_subscriber = connection.protocol_version is not None
         
-        # 客户端断开连接
+        self.handshaking.pop(connection.sock, None)
+        self.resuming.pop(connection.sock, None)
         with self.clients_lock:
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
+            self.clients.pop(connection.sock, None)
+        self.subscriptions.remove(connection)
         
         try:
-            client_socket.close()
+            self.selector.unregister(connection.sock)
+        except Exception:
+            pass
+        try:
+            connection.sock.close()
         except Exception as e:
             print(f"Error closing client socket: {e}")
         
-        print(f"Client disconnected: {client_addr}")
+        if was_subscriber and not quiet:
+            print(f"Client disconnected: {connection.addr}")
     
-    def broadcast(self, message):
-        """向所有客户端广播消息"""
-        if not self.running:
+    def _dispatch_broadcasts(self):
+        """在事件循环中把已编码的广播分发到各连接的发送队列"""
+        while self.broadcast_queue:
+            broadcast = self.broadcast_queue.popleft()
+            start_time = time.perf_counter()
+            BROADCAST_EVENTS.inc(broadcast.last_sequence - self.dispatched_sequence)
+            self.dispatched_sequence = broadcast.last_sequence
+            for connection in self.handshaking.values():
+                connection.pending_events.append(broadcast)
+            for connection in self.resuming.values():
+                connection.pending_events.append(broadcast)
+            for connection in list(self.subscriptions.everything):
+                self._queue_event(connection, broadcast.encoded)
+            if self.subscriptions.filtered:
+                self._dispatch_filtered(broadcast)
+            BROADCAST_FANOUT.observe(time.perf_counter() - start_time)
+    
+    def _dispatch_filtered(self, broadcast):
+        """将广播中的事件按前缀索引只发给订阅了对应路径的连接
+
+        RENAME在原路径或新路径被订阅时都发送，由客户端按自己的订阅转换为创建或删除；
+        订阅了相同事件子集的连接共用一次编码
+        """
+        if broadcast.events is None:
+            # 重新同步通知发给所有二进制协议客户端
+            for connection in list(self.subscriptions.filtered):
+                connection.sent_sequence = broadcast.last_sequence
+                self._queue_event(connection, broadcast.encoded)
             return
         
-        # 确保消息以换行符结尾
-        if not message.endswith('\n'):
-            message += '\n'
+        selected = {}
+        for index, (path, new_path, is_dir) in enumerate(self._event_routes(broadcast)):
+            matched = set()
+            if path is not None:
+                self.subscriptions.lookup(path, is_dir, matched)
+            if new_path is not None:
+                self.subscriptions.lookup(new_path, is_dir, matched)
+            for connection in matched:
+                selected.setdefault(connection, []).append(index)
         
-        # 发送消息给所有客户端
-        with self.clients_lock:
-            for client in self.clients:
+        if len(selected) < len(self.subscriptions.filtered):
+            # 部分客户端跳过了这批广播，稍后告知其序号水位
+            self._schedule_watermarks()
+        
+        subsets = {}
+        for connection, indices in selected.items():
+            if len(indices) == len(broadcast.events):
+                encoded = broadcast.encoded
+            else:
+                key = tuple(indices)
+                encoded = subsets.get(key)
+                if encoded is None:
+                    encoded = subsets[key] = self._encode_subset(broadcast, indices)
+            ROUTED_EVENTS.inc(len(indices))
+            connection.sent_sequence = self._event_sequence(broadcast, indices[-1])
+            self._queue_event(connection, encoded)
+    
+    @staticmethod
+    def _event_sequence(broadcast, index):
+        """广播中第index个事件的序号"""
+        return broadcast.last_sequence - len(broadcast.frames) + 1 + index
+    
+    def _encode_subset(self, broadcast, indices):
+        """按协议版本编码广播中的部分事件，复用已编码的单个事件帧和文本行"""
+        frames = [broadcast.frames[index] for index in indices]
+        first_sequence = self._event_sequence(broadcast, indices[0])
+        return {
+            TEXT_PROTOCOL_VERSION: b''.join(broadcast.text_lines[index] for index in indices),
+            BINARY_PROTOCOL_VERSION: frames[0] if len(frames) == 1 else encode_batch_frame(frames, first_sequence),
+        }
+    
+    def broadcast(self, event_type, file_path, new_file_path=None, is_dir=False):
+        """向所有客户端广播单个文件事件"""
+        self.broadcast_events([(event_type, file_path, new_file_path, is_dir)])
+    
+    def broadcast_events(self, events):
+        """向所有客户端广播一批文件事件[(事件类型, 路径, 新路径, 是否目录), ...]，订阅了路径的客户端只收到匹配的事件
+
+        目录事件在二进制帧中设置FLAG_DIR，文本协议没有标志位，客户端按本地路径判断；
+        每种协议只编码一次：二进制客户端收到一个批量帧，文本客户端收到一次写入的多行消息；
+        实际发送由事件循环完成，每个客户端有独立的有界发送队列，调用方和其他客户端不会被慢速客户端阻塞
+        """
+        if not self.running or not events:
+            return
+        
+        with self.broadcast_lock:
+            first_sequence = self.sequence + 1
+            frames = []
+            for event_type, file_path, new_file_path, is_dir in events:
+                self.sequence += 1
+                frames.append(encode_event_frame(event_type, file_path, new_file_path, self.sequence,
+                                                 FLAG_DIR if is_dir else 0))
+            if self.journal is not None:
                 try:
-                    client.sendall(message.encode('utf-8'))
-                except Exception as e:
-                    print(f"Error broadcasting to client: {e}")
-                    # 移除无法发送消息的客户端
-                    self.clients.remove(client)
+                    self.journal.append(frames, first_sequence)
+                except OSError as e:
+                    print(f"Failed to write event journal: {e}")
+            
+            text_lines = [encode_text_event(event_type, file_path, new_file_path)
+                          for event_type, file_path, new_file_path, _is_dir in events]
+            encoded = {
+                TEXT_PROTOCOL_VERSION: b''.join(text_lines),
+                BINARY_PROTOCOL_VERSION: frames[0] if len(frames) == 1
+                else encode_batch_frame(frames, first_sequence),
+            }
+            self.broadcast_queue.append(Broadcast(self.sequence, encoded, events, frames, text_lines))
+        
+        self._wakeup()
+    
+    def broadcast_resync(self):
+        """服务端丢失了文件事件时通知所有二进制协议客户端重新对比目录，通知写入事件日志，续传的客户端也会收到"""
+        if not self.running:
+            return
+        
+        with self.broadcast_lock:
+            self.sequence += 1
+            frame = encode_resync_frame(self.sequence)
+            if self.journal is not None:
+                try:
+                    self.journal.append([frame], self.sequence)
+                except OSError as e:
+                    print(f"Failed to write event journal: {e}")
+            self.broadcast_queue.append(Broadcast(self.sequence, {BINARY_PROTOCOL_VERSION: frame}))
+        
+        self._wakeup()
     
     def get_client_count(self):
         """获取当前连接的客户端数量"""